@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""ikunimage 压测：在本地模拟服务上按 worker 数 x 引擎矩阵跑批量生成，汇报吞吐、延迟和内存。
+
+用法:
+    # 默认：文生图 50 张 1K，thread/async x 4/16/64 workers，自动拉起 mock_server.py
+    python bench.py
+
+    # 图生图 + 2K，附加参数透传给生成脚本
+    python bench.py --script edit --size 2K --workers 8,32 --extra "--adaptive --http2"
+
+    # 注入故障，延迟按真实值的 5% 运行
+    python bench.py --rate-429 0.05 --rate-5xx 0.02 --time-scale 0.05
+
+    # 使用已在运行的服务，结果另存 JSON
+    python bench.py --base-url http://127.0.0.1:8765 --json bench.json
+
+每个组合在独立子进程中运行 generate_ikun.py / generate_ikun_edit.py 的 --batch 模式
+（即 generate_batch / edit_batch 及其 async 版本），HOME 指向临时目录，互不共享缓存和限流状态。
+指标:
+    img/s   成功张数 / 进程总耗时
+    p50/p99 单任务耗时（结果中的 elapsed，含重试与退避）
+    RSS     子进程峰值常驻内存
+"""
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from mock_server import make_png  # noqa: E402
+
+# ---------------------------------------------------------------------------
+# 常量
+# ---------------------------------------------------------------------------
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent / "skills" / "ikunimage" / "scripts"
+SCRIPTS = {
+    "gen": SCRIPTS_DIR / "generate_ikun.py",
+    "edit": SCRIPTS_DIR / "generate_ikun_edit.py",
+}
+MOCK_SERVER = Path(__file__).resolve().parent / "mock_server.py"
+MOCK_START_TIMEOUT = 60
+INPUT_IMAGE_SIDE = 512
+
+
+# ---------------------------------------------------------------------------
+# 模拟服务
+# ---------------------------------------------------------------------------
+
+def start_mock(args) -> tuple[subprocess.Popen, str]:
+    """以随机端口拉起 mock_server.py，返回进程和 BASE_URL。"""
+    cmd = [
+        sys.executable, str(MOCK_SERVER), "--port", "0",
+        "--latency", args.latency,
+        "--time-scale", str(args.time_scale),
+        "--payload-scale", str(args.payload_scale),
+        "--rate-429", str(args.rate_429),
+        "--rate-5xx", str(args.rate_5xx),
+        "--rate-stall", str(args.rate_stall),
+        "--max-inflight", str(args.max_inflight),
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    deadline = time.monotonic() + MOCK_START_TIMEOUT
+    while time.monotonic() < deadline:
+        line = proc.stdout.readline()
+        if line.startswith("listening "):
+            return proc, line.split(" ", 1)[1].strip()
+        if not line and proc.poll() is not None:
+            break
+    proc.kill()
+    raise RuntimeError("模拟服务启动失败")
+
+
+def mock_stats(base_url: str) -> dict | None:
+    try:
+        with urllib.request.urlopen(f"{base_url}/stats", timeout=5) as r:
+            return json.loads(r.read())
+    except (OSError, ValueError):
+        return None
+
+
+# ---------------------------------------------------------------------------
+# 单次运行
+# ---------------------------------------------------------------------------
+
+def _percentile(values: list, pct: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _write_tasks(path: Path, script: str, n: int, size: str, out_dir: Path, input_image: Path) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(n):
+            task = {"prompt": f"bench #{i}", "output": str(out_dir / f"{i:05d}.png")}
+            if script == "gen":
+                task["size"] = size
+            else:
+                task["input"] = str(input_image)
+            f.write(json.dumps(task) + "\n")
+
+
+def run_case(script: str, engine: str, workers: int, args, base_url: str, work: Path) -> dict:
+    """跑一个组合，返回指标字典。"""
+    case_dir = work / f"{script}-{engine}-{workers}"
+    out_dir = case_dir / "out"
+    home = case_dir / "home"
+    out_dir.mkdir(parents=True)
+    home.mkdir()
+    tasks_path = case_dir / "tasks.jsonl"
+    results_path = case_dir / "results.jsonl"
+    _write_tasks(tasks_path, script, args.tasks, args.size, out_dir, work / "input.png")
+
+    cmd = [
+        sys.executable, str(SCRIPTS[script]),
+        "--batch", str(tasks_path),
+        "--engine", engine,
+        "--workers", str(workers),
+        "--results", str(results_path),
+        "--api-key", "bench",
+        *shlex.split(args.extra),
+    ]
+    env = dict(os.environ, IKUN_BASE_URL=base_url, HOME=str(home))
+    env.pop("IKUN_API_KEY", None)
+    with open(case_dir / "stdout.log", "wb") as out, open(case_dir / "stderr.log", "wb") as err:
+        t0 = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=out, stderr=err, env=env)
+        # wait4 拿到的是该子进程自己的资源占用，不会混入之前的组合
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - t0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    ok, elapsed = 0, []
+    if results_path.exists():
+        with open(results_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result.get("success"):
+                    ok += 1
+                    elapsed.append(result.get("elapsed", 0.0))
+    # Linux 上 ru_maxrss 单位是 KB，macOS 上是字节
+    rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return {
+        "script": script,
+        "engine": engine,
+        "workers": workers,
+        "tasks": args.tasks,
+        "ok": ok,
+        "exit": proc.returncode,
+        "wall": round(wall, 2),
+        "img_per_s": round(ok / wall, 2) if wall > 0 else 0.0,
+        "p50": _percentile(elapsed, 50),
+        "p99": _percentile(elapsed, 99),
+        "peak_rss_mb": round(rss_mb, 1),
+    }
+
+
+# ---------------------------------------------------------------------------
+# 报告
+# ---------------------------------------------------------------------------
+
+def _fmt(value) -> str:
+    return "-" if value is None else f"{value:.2f}"
+
+
+def print_table(rows: list) -> None:
+    header = f"{'script':<6} {'engine':<7} {'workers':>7} {'ok':>9} {'wall(s)':>8} {'img/s':>7} " \
+             f"{'p50(s)':>7} {'p99(s)':>7} {'RSS(MB)':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(f"{r['script']:<6} {r['engine']:<7} {r['workers']:>7} {r['ok']:>4}/{r['tasks']:<4} "
+              f"{r['wall']:>8.2f} {r['img_per_s']:>7.2f} {_fmt(r['p50']):>7} {_fmt(r['p99']):>7} "
+              f"{r['peak_rss_mb']:>8.1f}")
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="ikunimage 批量生成压测")
+    parser.add_argument("--script", choices=["gen", "edit", "both"], default="gen",
+                        help="压测文生图 / 图生图 / 两者（默认: gen）")
+    parser.add_argument("--tasks", "-n", type=int, default=50, help="每个组合的任务数（默认: 50）")
+    parser.add_argument("--size", default="1K", choices=["1K", "2K", "4K"], help="文生图分辨率（默认: 1K）")
+    parser.add_argument("--workers", default="4,16,64", help="逗号分隔的 worker 数列表（默认: 4,16,64）")
+    parser.add_argument("--engines", default="thread,async", help="逗号分隔的引擎列表（默认: thread,async）")
+    parser.add_argument("--extra", default="", help="透传给生成脚本的额外参数，如 \"--adaptive --http2\"")
+    parser.add_argument("--json", default=None, metavar="FILE", help="把结果另存为 JSON")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录（输出图片与日志）")
+
+    mock = parser.add_argument_group("模拟服务（未指定 --base-url 时自动拉起）")
+    mock.add_argument("--base-url", default=None, help="使用已在运行的服务，不再自动拉起")
+    mock.add_argument("--latency", default="lognormal:20:0.5", metavar="SPEC", help="延迟分布（默认: lognormal:20:0.5）")
+    mock.add_argument("--time-scale", type=float, default=0.05, help="延迟缩放（默认: 0.05，即中位数约 1 秒）")
+    mock.add_argument("--payload-scale", type=float, default=1.0, help="图片体积缩放（默认: 1）")
+    mock.add_argument("--rate-429", type=float, default=0.0, help="429 概率（默认: 0）")
+    mock.add_argument("--rate-5xx", type=float, default=0.0, help="5xx 概率（默认: 0）")
+    mock.add_argument("--rate-stall", type=float, default=0.0, help="响应体中途卡住的概率（默认: 0）")
+    mock.add_argument("--max-inflight", type=int, default=0, help="服务端并发上限，超出返回 429（默认: 不限制）")
+    args = parser.parse_args()
+
+    try:
+        workers = [int(w) for w in args.workers.split(",") if w.strip()]
+    except ValueError:
+        parser.error("--workers 必须是逗号分隔的整数")
+    engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+    if not set(engines) <= {"thread", "async"}:
+        parser.error("--engines 只能包含 thread / async")
+    scripts = ["gen", "edit"] if args.script == "both" else [args.script]
+
+    mock_proc = None
+    base_url = args.base_url
+    work = Path(tempfile.mkdtemp(prefix="ikun-bench-"))
+    rows = []
+    try:
+        if base_url is None:
+            print("启动模拟服务...", file=sys.stderr)
+            mock_proc, base_url = start_mock(args)
+        base_url = base_url.rstrip("/")
+        (work / "input.png").write_bytes(make_png(INPUT_IMAGE_SIDE, 0))
+
+        for script in scripts:
+            for engine in engines:
+                for w in workers:
+                    print(f"[{script}] engine={engine} workers={w} ...", file=sys.stderr, flush=True)
+                    row = run_case(script, engine, w, args, base_url, work)
+                    if row["exit"] != 0 and row["ok"] == 0:
+                        print(f"  子进程退出码 {row['exit']}，日志: {work / f'{script}-{engine}-{w}'}",
+                              file=sys.stderr)
+                        args.keep = True
+                    rows.append(row)
+        stats = mock_stats(base_url)
+    finally:
+        if mock_proc is not None:
+            mock_proc.terminate()
+            mock_proc.wait()
+        if args.keep:
+            print(f"临时目录: {work}", file=sys.stderr)
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+    print()
+    print_table(rows)
+    if stats:
+        print(f"\n服务端: {stats['requests']} 个请求, 状态 {stats['status']}, "
+              f"峰值并发 {stats['peak_inflight']}, 下行 {stats['mb_out']} MB")
+    if args.json:
+        Path(args.json).write_text(json.dumps({"cases": rows, "server": stats}, indent=2, ensure_ascii=False),
+                                   encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""ikunimage 本地模拟服务：替身 /v1beta/models/...:generateContent 端点，用于压测与故障演练。
+
+用法:
+    # 启动（默认 127.0.0.1:8765）
+    python mock_server.py [--latency lognormal:20:0.5] [--rate-429 0.05] [--rate-5xx 0.01]
+
+    # 让生成脚本指向它
+    IKUN_BASE_URL=http://127.0.0.1:8765 python generate_ikun.py --batch tasks.json --api-key test
+
+    # 查看统计
+    curl http://127.0.0.1:8765/stats
+
+响应体与真实接口同构（candidates[0].content.parts[].inlineData），图片是按 imageConfig.image_size
+生成的合法 PNG（1K/2K/4K 对应 1024/2048/4096 像素见方），体积默认贴近真实返回。
+只依赖标准库。
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ---------------------------------------------------------------------------
+# 常量
+# ---------------------------------------------------------------------------
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_LATENCY = "lognormal:20:0.5"
+# 解码后的 PNG 大小（MiB），按真实接口的常见返回估算
+PAYLOAD_MIB = {"1K": 1.5, "2K": 5.5, "4K": 20.0}
+PIXELS = {"1K": 1024, "2K": 2048, "4K": 4096}
+# 分辨率越高生成越慢，延迟分布按此倍数放大
+LATENCY_FACTOR = {"1K": 1.0, "2K": 1.5, "4K": 3.0}
+DEFAULT_SIZE = "1K"  # 图生图请求不带 image_size
+SERVER_ERROR_CODES = (500, 502, 503)
+STALL_SECONDS = 3600  # 卡住的响应在发出首块后挂起多久（客户端超时断开即结束）
+WRITE_CHUNK = 256 * 1024
+
+
+# ---------------------------------------------------------------------------
+# 延迟分布
+# ---------------------------------------------------------------------------
+
+def parse_latency(spec: str):
+    """解析延迟分布描述，返回无参采样函数（秒）。
+
+    支持:
+        fixed:S                  固定 S 秒
+        uniform:A:B              [A, B] 均匀分布
+        lognormal:MEDIAN:SIGMA   对数正态，中位数 MEDIAN 秒
+        exp:MEAN                 指数分布，均值 MEAN 秒
+    """
+    kind, _, rest = spec.partition(":")
+    try:
+        args = [float(x) for x in rest.split(":")] if rest else []
+    except ValueError:
+        raise ValueError(f"无法解析延迟分布参数: {spec}")
+    if kind == "fixed" and len(args) == 1:
+        return lambda: args[0]
+    if kind == "uniform" and len(args) == 2:
+        return lambda: random.uniform(args[0], args[1])
+    if kind == "lognormal" and len(args) == 2:
+        mu = math.log(max(args[0], 1e-6))
+        return lambda: random.lognormvariate(mu, args[1])
+    if kind == "exp" and len(args) == 1:
+        return lambda: random.expovariate(1 / args[0]) if args[0] > 0 else 0.0
+    raise ValueError(f"不支持的延迟分布: {spec}（可选 fixed:S / uniform:A:B / lognormal:MEDIAN:SIGMA / exp:MEAN）")
+
+
+# ---------------------------------------------------------------------------
+# 图片负载
+# ---------------------------------------------------------------------------
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+def make_png(side: int, target_bytes: int) -> bytes:
+    """生成 side x side 的 RGB PNG，前若干行是噪声、其余纯色，使文件大小接近 target_bytes。"""
+    row = side * 3
+    noisy = min(side, max(0, target_bytes // row))
+    comp = zlib.compressobj(1)
+    parts = []
+    blank = b"\x00" * (row + 1)
+    for y in range(side):
+        parts.append(comp.compress(b"\x00" + os.urandom(row) if y < noisy else blank))
+    parts.append(comp.flush())
+    ihdr = struct.pack(">IIBBBBB", side, side, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", ihdr)
+            + _png_chunk(b"IDAT", b"".join(parts)) + _png_chunk(b"IEND", b""))
+
+
+def build_bodies(scale: float) -> dict:
+    """预先生成各分辨率的单个候选（bytes），请求时按候选数拼成响应体写出。"""
+    bodies = {}
+    for size, mib in PAYLOAD_MIB.items():
+        png = make_png(PIXELS[size], int(mib * scale * 1024 * 1024))
+        data = base64.b64encode(png).decode()
+        bodies[size] = json.dumps({
+            "content": {"parts": [
+                {"text": "mock image"},
+                {"inlineData": {"mimeType": "image/png", "data": data}},
+            ]},
+            "finishReason": "STOP",
+        }).encode()
+    return bodies
+
+
+def compose_body(candidate: bytes, count: int) -> bytes:
+    """把 count 个相同的候选拼成 generateContent 响应体。"""
+    return b'{"candidates": [' + b", ".join([candidate] * count) + b'], "modelVersion": "mock"}'
+
+
+# ---------------------------------------------------------------------------
+# 统计
+# ---------------------------------------------------------------------------
+
+class Stats:
+    """线程安全的请求计数，供 GET /stats 和退出时打印。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.inflight = 0
+        self.peak_inflight = 0
+        self.status = {}
+        self.keys = {}
+        self.bytes_out = 0
+
+    def enter(self, key: str) -> int:
+        with self._lock:
+            self.requests += 1
+            self.keys[key] = self.keys.get(key, 0) + 1
+            self.inflight += 1
+            self.peak_inflight = max(self.peak_inflight, self.inflight)
+            return self.inflight
+
+    def leave(self, status: int, nbytes: int) -> None:
+        with self._lock:
+            self.inflight -= 1
+            self.status[str(status)] = self.status.get(str(status), 0) + 1
+            self.bytes_out += nbytes
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "uptime": round(time.time() - self.started, 1),
+                "requests": self.requests,
+                "inflight": self.inflight,
+                "peak_inflight": self.peak_inflight,
+                "status": dict(self.status),
+                "keys": dict(self.keys),
+                "mb_out": round(self.bytes_out / 1024 / 1024, 1),
+            }
+
+
+# ---------------------------------------------------------------------------
+# HTTP 处理
+# ---------------------------------------------------------------------------
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "ikun-mock/1.0"
+
+    def log_message(self, fmt, *args):
+        if self.server.opts.verbose:
+            super().log_message(fmt, *args)
+
+    def _send(self, status: int, body: bytes, headers: dict | None = None, stall: bool = False,
+              truncate: bool = False) -> int:
+        """发送响应；stall 时只发出响应头和第一块数据就挂起，模拟卡死的连接；
+        truncate 时只发出一半响应体就关闭连接，模拟传输中途断开。"""
+        opts = self.server.opts
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if stall:
+            self.wfile.write(body[:WRITE_CHUNK])
+            self.wfile.flush()
+            time.sleep(STALL_SECONDS)
+            return min(len(body), WRITE_CHUNK)
+        if truncate:
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return len(body) // 2
+        if not opts.bandwidth:
+            self.wfile.write(body)
+            return len(body)
+        # 按带宽限速分块写出，模拟下载耗时
+        per_chunk = WRITE_CHUNK / (opts.bandwidth * 1024 * 1024)
+        for i in range(0, len(body), WRITE_CHUNK):
+            self.wfile.write(body[i:i + WRITE_CHUNK])
+            time.sleep(per_chunk)
+        return len(body)
+
+    def _error(self, status: int, message: str, headers: dict | None = None) -> int:
+        body = json.dumps({"error": {"code": status, "message": message}}).encode()
+        return self._send(status, body, headers)
+
+    def do_HEAD(self):
+        # 生成脚本启动时用 HEAD / 预热连接
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send(200, json.dumps(self.server.stats.snapshot()).encode())
+        else:
+            self._error(404, "not found")
+
+    def do_POST(self):
+        opts = self.server.opts
+        stats = self.server.stats
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+        auth = self.headers.get("Authorization", "")
+        api_key = auth[len("Bearer "):] if auth.startswith("Bearer ") else ""
+        inflight = stats.enter(api_key[-4:])
+        status, sent = 500, 0
+        try:
+            if not self.path.endswith(":generateContent"):
+                status = 404
+                sent = self._error(status, f"unknown path {self.path}")
+                return
+            if not api_key:
+                status = 401
+                sent = self._error(status, "missing API key")
+                return
+            if api_key in opts.reject_key:
+                status = 401
+                sent = self._error(status, "API key not valid")
+                return
+            if api_key in opts.exhaust_key:
+                status = 429
+                sent = self._error(status, "quota exceeded for this API key")
+                return
+            try:
+                payload = json.loads(raw)
+                image_config = payload.get("generationConfig", {}).get("imageConfig", {})
+                candidates = int(payload.get("generationConfig", {}).get("candidateCount", 1))
+            except (ValueError, AttributeError):
+                status = 400
+                sent = self._error(status, "invalid JSON payload")
+                return
+            size = image_config.get("image_size") or image_config.get("imageSize") or DEFAULT_SIZE
+            if size not in self.server.bodies:
+                status = 400
+                sent = self._error(status, f"unsupported image_size {size}")
+                return
+            if candidates > 1 and not opts.max_candidates:
+                status = 400
+                sent = self._error(status, "candidateCount is not supported for this model")
+                return
+
+            retry_after = {"Retry-After": f"{opts.retry_after:g}"} if opts.retry_after else None
+            if opts.max_inflight and inflight > opts.max_inflight:
+                status = 429
+                sent = self._error(status, "too many concurrent requests", retry_after)
+                return
+            roll = random.random()
+            if roll < opts.rate_429:
+                status = 429
+                sent = self._error(status, "resource exhausted", retry_after)
+                return
+            # 5xx 在生成阶段失败，先消耗一部分延迟更贴近真实
+            delay = self.server.latency() * LATENCY_FACTOR[size] * opts.time_scale
+            if roll < opts.rate_429 + opts.rate_5xx:
+                time.sleep(delay * random.random())
+                status = random.choice(SERVER_ERROR_CODES)
+                sent = self._error(status, "internal error")
+                return
+            time.sleep(delay)
+            status = 200
+            stall = roll < opts.rate_429 + opts.rate_5xx + opts.rate_stall
+            truncate = not stall and roll < opts.rate_429 + opts.rate_5xx + opts.rate_stall + opts.rate_truncate
+            body = compose_body(self.server.bodies[size], max(1, min(candidates, opts.max_candidates)))
+            sent = self._send(status, body, stall=stall, truncate=truncate)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端已放弃（超时 / 对冲的另一方先完成）
+            status = 499
+        finally:
+            stats.leave(status, sent)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, addr, opts):
+        super().__init__(addr, MockHandler)
+        self.opts = opts
+        self.latency = parse_latency(opts.latency)
+        self.bodies = build_bodies(opts.payload_scale)
+        self.stats = Stats()
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="ikunimage 本地模拟服务")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"监听地址（默认: {DEFAULT_HOST}）")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"监听端口，0 为随机（默认: {DEFAULT_PORT}）")
+    parser.add_argument(
+        "--latency", default=DEFAULT_LATENCY, metavar="SPEC",
+        help=f"1K 图的生成延迟分布，2K/4K 按倍数放大（默认: {DEFAULT_LATENCY}）",
+    )
+    parser.add_argument(
+        "--time-scale", type=float, default=1.0,
+        help="延迟整体缩放，压测时可设为 0.01 等加速（默认: 1）",
+    )
+    parser.add_argument(
+        "--payload-scale", type=float, default=1.0,
+        help="图片体积缩放（默认: 1，即 1K/2K/4K 约 1.5/5.5/20 MiB）",
+    )
+    parser.add_argument("--rate-429", type=float, default=0.0, help="随机返回 429 的概率（默认: 0）")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="随机返回 500/502/503 的概率（默认: 0）")
+    parser.add_argument(
+        "--rate-stall", type=float, default=0.0,
+        help="响应体发出第一块后卡住不动的概率，用于演练读取空闲超时（默认: 0）",
+    )
+    parser.add_argument(
+        "--rate-truncate", type=float, default=0.0,
+        help="响应体只发出一半就断开连接的概率，用于演练传输中断后的重试（默认: 0）",
+    )
+    parser.add_argument(
+        "--max-candidates", type=int, default=1,
+        help="单次响应最多返回的候选数，多请求的部分直接忽略；0 为拒绝 candidateCount > 1（默认: 1）",
+    )
+    parser.add_argument(
+        "--retry-after", type=float, default=1.0,
+        help="429 响应携带的 Retry-After 秒数，0 为不携带（默认: 1）",
+    )
+    parser.add_argument(
+        "--max-inflight", type=int, default=0,
+        help="同时处理的请求数上限，超出直接返回 429（默认: 不限制）",
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=0.0, metavar="MB_PER_S",
+        help="单连接下行带宽上限（默认: 不限速）",
+    )
+    parser.add_argument(
+        "--reject-key", action="append", default=[], metavar="KEY",
+        help="对该 API Key 一律返回 401，可重复指定，用于演练多 Key 故障切换",
+    )
+    parser.add_argument(
+        "--exhaust-key", action="append", default=[], metavar="KEY",
+        help="对该 API Key 一律返回 429（额度用尽），可重复指定",
+    )
+    parser.add_argument("--verbose", "-v", action="store_true", help="打印每个请求的访问日志")
+    return parser
+
+
+def main():
+    opts = build_parser().parse_args()
+    try:
+        parse_latency(opts.latency)
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    print("正在生成模拟图片负载...", file=sys.stderr)
+    server = MockServer((opts.host, opts.port), opts)
+    sizes = ", ".join(f"{k}={len(compose_body(v, 1)) / 1024 / 1024:.1f}MB" for k, v in server.bodies.items())
+    host, port = server.server_address[:2]
+    # 第一行固定格式，供 bench.py 等调用方解析实际端口
+    print(f"listening http://{host}:{port}", flush=True)
+    print(f"  延迟: {opts.latency} x{opts.time_scale:g} | 响应体: {sizes} | "
+          f"429: {opts.rate_429:g} | 5xx: {opts.rate_5xx:g} | 卡住: {opts.rate_stall:g} | "
+          f"断开: {opts.rate_truncate:g}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats.snapshot(), ensure_ascii=False), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,20 +11,58 @@
     python generate_ikun_edit.py --input photo.jpg --prompt "将背景改为雪景" \
                                  [--aspect-ratio 1:1] [--output edited.png] [--retry 3]
 
+    # 一次编辑出 4 个版本（edited.png、edited_2.png ...）
+    python generate_ikun_edit.py --input photo.jpg --prompt "将背景改为雪景" --count 4
+
     # 并发批量编辑
     python generate_ikun_edit.py --batch tasks.json [--workers 2] [--retry 3]
+
+    # 参数扫描（输入图片 × 编辑描述模板 × 宽高比，按需展开）
+    python generate_ikun_edit.py --batch sweep.json
+
+    # 异步引擎（单线程上百并发）
+    python generate_ikun_edit.py --batch tasks.json --engine async --workers 200 [--http2]
+
+    # 常驻守护进程（之后的调用自动交给它执行，复用连接池）
+    python generate_ikun_edit.py --serve &
 """
 
 import argparse
+import asyncio
+import atexit
 import base64
+import bisect
+import contextvars
+import email.utils
+import hashlib
+import heapq
+import importlib.util
+import io
+import itertools
 import json
+import math
 import mimetypes
+import mmap
 import os
+import queue
+import random
+import re
+import shutil
+import signal
+import string
+import socket
+import socketserver
 import sys
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import uuid
+from collections import OrderedDict, deque
+from collections.abc import Callable, Iterable, Sized
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
 from pathlib import Path
+from typing import NamedTuple
 
 try:
     import httpx
@@ -32,14 +70,33 @@ except ImportError:
     print("错误: 需要 httpx 库，请执行: pip install httpx", file=sys.stderr)
     sys.exit(1)
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows 下无 flock，跨进程限流不可用
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None  # 输入预处理（--max-input-edge / --input-format）和输出后处理时才需要 Pillow
+
 # ---------------------------------------------------------------------------
 # 渠道配置（单渠道：ikun）
 # ---------------------------------------------------------------------------
 
-BASE_URL = "https://api.ikuncode.cc"
+# IKUN_BASE_URL 用于把请求指向本地模拟服务（bench/mock_server.py）等替代端点
+BASE_URL = os.environ.get("IKUN_BASE_URL", "https://api.ikuncode.cc").rstrip("/")
 MODEL_PATH = "/v1beta/models/gemini-3-pro-image-preview:generateContent"
 CONFIG_DIR = Path.home() / ".ikunimage"
 CONFIG_FILE = CONFIG_DIR / "config.json"
+CACHE_DIR = CONFIG_DIR / "cache"
+RATE_LIMIT_DIR = CONFIG_DIR / "ratelimit"
+# 成功请求耗时的历史（文生图与图生图共用，按 latency key 区分），用于自适应超时
+LATENCY_HISTORY_PATH = CONFIG_DIR / "latency.json"
+# 运行中探测到的上游能力（如是否支持多候选），与存放凭据的 config.json 分开保存
+STATE_FILE = CONFIG_DIR / "state.json"
+# 守护进程（--serve）监听的 Unix socket，文生图与图生图的守护进程各自独立
+DAEMON_SOCKET = CONFIG_DIR / "edit.sock"
 
 # ---------------------------------------------------------------------------
 # 常量
@@ -54,17 +111,269 @@ SUPPORTED_IMAGE_FORMATS = {".jpg", ".jpeg", ".png", ".webp", ".gif"}
 
 MAX_IMAGE_SIZE_MB = 4
 
+# 批量编辑时输入图片 base64 缓存的内存上限
+INPUT_CACHE_MAX_MB = 256
+
+# 输入预处理可选的重编码格式
+INPUT_FORMATS = ["webp", "jpeg", "png"]
+
 TIMEOUT_SECONDS = 600
 
+# 单个任务最多输出的图片数（--count / 任务的 count 字段，即 candidateCount 的上限）
+MAX_IMAGE_COUNT = 8
+
+# 输出后处理：可选的转换格式，每个后处理进程最多积压的任务数（超过后网络 worker 等待）
+OUTPUT_FORMATS = ["webp", "jpeg", "png"]
+POSTPROCESS_QUEUE_FACTOR = 4
+
+# 批量输出写入（write-behind）：写线程数、待写数据的内存上限（MB）、fsync 方式，
+# 以及 --fsync batch 时攒够多少个文件或最多等待多少秒后一起 fsync、重命名
+OUTPUT_WRITER_THREADS = 4
+OUTPUT_WRITE_BUFFER_MB = 256
+FSYNC_MODES = ["off", "batch", "always"]
+OUTPUT_FSYNC_BATCH = 32
+OUTPUT_FSYNC_INTERVAL = 1.0
+
 RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
 
-_print_lock = threading.Lock()
+# 重试退避（秒）：decorrelated jitter 的下限 / 上限，以及 Retry-After 最多遵从多久
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+RETRY_AFTER_MAX = 600.0
+
+# 批量重试预算：默认 10 次，每提交一个任务再追加 0.5 次（流式读取任务时总数未知）
+RETRY_BUDGET_RATIO = 0.5
+RETRY_BUDGET_MIN = 10
+
+# 熔断：最近 BREAKER_WINDOW 次请求中（至少 BREAKER_MIN_SAMPLES 次）失败占比达到
+# BREAKER_FAILURE_RATIO 时暂停所有请求，暂停时间从 BREAKER_COOLDOWN 起按次加倍
+BREAKER_WINDOW = 20
+BREAKER_MIN_SAMPLES = 10
+BREAKER_FAILURE_RATIO = 0.5
+BREAKER_COOLDOWN = 30.0
+BREAKER_MAX_COOLDOWN = 300.0
+BREAKER_POLL_SECONDS = 1.0
+BREAKER_MAX_TRIPS = 4  # 连续熔断这么多次（探测一直失败）后放弃剩余请求
+
+# 自适应并发（--adaptive）：视为限流信号的状态码、未指定 --workers 时的并发上限、
+# 近期延迟超过基线多少倍时停止增加并发
+THROTTLE_STATUS_CODES = {429, 503}
+ADAPTIVE_MAX_WORKERS = 32
+ADAPTIVE_LATENCY_TOLERANCE = 2.0
+ADAPTIVE_BASELINE_SAMPLES = 5
+
+# 批量任务：必填字段、视为 JSONL（逐行按需读取）的文件后缀、
+# 提交队列长度（最多 workers × BATCH_QUEUE_FACTOR 个任务已提交未完成）
+REQUIRED_TASK_FIELDS = ("input", "prompt", "output")
+JSONL_SUFFIXES = {".jsonl", ".ndjson"}
+# 参数扫描（JSON 对象带 sweep）：可由同名扫描变量直接提供、或写成模板的任务字段
+SWEEP_TASK_FIELDS = ("input", "prompt", "output", "aspect_ratio", "count", "priority", "deadline")
+BATCH_QUEUE_FACTOR = 2
+
+# 请求对冲（--hedge）：默认分位数、统计延迟的样本数，样本不足时的等待秒数，
+# 以及批量时对冲请求占任务数的默认上限
+HEDGE_DEFAULT_PERCENTILE = 95.0
+HEDGE_MIN_SAMPLES = 10
+HEDGE_MAX_SAMPLES = 200
+HEDGE_FALLBACK_DELAY = {"edit": 150}
+HEDGE_DEFAULT_DELAY = 150
+HEDGE_BUDGET_RATIO = 0.1
+
+# 批量调度：各延迟类别预估的单任务耗时（秒，用于排序和判断能否赶上截止时间）、
+# 排序窗口（JSONL 流式读取时最多向前读入的任务数）
+EXPECTED_SECONDS = {"edit": 60}
+SCHEDULE_WINDOW = 1000
+
+# 分阶段耗时（结果中的 timings 字段）、指标直方图的桶上限（秒）和导出时的 script 标签
+TIMING_PHASES = ("prepare", "queue", "backoff", "connect", "upload", "ttfb", "download", "parse", "decode", "write")
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+METRICS_SCRIPT = "edit"
+
+# 自适应超时：每个 latency key 保留的耗时样本数；样本达到 ADAPTIVE_TIMEOUT_MIN_SAMPLES 后
+# 总超时 = p99 x ADAPTIVE_TIMEOUT_FACTOR，不低于 ADAPTIVE_TIMEOUT_FLOOR、不高于 TIMEOUT_SECONDS；
+# 建连超时与响应头到达后的读取空闲超时单独设置（卡住的连接不必等满总超时）
+LATENCY_HISTORY_SIZE = 200
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 20
+ADAPTIVE_TIMEOUT_PERCENTILE = 99.0
+ADAPTIVE_TIMEOUT_FACTOR = 2.0
+ADAPTIVE_TIMEOUT_FLOOR = 60
+CONNECT_TIMEOUT = 15
+READ_IDLE_TIMEOUT = 60
+
+# 共享连接池默认参数
+DEFAULT_MAX_CONNECTIONS = 16
+KEEPALIVE_EXPIRY = 120
+
+# 结果缓存默认上限（可在 config.json 中用 cache_max_mb / cache_max_age_days 覆盖）
+DEFAULT_CACHE_MAX_MB = 2048
+DEFAULT_CACHE_MAX_AGE_DAYS = 30
+
+# 跨进程限流：排队轮询间隔、排队者多久未轮询视为已退出、持有者名额的最长租期（超过最长超时）
+RATE_LIMIT_POLL_SECONDS = 0.2
+RATE_LIMIT_QUEUE_STALE_SECONDS = 10
+RATE_LIMIT_LEASE_SECONDS = 1800
+
+# 多 Key 池（config.json 的 keys）：视为认证失败 / 额度用尽的状态码、认证失败的 Key 停用多久；
+# 额度用尽（没有 Retry-After 时）或连续 KEY_FAILURE_THRESHOLD 次服务端错误 / 连接失败后冷却，
+# 冷却时间从 KEY_COOLDOWN 起按次加倍、不超过 KEY_MAX_COOLDOWN；近期失败率对选择的惩罚系数
+KEY_AUTH_STATUS_CODES = {401, 403}
+KEY_QUOTA_STATUS_CODES = {402, 429}
+KEY_AUTH_COOLDOWN = 3600.0
+KEY_COOLDOWN = 30.0
+KEY_MAX_COOLDOWN = 600.0
+KEY_FAILURE_THRESHOLD = 3
+KEY_ERROR_PENALTY = 4.0
+KEY_POOL_POLL_SECONDS = 1.0
+
+# 日志：级别（--quiet 只输出 notice 及以上）、后台写出队列的积压上限（超过后丢弃 info 日志）
+LOG_LEVELS = {"info": 20, "notice": 25, "warning": 30, "error": 40}
+LOG_QUEUE_SIZE = 10000
+
+
+# ---------------------------------------------------------------------------
+# 日志输出（后台线程写出，不阻塞网络 worker）
+# ---------------------------------------------------------------------------
+
+class _LogWriter:
+    """日志队列 + 后台写出线程。
+
+    调用方只做一次入队；格式化、写出和 flush 都在后台线程完成，stdout 是慢速管道时
+    也不会拖住网络 worker。积压超过 LOG_QUEUE_SIZE 条时直接丢弃 info 日志并计数，
+    notice 及以上的日志等待入队，不会丢弃。
+
+    stdout / stderr 为 None 时写当前的 sys.stdout / sys.stderr；守护进程为每个客户端调用
+    单独创建一个写出器，输出流指向该客户端。
+    """
+
+    _NAMES = {v: k for k, v in LOG_LEVELS.items()}
+
+    def __init__(self, stdout=None, stderr=None):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.level = LOG_LEVELS["info"]
+        self.json_lines = False
+        self.dropped = 0
+        self._reported = 0
+        self._queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def emit(self, level: int, msg: str, stream, fields: dict) -> None:
+        if level < self.level:
+            return
+        if self._thread is None:
+            self._start()
+        record = (time.time(), level, msg, stream, fields)
+        if level > LOG_LEVELS["info"]:
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ikunimage-log", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def stream(self, file=None):
+        """把 sys.stdout / sys.stderr 映射为本写出器实际写入的流。"""
+        if file is sys.stderr:
+            return self.stderr or sys.stderr
+        return self.stdout or file or sys.stdout
+
+    def _run(self) -> None:
+        pending = set()  # 已写入、尚未 flush 的流；队列清空时才 flush，积压时成批写出
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:  # close() 的结束标记
+                    for s in pending:
+                        self._write(s, None)
+                    return
+                ts, level, msg, stream, fields = record
+                self._write(stream, self._format(ts, level, msg, fields))
+                pending.add(stream)
+                if self._queue.empty():
+                    if self.dropped > self._reported:
+                        err = self.stream(sys.stderr)
+                        self._write(err, f"[ikunimage] 输出积压，已丢弃 {self.dropped - self._reported} 条日志")
+                        self._reported = self.dropped
+                        pending.add(err)
+                    for s in pending:
+                        self._write(s, None)
+                    pending.clear()
+            finally:
+                self._queue.task_done()
+
+    def _format(self, ts: float, level: int, msg: str, fields: dict) -> str:
+        if not self.json_lines:
+            return msg
+        entry = {"ts": round(ts, 3), "level": self._NAMES[level], "msg": msg.strip(), **fields}
+        return json.dumps(entry, ensure_ascii=False)
+
+    @staticmethod
+    def _write(stream, line: str | None) -> None:
+        """写一行（line 为 None 时只 flush），输出管道已关闭时静默丢弃。"""
+        try:
+            if line is not None:
+                stream.write(line + "\n")
+            else:
+                stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def flush(self) -> None:
+        """等待已入队的日志全部写出（进程退出时自动调用）。"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self) -> None:
+        """写出剩余日志并结束后台线程。"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            atexit.unregister(self.flush)
+
+
+_logger = _LogWriter()
+
+
+def _current_logger() -> _LogWriter:
+    """当前调用的日志写出器：守护进程中为该客户端专用的写出器，否则为进程级 _logger。"""
+    job = _current_job.get()
+    return _logger if job is None else job.logger
+
 
+def configure_logging(quiet: bool = False, json_lines: bool = False) -> None:
+    """quiet 时只输出 notice 及以上（批量汇总、警告、错误）；json_lines 时每行输出一个 JSON 对象。"""
+    logger = _current_logger()
+    logger.level = LOG_LEVELS["notice" if quiet else "info"]
+    logger.json_lines = json_lines
 
-def _safe_print(msg, *, file=None):
-    """线程安全的打印。"""
-    with _print_lock:
-        print(msg, file=file or sys.stdout, flush=True)
+
+def _safe_print(msg, *, file=None, level: str | None = None, **fields):
+    """线程安全、不阻塞的日志输出：入队后立即返回，由后台线程写出。
+
+    level 缺省时写 stderr 的视为 warning，其余为 info；fields 是 --log-json 时附加的结构化字段。
+    """
+    name = level or ("warning" if file is sys.stderr else "info")
+    logger = _current_logger()
+    logger.emit(LOG_LEVELS[name], msg, logger.stream(file), fields)
+
+
+def _print_result(text: str) -> None:
+    """输出最终结果（批量汇总 JSON）：先写完已入队的日志，再直接写 stdout，不受 --quiet / --log-json 影响。"""
+    logger = _current_logger()
+    logger.flush()
+    out = logger.stream()
+    logger._write(out, text)
+    logger._write(out, None)
 
 
 # ---------------------------------------------------------------------------
@@ -106,14 +415,19 @@ def resolve_api_key(cli_key: str | None = None) -> str:
     file_key = config.get("api_key", "").strip()
     if file_key:
         return file_key
+    # 只配置了 keys（多 Key 池）时以第一个 Key 为准，请求由 Key 池分配
+    for entry in config.get("keys") or []:
+        if isinstance(entry, dict) and str(entry.get("api_key", "")).strip():
+            return str(entry["api_key"]).strip()
 
-    print(
+    _safe_print(
         "错误: 未找到 API Key。请通过以下方式之一配置：\n"
         "  1. 运行 python generate_ikun.py --setup 进行交互式配置\n"
         f"  2. 手动创建 {CONFIG_FILE}，内容: {{\"api_key\": \"sk-xxx\"}}\n"
         "  3. 设置环境变量 IKUN_API_KEY=sk-xxx\n"
         "  4. 使用 --api-key sk-xxx 命令行参数",
         file=sys.stderr,
+        level="error",
     )
     sys.exit(1)
 
@@ -151,8 +465,22 @@ def run_setup() -> None:
 # 图片读取
 # ---------------------------------------------------------------------------
 
-def read_image_as_base64(image_path: str) -> tuple[str, str]:
-    """读取本地图片并返回 (base64_data, mime_type)。
+class InputPreprocess(NamedTuple):
+    """上传前的输入图片预处理参数，全部为默认值时不做处理。"""
+
+    max_edge: int = 0           # 长边上限（像素），0 = 不缩放
+    format: str | None = None   # 重编码格式 webp / jpeg / png，None = 保持原格式
+    quality: int = 85           # webp / jpeg 质量
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_edge or self.format)
+
+
+def _check_input_image(image_path: str, allow_oversize: bool = False) -> tuple[Path, str]:
+    """校验输入图片并返回 (path, mime_type)。
+
+    allow_oversize=True 时跳过大小检查（启用预处理时由缩放/重编码负责压小）。
 
     Raises:
         FileNotFoundError: 图片不存在
@@ -170,16 +498,190 @@ def read_image_as_base64(image_path: str) -> tuple[str, str]:
         )
 
     size_mb = path.stat().st_size / (1024 * 1024)
-    if size_mb > MAX_IMAGE_SIZE_MB:
+    if size_mb > MAX_IMAGE_SIZE_MB and not allow_oversize:
         raise ValueError(f"图片过大 ({size_mb:.1f}MB)，建议 < {MAX_IMAGE_SIZE_MB}MB")
 
     mime_type, _ = mimetypes.guess_type(str(path))
     if not mime_type or not mime_type.startswith("image/"):
         mime_type = "image/jpeg"
 
-    raw = path.read_bytes()
-    b64 = base64.b64encode(raw).decode("utf-8")
-    return b64, mime_type
+    return path, mime_type
+
+
+def _encode_file_base64(path: Path) -> str:
+    """通过 mmap 分块编码文件，不再先 read_bytes 再整体 b64encode。
+
+    各块的编码结果只在最后拼接一次；拼接后立即释放分块，解码成 str 时只剩拼接结果这一份 bytes。
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return ""
+        step = 3 * 256 * 1024  # 3 的倍数，分块编码结果可直接拼接
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            chunks = [base64.b64encode(mm[start:start + step]) for start in range(0, size, step)]
+    data = b"".join(chunks)
+    chunks.clear()
+    return data.decode("ascii")
+
+
+def _file_digest(path: Path) -> str:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).hexdigest()
+
+
+def _preprocess_image(path: Path, preprocess: InputPreprocess) -> tuple[bytes, str] | None:
+    """按 preprocess 缩放 / 重编码图片，返回 (图片数据, mime_type)。
+
+    未指定格式且无需缩放时返回 None，直接上传原文件，避免无谓的有损重编码。
+    """
+    with Image.open(path) as im:
+        needs_resize = preprocess.max_edge and max(im.size) > preprocess.max_edge
+        if not needs_resize and not preprocess.format:
+            return None
+        fmt = preprocess.format or {"JPEG": "jpeg", "WEBP": "webp"}.get(im.format, "png")
+        # 元数据不随重编码保留，先按 EXIF 方向摆正
+        im = ImageOps.exif_transpose(im)
+        if needs_resize:
+            im.thumbnail((preprocess.max_edge, preprocess.max_edge), Image.Resampling.LANCZOS)
+        if fmt == "jpeg" and im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        elif im.mode not in ("RGB", "RGBA", "L", "LA"):
+            im = im.convert("RGBA")
+        buf = io.BytesIO()
+        save_kwargs = {} if fmt == "png" else {"quality": preprocess.quality}
+        im.save(buf, format=fmt.upper(), **save_kwargs)
+    return buf.getvalue(), f"image/{fmt}"
+
+
+def _load_input_base64(
+    path: Path,
+    mime_type: str,
+    preprocess: InputPreprocess | None = None,
+) -> tuple[str, str]:
+    """读取（并按需预处理）输入图片，返回 (base64_data, mime_type)。
+
+    模块级函数，便于提交到进程池执行。
+    """
+    if preprocess is None or not preprocess.enabled:
+        return _encode_file_base64(path), mime_type
+    processed = _preprocess_image(path, preprocess)
+    if processed is None:
+        data = path.read_bytes()
+    else:
+        data, mime_type = processed
+    size_mb = len(data) / (1024 * 1024)
+    if size_mb > MAX_IMAGE_SIZE_MB:
+        raise ValueError(
+            f"预处理后图片仍过大 ({size_mb:.1f}MB)，请减小 --max-input-edge 或 --input-quality"
+        )
+    return base64.b64encode(data).decode("utf-8"), mime_type
+
+
+def read_image_as_base64(
+    image_path: str,
+    preprocess: InputPreprocess | None = None,
+) -> tuple[str, str]:
+    """读取本地图片并返回 (base64_data, mime_type)。
+
+    Raises:
+        FileNotFoundError: 图片不存在
+        ValueError: 格式不支持或文件过大
+    """
+    enabled = preprocess is not None and preprocess.enabled
+    path, mime_type = _check_input_image(image_path, allow_oversize=enabled)
+    return _load_input_base64(path, mime_type, preprocess)
+
+
+class InputImageCache:
+    """批量编辑共享的输入图片 base64 缓存，线程安全，按内存上限做 LRU 淘汰。
+
+    先按 (路径, mtime, 大小) 找到文件内容的 sha256，再按内容取编码结果：
+    同一张图被多个任务引用、或不同路径指向相同内容时都只编码一次，
+    所有任务的 payload 引用同一个字符串。并发首次读取同一张图时只有一个线程编码。
+
+    指定 executor（进程池）时，预处理在池中执行，与其他 worker 的网络请求重叠。
+    """
+
+    def __init__(
+        self,
+        max_mb: float = INPUT_CACHE_MAX_MB,
+        preprocess: InputPreprocess | None = None,
+        executor: Executor | None = None,
+    ):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.preprocess = preprocess
+        self.executor = executor
+        self._lock = threading.Lock()
+        self._digests = {}            # (路径, mtime_ns, 大小) -> sha256
+        self._encoded = OrderedDict()  # sha256 -> (base64, mime_type)
+        self._inflight = {}           # sha256 -> threading.Event
+        self._bytes = 0
+
+    def read(self, image_path: str) -> tuple[str, str]:
+        """同 read_image_as_base64，但复用已编码的结果。"""
+        enabled = self.preprocess is not None and self.preprocess.enabled
+        path, mime_type = _check_input_image(image_path, allow_oversize=enabled)
+        digest = self.digest(path)
+
+        while True:
+            with self._lock:
+                hit = self._encoded.get(digest)
+                if hit is not None:
+                    self._encoded.move_to_end(digest)
+                    return hit
+                event = self._inflight.get(digest)
+                owner = event is None
+                if owner:
+                    event = self._inflight[digest] = threading.Event()
+            if not owner:
+                # 等待正在编码的线程；若它失败或结果超出上限未缓存，下一轮由本线程自己编码
+                event.wait()
+                continue
+            try:
+                if self.executor is not None:
+                    loaded = self.executor.submit(
+                        _load_input_base64, path, mime_type, self.preprocess,
+                    ).result()
+                else:
+                    loaded = _load_input_base64(path, mime_type, self.preprocess)
+                with self._lock:
+                    self._store(digest, loaded)
+                return loaded
+            finally:
+                with self._lock:
+                    self._inflight.pop(digest).set()
+
+    def digest(self, path: Path) -> str:
+        """文件内容的 sha256，按 (路径, mtime, 大小) 缓存。"""
+        st = path.stat()
+        stat_key = (str(path.resolve()), st.st_mtime_ns, st.st_size)
+        with self._lock:
+            digest = self._digests.get(stat_key)
+        if digest is None:
+            digest = _file_digest(path)
+            with self._lock:
+                self._digests[stat_key] = digest
+        return digest
+
+    def _store(self, digest: str, loaded: tuple[str, str]) -> None:
+        if len(loaded[0]) > self.max_bytes:
+            return
+        self._encoded[digest] = loaded
+        self._bytes += len(loaded[0])
+        while self._bytes > self.max_bytes:
+            _, (old, _) = self._encoded.popitem(last=False)
+            self._bytes -= len(old)
+
+
+def _preprocess_executor(preprocess: InputPreprocess | None, workers: int) -> Executor | None:
+    """批量预处理用的进程池，未启用预处理时返回 None。"""
+    if preprocess is None or not preprocess.enabled:
+        return None
+    return ProcessPoolExecutor(max_workers=max(1, min(workers, os.cpu_count() or 1)))
 
 
 # ---------------------------------------------------------------------------
@@ -191,9 +693,10 @@ def build_edit_payload(
     image_b64: str,
     mime_type: str,
     aspect_ratio: str,
+    count: int = 1,
 ) -> dict:
-    """构建图生图请求 payload。"""
-    return {
+    """构建图生图请求 payload，count > 1 时请求多个候选。"""
+    payload = {
         "contents": [
             {
                 "parts": [
@@ -214,257 +717,3806 @@ def build_edit_payload(
             },
         },
     }
-
-
-def _request_once(payload: dict, timeout: int, api_key: str) -> httpx.Response:
-    """发送单次 API 请求。"""
-    url = BASE_URL + MODEL_PATH
-    with httpx.Client(timeout=timeout) as client:
-        return client.post(
-            url,
-            json=payload,
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-        )
+    if count > 1:
+        payload["generationConfig"]["candidateCount"] = count
+    return payload
 
 
 # ---------------------------------------------------------------------------
-# 核心编辑逻辑（线程安全）
+# 跨进程限流（同一台机器上共用 API Key 的所有进程共享配额）
 # ---------------------------------------------------------------------------
 
-def _edit_core(
-    input_image: str,
-    prompt: str,
-    api_key: str,
-    aspect_ratio: str = "1:1",
-    output_path: str = "output.png",
-    max_retries: int = 3,
-    task_label: str = "",
-) -> dict:
-    """编辑单张图片，返回结果字典。线程安全，不会调用 sys.exit。
+class RateLimiter:
+    """基于文件锁的跨进程令牌桶 + 并发名额，按 API Key 划分。
 
-    返回:
-        成功: {"success": True, "path": str, "size_kb": float, "elapsed": float}
-        失败: {"success": False, "error": str}
+    状态保存在 CONFIG_DIR/ratelimit/<Key 指纹>.json，每次取用都在 flock 下读改写，
+    因此同机器上的所有 CLI 进程（以及进程内的所有线程 / 协程）共用同一份配额：
+    - rpm: 每分钟最多发出的请求数（令牌桶，容量 burst）
+    - concurrency: 同时在途的请求数上限
+    排队的请求按先来后到依次放行；持有者 / 排队者所在进程退出后其名额自动回收。
     """
-    tag = f"[ikunimage 编辑{' ' + task_label if task_label else ''}]"
 
-    # 读取输入图片
-    try:
-        image_b64, mime_type = read_image_as_base64(input_image)
-        _safe_print(f"{tag} 输入图片: {input_image} ({mime_type})")
-    except (FileNotFoundError, ValueError) as e:
-        return {"success": False, "error": str(e)}
+    def __init__(self, path: Path, rpm: float = 0, concurrency: int = 0, burst: int = 1):
+        self.path = path
+        self.rpm = max(0.0, float(rpm))
+        self.concurrency = max(0, int(concurrency))
+        self.burst = max(1, int(burst))
+        self._announced = False
+        # async 引擎的进程内排队：(事件循环, asyncio.Lock)，见 aacquire
+        self._aqueue = None
+        path.parent.mkdir(parents=True, exist_ok=True)
 
-    payload = build_edit_payload(prompt, image_b64, mime_type, aspect_ratio)
+    def _new_ticket(self) -> str:
+        return f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
 
-    _safe_print(f"{tag} 正在编辑图片...")
-    _safe_print(f"{tag}   编辑描述: {prompt[:80]}{'...' if len(prompt) > 80 else ''}")
-    _safe_print(f"{tag}   宽高比: {aspect_ratio} | 超时: {TIMEOUT_SECONDS}s")
+    @staticmethod
+    def _alive(entry: dict, now: float, max_age: float) -> bool:
+        if now - entry["t"] > max_age:
+            return False
+        try:
+            os.kill(entry["pid"], 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass  # 进程存在但属于其他用户
+        return True
 
-    resp = None
-    last_error = None
+    def _try_acquire(self, ticket: str) -> float:
+        """尝试取得名额：成功返回 0，否则返回建议的等待秒数（此时 ticket 留在队列中）。"""
+        with open(self.path, "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or "{}")
+            except json.JSONDecodeError:
+                state = {}
+            now = time.time()
+
+            tokens = float(state.get("tokens", self.burst))
+            if self.rpm:
+                elapsed = max(0.0, now - state.get("updated", now))
+                tokens = min(self.burst, tokens + elapsed * self.rpm / 60)
+            holders = {
+                k: v for k, v in state.get("holders", {}).items()
+                if self._alive(v, now, RATE_LIMIT_LEASE_SECONDS)
+            }
+            queue = {
+                k: v for k, v in state.get("queue", {}).items()
+                if self._alive(v, now, RATE_LIMIT_QUEUE_STALE_SECONDS)
+            }
+            queue.setdefault(ticket, {"pid": os.getpid(), "t": now})["t"] = now
 
-    for attempt in range(max_retries + 1):
-        if attempt > 0:
-            delay = min(2 ** attempt, 60)
-            _safe_print(f"{tag} 第 {attempt}/{max_retries} 次重试，等待 {delay}s ...")
-            time.sleep(delay)
+            wait = 0.0
+            if next(iter(queue)) != ticket:
+                wait = RATE_LIMIT_POLL_SECONDS
+            elif self.concurrency and len(holders) >= self.concurrency:
+                wait = RATE_LIMIT_POLL_SECONDS
+            elif self.rpm and tokens < 1:
+                wait = (1 - tokens) * 60 / self.rpm
+            else:
+                if self.rpm:
+                    tokens -= 1
+                del queue[ticket]
+                holders[ticket] = {"pid": os.getpid(), "t": now}
 
-        _safe_print(f"{tag} 发送请求 (attempt {attempt + 1})")
+            f.seek(0)
+            f.truncate()
+            json.dump({"tokens": tokens, "updated": now, "holders": holders, "queue": queue}, f)
+            return min(wait, RATE_LIMIT_POLL_SECONDS * 5)
 
-        t0 = time.time()
+    def _drop(self, ticket: str) -> None:
+        with open(self.path, "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or "{}")
+            except json.JSONDecodeError:
+                return
+            state.get("holders", {}).pop(ticket, None)
+            state.get("queue", {}).pop(ticket, None)
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+
+    def _announce(self) -> None:
+        if not self._announced:
+            self._announced = True
+            _safe_print("[ikunimage 限流] 已达到 config.json 中 rate_limit_* 的限制，请求排队中...")
+
+    def acquire(self) -> str:
+        """阻塞直到取得名额，返回 ticket（传给 release）。"""
+        ticket = self._new_ticket()
         try:
-            resp = _request_once(payload, TIMEOUT_SECONDS, api_key)
-        except httpx.TimeoutException:
-            last_error = "请求超时"
-            _safe_print(f"{tag} 请求超时", file=sys.stderr)
-            continue
-        except httpx.ConnectError as e:
-            last_error = f"连接失败: {e}"
-            _safe_print(f"{tag} 连接失败: {e}", file=sys.stderr)
-            continue
+            while (wait := self._try_acquire(ticket)) > 0:
+                self._announce()
+                time.sleep(wait)
+        except BaseException:
+            self._drop(ticket)
+            raise
+        return ticket
 
-        elapsed = time.time() - t0
+    def _async_queue(self) -> asyncio.Lock:
+        # asyncio.Lock 只能在一个事件循环中使用；限流器跨调用缓存，换了事件循环就换一把
+        loop = asyncio.get_running_loop()
+        if self._aqueue is None or self._aqueue[0] is not loop:
+            self._aqueue = (loop, asyncio.Lock())
+        return self._aqueue[1]
 
-        if resp.status_code == 200:
-            _safe_print(f"{tag} API 响应成功，耗时 {elapsed:.1f}s")
-            break
+    async def aacquire(self) -> str:
+        """acquire 的协程版本。
 
-        if resp.status_code in RETRYABLE_STATUS_CODES and attempt < max_retries:
+        同一事件循环上的协程先在进程内的 asyncio.Lock 上按先来后到排队，只有排在最前的一个
+        读改写状态文件（flock + JSON，放到线程里执行），其余协程不轮询文件、不占用事件循环。
+        """
+        async with self._async_queue():
+            ticket = self._new_ticket()
+            pending = None
             try:
-                err_body = resp.json()
-                err_msg = err_body.get("error", {}).get("message", resp.text[:200])
-            except Exception:
-                err_msg = resp.text[:200]
-            last_error = f"HTTP {resp.status_code}: {err_msg}"
-            _safe_print(f"{tag} 收到 {resp.status_code}，将重试", file=sys.stderr)
-            continue
+                while True:
+                    # shield：协程被取消时不丢下线程中进行到一半的读改写
+                    pending = asyncio.ensure_future(asyncio.to_thread(self._try_acquire, ticket))
+                    wait = await asyncio.shield(pending)
+                    if wait <= 0:
+                        return ticket
+                    self._announce()
+                    await asyncio.sleep(wait)
+            except BaseException:
+                # 读改写结束后再撤销 ticket（取消时它可能刚刚取得名额）；只在出错 / 取消时执行一次
+                if pending is not None and not pending.done():
+                    try:
+                        await pending
+                    except BaseException:
+                        pass
+                self._drop(ticket)
+                raise
 
-        # 不可重试
-        try:
-            err_detail = json.dumps(resp.json(), indent=2, ensure_ascii=False)[:500]
-        except Exception:
-            err_detail = resp.text[:500]
-        return {"success": False, "error": f"HTTP {resp.status_code}: {err_detail}"}
-    else:
-        return {"success": False, "error": f"重试 {max_retries} 次仍然失败。最后错误: {last_error}"}
+    def release(self, ticket: str) -> None:
+        self._drop(ticket)
 
-    # 解析响应
-    data = resp.json()
-    try:
-        parts = data["candidates"][0]["content"]["parts"]
-        image_part = next(p for p in parts if "inlineData" in p)
-        b64_data = image_part["inlineData"]["data"]
-        out_mime = image_part["inlineData"].get("mimeType", "image/png")
-    except (KeyError, IndexError, StopIteration):
-        snippet = json.dumps(data, indent=2, ensure_ascii=False)[:500]
-        return {"success": False, "error": f"API 响应中未找到图片数据: {snippet}"}
 
-    image_bytes = base64.b64decode(b64_data)
+_rate_limit_lock = threading.Lock()
+_rate_limit_options = {"rpm": 0, "concurrency": 0, "burst": 1}
+_rate_limiters: dict[str, RateLimiter] = {}
 
-    out = Path(output_path)
-    if not out.suffix:
-        ext = out_mime.split("/")[-1].replace("jpeg", "jpg")
-        out = out.with_suffix(f".{ext}")
 
-    out.parent.mkdir(parents=True, exist_ok=True)
-    out.write_bytes(image_bytes)
+def configure_rate_limit(rpm: float = 0, concurrency: int = 0, burst: int = 1) -> None:
+    """设置跨进程限流参数，rpm 与 concurrency 均为 0 表示不限流。
 
-    size_kb = len(image_bytes) / 1024
-    _safe_print(f"{tag} 编辑完成，大小 {size_kb:.0f}KB -> {out}")
+    不支持 fcntl 的平台（Windows）上给出警告并忽略。
+    """
+    if (rpm or concurrency) and fcntl is None:
+        _safe_print("警告: 当前平台不支持跨进程限流，已忽略 rate_limit_* 配置", file=sys.stderr)
+        rpm = concurrency = 0
+    with _rate_limit_lock:
+        _rate_limit_options.update(rpm=rpm or 0, concurrency=concurrency or 0, burst=burst or 1)
+        _rate_limiters.clear()
 
-    return {
-        "success": True,
-        "path": str(out),
-        "size_kb": round(size_kb, 1),
-        "elapsed": round(elapsed, 1),
-    }
 
+def configure_rate_limit_from_config() -> None:
+    """按 config.json 的 rate_limit_rpm / rate_limit_concurrency / rate_limit_burst 配置限流。"""
+    config = _load_config()
+    configure_rate_limit(
+        rpm=config.get("rate_limit_rpm", 0),
+        concurrency=config.get("rate_limit_concurrency", 0),
+        burst=config.get("rate_limit_burst", 1),
+    )
 
-# ---------------------------------------------------------------------------
-# 单张编辑（CLI 单图模式）
-# ---------------------------------------------------------------------------
 
-def edit(
-    input_image: str,
-    prompt: str,
-    api_key: str,
-    aspect_ratio: str = "1:1",
-    output_path: str = "output.png",
-    max_retries: int = 3,
-) -> str:
-    """单张编辑入口，失败时 sys.exit(1)。"""
-    result = _edit_core(
-        input_image=input_image,
-        prompt=prompt,
-        api_key=api_key,
-        aspect_ratio=aspect_ratio,
-        output_path=output_path,
-        max_retries=max_retries,
-    )
-    if not result["success"]:
-        print(f"错误: {result['error']}", file=sys.stderr)
-        sys.exit(1)
-    return result["path"]
+def _get_rate_limiter(api_key: str) -> RateLimiter | None:
+    """返回该 API Key 的限流器，未配置限流时返回 None。"""
+    with _rate_limit_lock:
+        if not (_rate_limit_options["rpm"] or _rate_limit_options["concurrency"]):
+            return None
+        fingerprint = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+        limiter = _rate_limiters.get(fingerprint)
+        if limiter is None:
+            limiter = RateLimiter(RATE_LIMIT_DIR / f"{fingerprint}.json", **_rate_limit_options)
+            _rate_limiters[fingerprint] = limiter
+        return limiter
 
 
 # ---------------------------------------------------------------------------
-# 并发批量编辑
+# 多 Key / 多端点负载均衡（config.json 的 keys）
 # ---------------------------------------------------------------------------
 
-def edit_batch(
-    tasks: list,
-    api_key: str,
-    workers: int = 0,
-    max_retries: int = 3,
-) -> list:
-    """并发批量编辑多张图片。
+class _PooledKey:
+    """Key 池中的一个 Key 及其端点：进程内的并发 / RPM 名额与健康状态，由 KeyPool 的锁保护。"""
 
-    参数:
-        tasks: 任务列表，每个元素为 dict:
-            {
-                "input": str,            # 必填，输入图片路径
-                "prompt": str,           # 必填，编辑描述
-                "aspect_ratio": str,     # 可选，默认 "1:1"
-                "output": str,           # 必填，输出路径
-            }
-        api_key: ikun API Key
-        workers: 并发数。0 = 自动（默认 2）
-        max_retries: 每个任务的最大重试次数
+    def __init__(self, entry: dict):
+        self.api_key = entry["api_key"].strip()
+        if not self.api_key:
+            raise ValueError("api_key 为空")
+        self.name = str(entry.get("name") or f"{self.api_key[:6]}...{self.api_key[-4:]}")
+        self.base_url = str(entry.get("base_url") or BASE_URL).rstrip("/")
+        self.url = self.base_url + MODEL_PATH
+        self.weight = max(0.01, float(entry.get("weight", 1)))
+        self.concurrency = max(0, int(entry.get("concurrency", 0)))
+        self.rpm = max(0.0, float(entry.get("rpm", 0)))
+        self.burst = max(1, int(entry.get("burst", 1)))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.cooldown_until = 0.0  # 额度用尽 / 连续失败后的冷却截止（time.monotonic()）
+        self.disabled_until = 0.0  # 认证失败后的停用截止
+        self.backoff = KEY_COOLDOWN
+        self.failures = 0          # 连续失败次数
+        self.error_rate = 0.0      # 近期失败率（EWMA）
+        self.requests = self.quota = self.auth = self.errors = 0
 
-    返回:
-        结果列表，每个元素含 "index" 字段。
+    def usable(self, now: float) -> bool:
+        return now >= self.cooldown_until and now >= self.disabled_until
+
+    def refill(self, now: float) -> None:
+        if self.rpm:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rpm / 60)
+        self.updated = now
+
+
+class KeyPool:
+    """多个 API Key / 端点之间的负载均衡，进程级共享，线程与协程都可使用。
+
+    每个请求从可用且有空余名额（concurrency / rpm，按进程计数）的 Key 中选负载最低的一个：
+    在途请求数 / weight，再按近期失败率加权，即优先走最健康、最空闲的 Key；都没有名额时排队等待。
+    - 认证失败（401/403）：停用该 Key KEY_AUTH_COOLDOWN 秒
+    - 额度用尽（429/402）：按 Retry-After 冷却，没有时从 KEY_COOLDOWN 起按次加倍
+    - 连续 KEY_FAILURE_THRESHOLD 次服务端错误 / 连接失败：同样冷却
+    Key 被标记不可用、池中还有其他可用 Key 时 report 返回 True，调用方立即换 Key 重试（不退避）。
+    所有 Key 都因认证失败停用时不再等待，照常发出请求，由上游的错误结束任务。
     """
-    num_tasks = len(tasks)
 
-    if workers <= 0:
-        workers = min(num_tasks, 2)
-    workers = max(1, min(workers, num_tasks))
+    def __init__(self, keys: list):
+        self.keys = keys
+        self._members = {key.api_key for key in keys}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._async_waiters = []  # (事件循环, future)
 
-    print(f"[ikunimage 批量编辑] 共 {num_tasks} 个任务，并发数: {workers}")
+    def routes(self, api_key: str) -> bool:
+        """api_key 属于本池时，其请求由本池分配 Key。"""
+        return api_key in self._members
 
-    t_start = time.time()
-    results = [None] * num_tasks
+    def _pick(self) -> tuple:
+        """在锁内选择 Key 并占用名额：返回 (Key, 0)，或 (None, 建议等待的秒数)。"""
+        now = time.monotonic()
+        best = None
+        best_score = math.inf
+        wait = KEY_POOL_POLL_SECONDS
+        enabled = False
+        for key in self.keys:
+            if now < key.disabled_until:
+                continue
+            enabled = True
+            if now < key.cooldown_until:
+                wait = min(wait, key.cooldown_until - now)
+                continue
+            key.refill(now)
+            if key.concurrency and key.in_flight >= key.concurrency:
+                continue
+            if key.rpm and key.tokens < 1:
+                wait = min(wait, (1 - key.tokens) * 60 / key.rpm)
+                continue
+            score = (key.in_flight + 1) / key.weight * (1 + KEY_ERROR_PENALTY * key.error_rate)
+            if score < best_score:
+                best, best_score = key, score
+        if best is None and not enabled:
+            best = min(self.keys, key=lambda k: k.in_flight / k.weight)
+        if best is None:
+            return None, wait
+        best.in_flight += 1
+        best.requests += 1
+        if best.rpm:
+            best.tokens -= 1
+        return best, 0.0
 
-    def _run_task(index: int, task: dict) -> tuple:
-        result = _edit_core(
-            input_image=task["input"],
-            prompt=task["prompt"],
-            api_key=api_key,
-            aspect_ratio=task.get("aspect_ratio", "1:1"),
-            output_path=task["output"],
-            max_retries=max_retries,
-            task_label=f"#{index + 1}",
-        )
-        result["index"] = index
-        return index, result
+    def _wake(self) -> None:
+        """名额释放或健康状态变化后唤醒排队者（在锁内调用）。"""
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            if not waiter.done():
+                loop.call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
 
-    with ThreadPoolExecutor(max_workers=workers) as pool:
-        futures = {
-            pool.submit(_run_task, i, t): i
-            for i, t in enumerate(tasks)
-        }
-        for future in as_completed(futures):
-            idx, result = future.result()
-            results[idx] = result
-            status = "OK" if result["success"] else "FAIL"
-            _safe_print(f"[ikunimage 批量编辑] 任务 #{idx + 1} {status}")
+    def acquire(self) -> _PooledKey:
+        """阻塞直到分到 Key，请求结束后调用 release。"""
+        with self._cond:
+            while True:
+                key, wait = self._pick()
+                if key is not None:
+                    return key
+                self._cond.wait(wait)
+
+    async def aacquire(self) -> _PooledKey:
+        """acquire 的协程版本。"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                key, wait = self._pick()
+                if key is not None:
+                    return key
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, key: _PooledKey) -> None:
+        with self._lock:
+            key.in_flight -= 1
+            self._wake()
 
-    t_total = time.time() - t_start
-    ok = sum(1 for r in results if r and r["success"])
-    print(f"\n[ikunimage 批量编辑] 全部完成: {ok}/{num_tasks} 成功，总耗时 {t_total:.1f}s")
+    def report(self, key: _PooledKey, status: int | None, retry_after: float | None = None) -> bool:
+        """记录一次请求的结果（status 为 None 表示超时 / 连接失败），返回是否应立即换 Key 重试。"""
+        now = time.monotonic()
+        note = None
+        cooldown = 0.0
+        with self._lock:
+            was_usable = key.usable(now)
+            if status == 200:
+                key.failures = 0
+                key.backoff = KEY_COOLDOWN
+                key.error_rate *= 0.8
+                return False
+            if status in KEY_AUTH_STATUS_CODES:
+                key.auth += 1
+                key.disabled_until = now + KEY_AUTH_COOLDOWN
+                note = f"认证失败（HTTP {status}），停用 {KEY_AUTH_COOLDOWN:.0f}s"
+            elif status in KEY_QUOTA_STATUS_CODES:
+                key.quota += 1
+                cooldown = min(retry_after, RETRY_AFTER_MAX) if retry_after else key.backoff
+                note = f"额度用尽 / 限流（HTTP {status}），冷却 {cooldown:.0f}s"
+            elif status is None or status in RETRYABLE_STATUS_CODES:
+                key.errors += 1
+                key.failures += 1
+                if key.failures >= KEY_FAILURE_THRESHOLD:
+                    cooldown = key.backoff
+                    note = f"连续 {key.failures} 次请求失败，冷却 {cooldown:.0f}s"
+                    key.failures = 0
+            else:
+                return False  # 请求本身有误（400 等），与 Key 无关
+            key.error_rate = 0.8 * key.error_rate + 0.2
+            if cooldown:
+                key.cooldown_until = max(key.cooldown_until, now + cooldown)
+                key.backoff = min(key.backoff * 2, KEY_MAX_COOLDOWN)
+            reroute = note is not None and any(k.usable(now) for k in self.keys if k is not key)
+            self._wake()
+        if note is not None and was_usable:
+            # 标记前已分出去的请求随后再失败时不重复提示
+            _safe_print(f"[ikunimage Key 池] {key.name} {note}", file=sys.stderr)
+        return reroute
 
-    return results
+    def describe(self) -> str:
+        """各 Key 的请求数与失败情况（进程内累计），如 "main 120 次（限流 2）, backup 3 次（认证失败 1，停用中）"。"""
+        now = time.monotonic()
+        parts = []
+        with self._lock:
+            for key in self.keys:
+                notes = [f"{label} {n}" for label, n in (("限流", key.quota), ("认证失败", key.auth),
+                                                        ("错误", key.errors)) if n]
+                if now < key.disabled_until:
+                    notes.append("停用中")
+                elif now < key.cooldown_until:
+                    notes.append("冷却中")
+                parts.append(f"{key.name} {key.requests} 次" + (f"（{'，'.join(notes)}）" if notes else ""))
+        return ", ".join(parts)
+
+
+_key_pool: KeyPool | None = None
+
+
+def configure_key_pool(entries: list | None) -> None:
+    """设置进程级 Key 池，entries 为 config.json 的 keys（每项至少有 api_key），为空时不启用。
+
+    每项可选 name、base_url（默认 BASE_URL）、weight（默认 1），
+    以及本进程内的名额 concurrency / rpm / burst（0 = 不限）。
+    """
+    global _key_pool
+    keys = []
+    for i, entry in enumerate(entries or []):
+        try:
+            keys.append(_PooledKey(entry))
+        except (KeyError, AttributeError, TypeError, ValueError):
+            _safe_print(f"警告: config.json 的 keys 第 {i + 1} 项无效（需要 api_key，数值字段须为数字），已忽略",
+                        file=sys.stderr)
+    _key_pool = KeyPool(keys) if keys else None
+
+
+def configure_key_pool_from_config() -> None:
+    """按 config.json 的 keys 配置 Key 池。"""
+    keys = _load_config().get("keys")
+    configure_key_pool(keys if isinstance(keys, list) else None)
+
+
+def _warmup_urls() -> list:
+    """预热的目标：Key 池中的各个端点（去重），未启用 Key 池时为 BASE_URL。"""
+    if _key_pool is None:
+        return ["/"]
+    return list(dict.fromkeys(key.base_url + "/" for key in _key_pool.keys))
 
 
 # ---------------------------------------------------------------------------
-# CLI
+# 共享 HTTP 连接池（进程级，线程安全）
 # ---------------------------------------------------------------------------
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="ikunimage - NanoBananaPro 图生图 / 图片编辑器（ikun 渠道）",
-        epilog="上传本地图片 + 文字描述，AI 生成编辑后的新图片。",
-    )
+_client_lock = threading.Lock()
+_client: httpx.Client | None = None
+_client_options = {"max_connections": DEFAULT_MAX_CONNECTIONS, "http2": False}
 
-    # 配置子命令
-    parser.add_argument(
-        "--setup", action="store_true",
-        help="交互式引导创建配置文件",
-    )
 
-    # API Key
-    parser.add_argument(
-        "--api-key", default=None,
-        help="API Key（优先级高于环境变量和配置文件）",
+def configure_http_pool(
+    max_connections: int = DEFAULT_MAX_CONNECTIONS,
+    http2: bool = False,
+) -> None:
+    """设置共享连接池参数。已创建的连接池会被关闭，下次请求时按新参数重建。
+
+    http2 需要 h2 库（pip install 'httpx[http2]'），缺失时自动回退到 HTTP/1.1。
+    """
+    if http2 and importlib.util.find_spec("h2") is None:
+        _safe_print("警告: 未安装 h2 库，HTTP/2 不可用，回退到 HTTP/1.1"
+                    "（pip install 'httpx[http2]'）", file=sys.stderr)
+        http2 = False
+    with _client_lock:
+        _client_options["max_connections"] = max(1, max_connections)
+        _client_options["http2"] = http2
+    close_http_pool()
+
+
+def _pool_limits(max_connections: int) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
     )
 
-    # 单图模式参数
-    parser.add_argument(
-        "--input", "-i", default=None,
+
+def _get_client() -> httpx.Client:
+    """返回进程级共享的 httpx.Client，首次调用时创建。"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(
+                    base_url=BASE_URL,
+                    http2=_client_options["http2"],
+                    limits=_pool_limits(_client_options["max_connections"]),
+                )
+    return _client
+
+
+def close_http_pool() -> None:
+    """关闭共享连接池（进程退出时自动调用）。"""
+    global _client
+    with _client_lock:
+        client, _client = _client, None
+    if client is not None:
+        client.close()
+
+
+atexit.register(close_http_pool)
+
+
+def warmup_http_pool(connections: int = 1) -> None:
+    """预先建立连接（DNS + TCP + TLS），让首批请求直接复用。
+
+    HTTP/2 下一条连接即可多路复用，只预热一条（启用 Key 池时每个端点一条）。预热失败不影响后续请求。
+    """
+    client = _get_client()
+    urls = _warmup_urls()
+    if _client_options["http2"]:
+        connections = 1
+    connections = max(len(urls), min(connections, _client_options["max_connections"]))
+
+    def _touch(i):
+        try:
+            client.head(urls[i % len(urls)], timeout=10)
+        except httpx.HTTPError:
+            pass
+
+    if connections == 1:
+        _touch(0)
+        return
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        list(pool.map(_touch, range(connections)))
+
+
+def _trace_recorder(events: list) -> Callable:
+    """httpcore 的 trace 回调，按发生顺序记录 (事件名, perf_counter)。"""
+    def _trace(name: str, info: dict) -> None:
+        events.append((name, time.perf_counter()))
+    return _trace
+
+
+def _atrace_recorder(events: list) -> Callable:
+    """_trace_recorder 的异步版本（AsyncClient 要求 trace 回调是协程函数）。"""
+    async def _trace(name: str, info: dict) -> None:
+        events.append((name, time.perf_counter()))
+    return _trace
+
+
+def _trace_phases(events: list, started: float, phases: dict) -> None:
+    """把 trace 事件折算为 connect / upload / ttfb，等待连接池空闲的时间计入 queue。
+
+    复用已有连接时没有建连事件，connect 为 0。
+    """
+    marks = {}
+    connect = 0.0
+    opened = None
+    for name, t in events:
+        step, _, state = name.rpartition(".")
+        step = step.rpartition(".")[2]
+        if step in ("connect_tcp", "connect_unix", "start_tls", "send_connection_init"):
+            if state == "started":
+                opened = t
+            elif opened is not None:
+                connect += t - opened
+                opened = None
+        else:
+            marks[f"{step}.{state}"] = t
+    send = marks.get("send_request_headers.started")
+    head = marks.get("receive_response_headers.complete")
+    if send is None or head is None:
+        return
+    body = marks.get("send_request_body.complete", send)
+    phases["connect"] = connect
+    phases["upload"] = body - send
+    phases["ttfb"] = head - body
+    phases["queue"] = phases.get("queue", 0.0) + max(0.0, send - started - connect)
+
+
+def _request_timeout(timeout: float) -> httpx.Timeout:
+    """单次请求的 httpx 超时：建连最多 CONNECT_TIMEOUT 秒，每次读写最多 timeout 秒，等待空闲连接不计入超时。"""
+    return httpx.Timeout(connect=min(CONNECT_TIMEOUT, timeout), read=timeout, write=timeout, pool=None)
+
+
+def _mark_deadlines(resp: httpx.Response, started: float, timeout: float) -> None:
+    """响应头已到：在响应上记下总超时的截止时刻（started 为发出请求的 time.perf_counter()）
+    和数据块之间的空闲超时，由 _stream_image_to_file 在读取响应体时检查。"""
+    resp.extensions["ikunimage_expires"] = started + timeout
+    resp.extensions["ikunimage_idle"] = min(READ_IDLE_TIMEOUT, timeout)
+
+
+@contextmanager
+def _request_once(payload: dict, timeout: float, api_key: str, phases: dict | None = None):
+    """通过共享连接池发送单次 API 请求，返回流式响应的上下文管理器。
+
+    用法: with _request_once(...) as resp: ...，响应体需在 with 块内读取。
+    配置了跨进程限流时先排队取得名额，响应读完后归还；api_key 属于 Key 池时由 Key 池选择 Key 和端点。
+    phases 不为空时记录排队、建连、上传、首字节耗时，以及响应读完后的收发字节数。
+    timeout 是总超时：建连最多 CONNECT_TIMEOUT 秒，等待响应头最多 timeout 秒（见 _request_timeout），
+    之后读取响应体的总时长和数据块间隔（READ_IDLE_TIMEOUT）由 _stream_image_to_file 检查。
+    """
+    t_wait = time.perf_counter()
+    pooled = _key_pool.acquire() if _key_pool is not None and _key_pool.routes(api_key) else None
+    if pooled is not None:
+        api_key = pooled.api_key
+    limiter = _get_rate_limiter(api_key)
+    ticket = None
+    events = []
+    reported = False
+    try:
+        ticket = limiter.acquire() if limiter is not None else None
+        started = time.perf_counter()
+        with _get_client().stream(
+            "POST",
+            MODEL_PATH if pooled is None else pooled.url,
+            json=payload,
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            },
+            # 等待空闲连接不计入超时，并发上限由 worker 数控制
+            timeout=_request_timeout(timeout),
+            extensions={"trace": _trace_recorder(events)} if phases is not None else None,
+        ) as resp:
+            _mark_deadlines(resp, started, timeout)
+            if pooled is not None and resp.status_code != 200:
+                # 非 200 在响应头到达时结果已定；这个 Key 被标记为不可用时，由调用方立即换 Key 重试
+                resp.extensions["ikunimage_reroute"] = _key_pool.report(
+                    pooled, resp.status_code, _retry_after_seconds(resp))
+                reported = True
+            if phases is not None:
+                phases["queue"] = started - t_wait
+                _trace_phases(events, started, phases)
+            yield resp
+            if pooled is not None and not reported:
+                # 200 的响应体读完才记为这个 Key 的一次成功，中途断开则只按失败记录一次
+                _key_pool.report(pooled, 200)
+                reported = True
+            if phases is not None:
+                phases["bytes_in"] = resp.num_bytes_downloaded
+                phases["bytes_out"] = int(resp.request.headers.get("Content-Length", 0))
+    except httpx.TransportError:
+        if pooled is not None and not reported:
+            _key_pool.report(pooled, None)
+        raise
+    finally:
+        if ticket is not None:
+            limiter.release(ticket)
+        if pooled is not None:
+            _key_pool.release(pooled)
+
+
+# ---------------------------------------------------------------------------
+# 异步连接池（async 引擎，仅在事件循环线程内使用）
+# ---------------------------------------------------------------------------
+
+# httpcore 的异步连接池每次分配请求都会扫描全部连接，连接数上百时开销近似平方增长；
+# 因此 HTTP/1.1 下把连接池拆成若干小分片轮询使用（HTTP/2 单连接多路复用，无需分片）
+ASYNC_POOL_SHARD_SIZE = 32
+
+_async_clients: list[httpx.AsyncClient] = []
+_async_rr = itertools.count()
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    """轮询返回 async 引擎的连接池分片，总连接数与同步连接池一致。"""
+    if not _async_clients:
+        max_conn = _client_options["max_connections"]
+        http2 = _client_options["http2"]
+        shards = 1 if http2 else math.ceil(max_conn / ASYNC_POOL_SHARD_SIZE)
+        per_shard = math.ceil(max_conn / shards)
+        _async_clients.extend(
+            httpx.AsyncClient(
+                base_url=BASE_URL,
+                http2=http2,
+                limits=_pool_limits(per_shard),
+            )
+            for _ in range(shards)
+        )
+    return _async_clients[next(_async_rr) % len(_async_clients)]
+
+
+async def aclose_http_pool() -> None:
+    """关闭 async 连接池。AsyncClient 绑定事件循环，需在同一循环结束前关闭。"""
+    clients = list(_async_clients)
+    _async_clients.clear()
+    for client in clients:
+        await client.aclose()
+
+
+async def awarmup_http_pool(connections: int = 1) -> None:
+    """warmup_http_pool 的异步版本。"""
+    urls = _warmup_urls()
+    if _client_options["http2"]:
+        connections = 1
+    connections = max(len(urls), min(connections, _client_options["max_connections"]))
+
+    async def _touch(i):
+        try:
+            await _get_async_client().head(urls[i % len(urls)], timeout=10)
+        except httpx.HTTPError:
+            pass
+
+    await asyncio.gather(*(_touch(i) for i in range(connections)))
+
+
+@asynccontextmanager
+async def _arequest_once(payload: dict, timeout: float, api_key: str, phases: dict | None = None):
+    """_request_once 的异步版本，返回 async with 使用的流式响应上下文管理器。"""
+    t_wait = time.perf_counter()
+    pooled = await _key_pool.aacquire() if _key_pool is not None and _key_pool.routes(api_key) else None
+    if pooled is not None:
+        api_key = pooled.api_key
+    limiter = _get_rate_limiter(api_key)
+    ticket = None
+    events = []
+    reported = False
+    try:
+        ticket = await limiter.aacquire() if limiter is not None else None
+        started = time.perf_counter()
+        async with _get_async_client().stream(
+            "POST",
+            MODEL_PATH if pooled is None else pooled.url,
+            json=payload,
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            },
+            timeout=_request_timeout(timeout),
+            extensions={"trace": _atrace_recorder(events)} if phases is not None else None,
+        ) as resp:
+            _mark_deadlines(resp, started, timeout)
+            if pooled is not None and resp.status_code != 200:
+                # 非 200 在响应头到达时结果已定；这个 Key 被标记为不可用时，由调用方立即换 Key 重试
+                resp.extensions["ikunimage_reroute"] = _key_pool.report(
+                    pooled, resp.status_code, _retry_after_seconds(resp))
+                reported = True
+            if phases is not None:
+                phases["queue"] = started - t_wait
+                _trace_phases(events, started, phases)
+            yield resp
+            if pooled is not None and not reported:
+                # 200 的响应体读完才记为这个 Key 的一次成功，中途断开则只按失败记录一次
+                _key_pool.report(pooled, 200)
+                reported = True
+            if phases is not None:
+                phases["bytes_in"] = resp.num_bytes_downloaded
+                phases["bytes_out"] = int(resp.request.headers.get("Content-Length", 0))
+    except httpx.TransportError:
+        if pooled is not None and not reported:
+            _key_pool.report(pooled, None)
+        raise
+    finally:
+        if ticket is not None:
+            limiter.release(ticket)
+        if pooled is not None:
+            _key_pool.release(pooled)
+
+
+# ---------------------------------------------------------------------------
+# 输出写入（批量后台写盘、原子重命名、fsync 批量提交、输出路径冲突检测）
+# ---------------------------------------------------------------------------
+
+# 当前批量的后台写入器，None 时由网络 worker 直接写盘；批量 worker、对冲请求等线程都继承它
+_output_writer: contextvars.ContextVar = contextvars.ContextVar("ikunimage_output_writer", default=None)
+
+
+class _PendingFile:
+    """交给 OutputWriter 写出的临时文件，write 只是入队，由固定的写线程按顺序执行。"""
+
+    def __init__(self, writer: "OutputWriter", tmp_path: Path, shard: int):
+        self.writer = writer
+        self.tmp_path = tmp_path
+        self.shard = shard
+        self.file = None   # 写线程首次写入时打开
+        self.error = None  # 写线程中的第一个错误，之后的写入直接跳过
+
+    def write(self, data: bytes) -> None:
+        self.writer._submit(self, ("write", self, data), len(data))
+
+    def close(self) -> None:
+        # 在 commit / discard 时由写线程关闭
+        pass
+
+
+class OutputWriter:
+    """批量输出的后台写入器（write-behind）：网络 worker 解码出的数据入队后立即返回，继续接收下一个请求。
+
+    每张图先写入同目录的临时文件，写完后原子重命名到目标路径，崩溃或并发读取都不会看到写了一半的文件。
+    待写数据按字节数有界（OUTPUT_WRITE_BUFFER_MB），写盘跟不上时入队阻塞（背压）；同一个文件的操作固定由同一个
+    写线程按顺序执行。fsync 为 "off" 时不 fsync；"always" 时每个文件重命名前 fsync 文件、重命名后 fsync 目录；
+    "batch" 时攒够 OUTPUT_FSYNC_BATCH 个文件或等待 OUTPUT_FSYNC_INTERVAL 秒后一起提交，每个目录只 fsync 一次。
+    when_written 注册的回调在文件落盘后执行，进度日志、结果缓存都据此推迟到文件真正就位之后。
+    线程安全。
+    """
+
+    def __init__(self, fsync: str = "off", threads: int = OUTPUT_WRITER_THREADS):
+        self.fsync = fsync
+        self._max_bytes = int(OUTPUT_WRITE_BUFFER_MB * 1024 * 1024)
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._waiters = {}  # 已提交、尚未落盘的目标路径 -> 等待它的回调
+        self._errors = {}   # 目标路径 -> 写出失败的原因
+        self._shards = itertools.count()
+        self._queues = [queue.SimpleQueue() for _ in range(threads)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,), name=f"ikunimage-writer-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def open(self, tmp_path: Path) -> _PendingFile:
+        return _PendingFile(self, tmp_path, next(self._shards) % len(self._queues))
+
+    def commit(self, handle: _PendingFile, path: Path) -> None:
+        """写完后把临时文件重命名为 path；在 when_written 之前调用。"""
+        with self._cond:
+            self._waiters[str(path)] = []
+        self._submit(handle, ("commit", handle, path), 0)
+
+    def discard(self, handle: _PendingFile) -> None:
+        """放弃临时文件（请求失败、对冲的另一方先完成）。"""
+        self._submit(handle, ("discard", handle), 0)
+
+    def when_written(self, paths: list, callback: Callable[[str | None], None]) -> None:
+        """paths 全部落盘（或写出失败）后以提交时的上下文调用 callback(错误信息或 None)。
+
+        没有经过本写入器的路径（如命中结果缓存时直接链接的文件）视为已就位，已全部就位时立即在当前线程调用。
+        """
+        ctx = contextvars.copy_context()
+        with self._cond:
+            pending = {str(p) for p in paths if str(p) in self._waiters}
+            error = next((self._errors[str(p)] for p in paths if str(p) in self._errors), None)
+            if pending:
+                waiter = [pending, error, callback, ctx]
+                for p in pending:
+                    self._waiters[p].append(waiter)
+                return
+        ctx.run(callback, error)
+
+    def close(self) -> None:
+        """写完并提交所有已入队的文件（含回调）后停止写线程。"""
+        for q in self._queues:
+            q.put(("stop",))
+        for t in self._threads:
+            t.join()
+
+    def _submit(self, handle: _PendingFile, op: tuple, size: int) -> None:
+        if size:
+            with self._cond:
+                while self._queued and self._queued + size > self._max_bytes:
+                    self._cond.wait()
+                self._queued += size
+        self._queues[handle.shard].put(op)
+
+    def _run(self, q: queue.SimpleQueue) -> None:
+        ready = []  # fsync=batch 时已写完、等待一起提交的 (handle, 目标路径)
+        flush_at = math.inf
+        while True:
+            try:
+                op = q.get(timeout=max(0.0, flush_at - time.monotonic()) if ready else None)
+            except queue.Empty:
+                op = ("flush",)
+            kind = op[0]
+            if kind == "write":
+                self._write(op[1], op[2])
+                with self._cond:
+                    self._queued -= len(op[2])
+                    self._cond.notify_all()
+            elif kind == "commit":
+                if self.fsync != "batch":
+                    self._commit([op[1:]])
+                    continue
+                if not ready:
+                    flush_at = time.monotonic() + OUTPUT_FSYNC_INTERVAL
+                ready.append(op[1:])
+                if len(ready) >= OUTPUT_FSYNC_BATCH:
+                    self._commit(ready)
+                    ready = []
+            elif kind == "discard":
+                self._cleanup(op[1])
+            else:  # flush / stop
+                if ready:
+                    self._commit(ready)
+                    ready = []
+                if kind == "stop":
+                    return
+
+    def _write(self, handle: _PendingFile, data: bytes) -> None:
+        if handle.error is not None:
+            return
+        try:
+            if handle.file is None:
+                # 不用 mkstemp：它固定创建 0600 文件，这里需要和普通写文件一样遵循 umask
+                handle.tmp_path.parent.mkdir(parents=True, exist_ok=True)
+                handle.file = open(handle.tmp_path, "xb")
+            handle.file.write(data)
+        except OSError as e:
+            handle.error = str(e)
+            self._cleanup(handle)
+
+    def _cleanup(self, handle: _PendingFile) -> None:
+        try:
+            if handle.file is not None:
+                handle.file.close()
+                handle.file = None
+            handle.tmp_path.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+    def _commit(self, items: list) -> None:
+        dirs = set()
+        for handle, path in items:
+            if handle.error is not None:
+                continue
+            if handle.file is None:  # 空图片也要生成文件
+                self._write(handle, b"")
+                if handle.error is not None:
+                    continue
+            try:
+                handle.file.flush()
+                if self.fsync != "off":
+                    os.fsync(handle.file.fileno())
+                handle.file.close()
+                handle.file = None
+                os.replace(handle.tmp_path, path)
+                dirs.add(path.parent)
+            except OSError as e:
+                handle.error = str(e)
+                self._cleanup(handle)
+        if self.fsync != "off":
+            for d in dirs:
+                _fsync_dir(d)
+        for handle, path in items:
+            self._done(str(path), handle.error)
+
+    def _done(self, path: str, error: str | None) -> None:
+        ready = []
+        with self._cond:
+            if error is not None:
+                self._errors[path] = error
+            for waiter in self._waiters.pop(path, []):
+                waiter[0].discard(path)
+                waiter[1] = waiter[1] or error
+                if not waiter[0]:
+                    ready.append(waiter)
+        for _, err, callback, ctx in ready:
+            ctx.run(callback, err)
+
+
+def _fsync_dir(path: Path) -> None:
+    """fsync 目录，让其中的重命名落盘（不支持的平台 / 文件系统上忽略）。"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _after_write(paths: list, fn: Callable, *args) -> None:
+    """输出文件落盘后调用 fn(*args)；后台写入时在写线程中执行，写出失败则不调用。"""
+    writer = _output_writer.get()
+    if writer is None:
+        fn(*args)
+        return
+    writer.when_written(paths, lambda error: fn(*args) if error is None else None)
+
+
+class OutputClaims:
+    """同一批量中各任务的输出路径登记：两个任务会写同一个文件时让后提交的任务失败，不互相覆盖。线程安全。"""
+
+    def __init__(self, postprocess: "OutputPostprocess | None" = None):
+        self.postprocess = postprocess
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def claim(self, task: dict, index: int, count: int) -> str | None:
+        """登记任务（含多张输出、后处理转换后）的全部输出路径，与已登记的任务冲突时返回错误信息。"""
+        paths = []
+        for i in range(count):
+            path = Path(os.path.abspath(_job_path(_indexed_path(task["output"], i))))
+            paths.append(path)
+            if self.postprocess is not None and self.postprocess.format:
+                paths.append(path.with_suffix("." + self.postprocess.format.replace("jpeg", "jpg")))
+        with self._lock:
+            for path in paths:
+                owner = self._owners.get(path)
+                if owner is not None and owner != index:
+                    return f"输出路径与任务 #{owner + 1} 重复: {path}"
+            for path in paths:
+                self._owners[path] = index
+        return None
+
+
+# ---------------------------------------------------------------------------
+# 响应处理（同步 / 异步引擎共用）
+# ---------------------------------------------------------------------------
+
+def _retry_error_message(resp: httpx.Response) -> str:
+    """提取可重试错误的简短描述。"""
+    try:
+        err_body = resp.json()
+        err_msg = err_body.get("error", {}).get("message", resp.text[:200])
+    except Exception:
+        err_msg = resp.text[:200]
+    return f"HTTP {resp.status_code}: {err_msg}"
+
+
+def _fatal_error_result(resp: httpx.Response) -> dict:
+    """不可重试错误的结果字典。"""
+    try:
+        err_detail = json.dumps(resp.json(), indent=2, ensure_ascii=False)[:500]
+    except Exception:
+        err_detail = resp.text[:500]
+    return {"success": False, "error": f"HTTP {resp.status_code}: {err_detail}"}
+
+
+class _InlineImageDecoder:
+    """增量解析 generateContent 响应体，把其中每个 inlineData.data 边接收边解码写入文件。
+
+    只缓存图片数据以外的少量 JSON 文本，单任务内存占用与分辨率无关。
+    每张图先写入输出目录下的临时文件，结束后再按 mimeType 确定扩展名并重命名：
+    第 1 张写到 output_path，多候选 / 多个图片 part 时其余依次为 <文件名>_2、<文件名>_3 ...
+    当前上下文有批量写入器（_output_writer）时写盘和重命名都交给它在后台完成。
+    写入的同时计算每张图的 sha256，结果中以 {"sha256": {路径: 摘要}} 给出，进度日志不必再读一遍文件。
+    """
+
+    _INLINE_RE = re.compile(rb'"inlineData"\s*:\s*\{')
+    _DATA_RE = re.compile(rb'"data"\s*:\s*"')
+    _MIME_RE = re.compile(rb'"mimeType"\s*:\s*"([^"]*)"')
+    _HEAD_LIMIT = 64 * 1024
+
+    def __init__(self, output_path: str):
+        self.output_path = Path(output_path)
+        self._state = "seek"  # seek -> data -> (tail ->) seek，直到响应结束
+        self._buf = b""       # 图片数据以外、尚未处理完的 JSON 文本
+        self._head = b""      # 响应开头，找不到图片时用于错误信息
+        self._pending = b""   # 不足 4 字节、暂不能解码的 base64 字符
+        self._escape = False  # 上一块以未配对的反斜杠结尾
+        self._mime = None
+        self._file = None
+        self._tmp_path = None
+        self._images = []     # 已接收完的图片：[临时文件, mimeType, 文件对象, sha256]
+        self._hash = None     # 当前图片已写入数据的 sha256
+        self._writer = _output_writer.get()
+        self.size = 0
+        self.decode_time = 0.0  # base64 解码累计耗时
+        self.write_time = 0.0   # 写盘（含关闭、重命名）累计耗时
+
+    def feed(self, chunk: bytes) -> None:
+        if len(self._head) < self._HEAD_LIMIT:
+            self._head += chunk[:self._HEAD_LIMIT - len(self._head)]
+        while chunk:
+            if self._state == "data":
+                chunk = self._feed_data(chunk)
+                continue
+            self._buf += chunk
+            chunk = self._seek() if self._state == "seek" else self._seek_tail_mime()
+
+    def _seek(self) -> bytes:
+        m = self._INLINE_RE.search(self._buf)
+        if not m:
+            # 保留末尾一小段，防止关键字被切在两个块之间
+            self._buf = self._buf[-64:]
+            return b""
+        obj = self._buf[m.end():]
+        d = self._DATA_RE.search(obj)
+        if not d:
+            self._buf = self._buf[m.start():]
+            return b""
+        mm = self._MIME_RE.search(obj, 0, d.start())
+        self._mime = mm.group(1).decode() if mm else None
+        self._buf = b""
+        self._open()
+        self._state = "data"
+        return obj[d.end():]
+
+    def _seek_tail_mime(self) -> bytes:
+        # mimeType 可能出现在 data 之后，只在同一个 inlineData 对象内查找
+        close = self._buf.find(b"}")
+        mm = self._MIME_RE.search(self._buf)
+        if mm and (close == -1 or mm.start() < close):
+            self._images[-1][1] = mm.group(1).decode()
+            rest = self._buf[mm.end():]
+        elif close != -1:
+            rest = self._buf[close + 1:]
+        else:
+            return b""
+        self._buf = b""
+        self._state = "seek"
+        return rest
+
+    def _feed_data(self, chunk: bytes) -> bytes:
+        end = chunk.find(b'"')
+        data, rest = (chunk, None) if end == -1 else (chunk[:end], chunk[end + 1:])
+        if self._escape or b"\\" in data:
+            data = self._unescape(data)
+        data = self._pending + data
+        n = len(data) - len(data) % 4
+        if n:
+            self._write(self._decode(data[:n]))
+        self._pending = data[n:]
+        if rest is None:
+            return b""
+        if self._pending:
+            self._write(self._decode(self._pending + b"=" * (-len(self._pending) % 4)))
+            self._pending = b""
+        self._close()
+        self._state = "seek" if self._mime else "tail"
+        return rest
+
+    def _unescape(self, data: bytes) -> bytes:
+        # base64 字符串里只可能出现 \/ 和换行转义
+        if self._escape:
+            data = b"\\" + data
+            self._escape = False
+        if (len(data) - len(data.rstrip(b"\\"))) % 2:
+            data = data[:-1]
+            self._escape = True
+        return data.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+
+    def _open(self) -> None:
+        tmp = self.output_path.with_name(f".{self.output_path.name}.{uuid.uuid4().hex[:8]}.part")
+        if self._writer is not None:
+            self._file = self._writer.open(tmp)
+        else:
+            # 不用 mkstemp：它固定创建 0600 文件，这里需要和普通写文件一样遵循 umask
+            self.output_path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(tmp, "xb")
+        self._tmp_path = tmp
+        self._hash = hashlib.sha256()
+
+    def _close(self) -> None:
+        t = time.perf_counter()
+        self._file.close()
+        self._images.append([self._tmp_path, self._mime, self._file, self._hash.hexdigest()])
+        self._file = None
+        self._tmp_path = None
+        self.write_time += time.perf_counter() - t
+
+    def _decode(self, data: bytes) -> bytes:
+        t = time.perf_counter()
+        raw = base64.b64decode(data)
+        self.decode_time += time.perf_counter() - t
+        return raw
+
+    def _write(self, data: bytes) -> None:
+        t = time.perf_counter()
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+        self.write_time += time.perf_counter() - t
+
+    def finish(self, claim: Callable[[], bool] | None = None) -> dict:
+        """响应读取完毕后调用，返回不含 elapsed 的结果字典（多张图时另带 paths）。
+
+        claim 返回 False 时（对冲请求中另一方已写出结果）丢弃本次数据，不覆盖输出文件。
+        """
+        if self._state == "data":
+            return {"success": False, "error": "API 响应中的图片数据不完整"}
+        if not self._images:
+            try:
+                snippet = json.dumps(json.loads(self._head), indent=2, ensure_ascii=False)[:500]
+            except ValueError:
+                snippet = self._head[:500].decode("utf-8", errors="replace")
+            return {"success": False, "error": f"API 响应中未找到图片数据: {snippet}"}
+
+        if claim is not None and not claim():
+            return {"success": False, "error": "对冲请求中另一方已先完成，结果已丢弃"}
+        t = time.perf_counter()
+        paths = []
+        digests = {}
+        for i, image in enumerate(self._images):
+            out = _indexed_path(self.output_path, i)
+            if not _has_image_suffix(out):
+                ext = (image[1] or "image/png").split("/")[-1].replace("jpeg", "jpg")
+                out = out.with_name(f"{out.name}.{ext}")
+            if self._writer is not None:
+                self._writer.commit(image[2], out)
+            else:
+                os.replace(image[0], out)
+            image[0] = None
+            paths.append(str(out))
+            digests[str(out)] = image[3]
+        self.write_time += time.perf_counter() - t
+
+        result = {"success": True, "path": paths[0], "size_kb": round(self.size / 1024, 1)}
+        if len(paths) > 1:
+            result["paths"] = paths
+        result["sha256"] = digests
+        return result
+
+    def abort(self) -> None:
+        """清理未完成的临时文件，finish 成功后调用为空操作。"""
+        if self._file is not None:
+            self._file.close()
+            self._images.append([self._tmp_path, self._mime, self._file, None])
+            self._file = None
+        for tmp, _, file, _ in self._images:
+            if tmp is None:
+                continue
+            if self._writer is not None:
+                self._writer.discard(file)
+            else:
+                tmp.unlink(missing_ok=True)
+        self._tmp_path = None
+        self._images = []
+
+
+def _stream_image_to_file(
+    resp: httpx.Response,
+    output_path: str,
+    claim: Callable[[], bool] | None = None,
+    phases: dict | None = None,
+    decided: threading.Event | None = None,
+) -> dict:
+    """边下载边解码，把 200 响应中的图片写入 output_path。
+
+    phases 不为空时记录 download（等待网络数据）、parse（扫描 JSON）、decode、write 耗时。
+    decided 被置位时（对冲请求中另一方已胜出）不再接收，丢弃已收到的数据，由调用方关闭响应。
+    超过请求的总超时，或两个数据块之间的间隔超过空闲超时（见 _mark_deadlines）时抛出 httpx.ReadTimeout；
+    连接完全卡住时由请求本身的读超时兜底（同步读取无法从外部中断）。
+    """
+    decoder = _InlineImageDecoder(output_path)
+    expires = resp.extensions.get("ikunimage_expires", math.inf)
+    idle = resp.extensions.get("ikunimage_idle", math.inf)
+    feeding = 0.0
+    t = waiting = time.perf_counter()
+    try:
+        for chunk in resp.iter_bytes():
+            f = time.perf_counter()
+            if f > expires:
+                raise httpx.ReadTimeout("超过总超时", request=resp.request)
+            if f - waiting > idle:
+                raise httpx.ReadTimeout(f"响应数据中断超过 {idle:.0f}s", request=resp.request)
+            if decided is not None and decided.is_set():
+                return {"success": False, "error": "对冲请求中另一方已先完成，结果已丢弃"}
+            decoder.feed(chunk)
+            waiting = time.perf_counter()
+            feeding += waiting - f
+        received = time.perf_counter() - t
+        parse = feeding - decoder.decode_time - decoder.write_time
+        result = decoder.finish(claim)
+        if phases is not None:
+            phases.update(download=received - feeding, parse=parse,
+                          decode=decoder.decode_time, write=decoder.write_time)
+        return result
+    finally:
+        decoder.abort()
+
+
+async def _astream_image_to_file(
+    resp: httpx.Response,
+    output_path: str,
+    claim: Callable[[], bool] | None = None,
+    phases: dict | None = None,
+) -> dict:
+    """_stream_image_to_file 的异步版本。
+
+    每个数据块最多等待空闲超时（且不超过总超时），连接卡住时不必等满请求的读超时。
+    """
+    decoder = _InlineImageDecoder(output_path)
+    expires = resp.extensions.get("ikunimage_expires", math.inf)
+    idle = resp.extensions.get("ikunimage_idle", math.inf)
+    feeding = 0.0
+    t = time.perf_counter()
+    chunks = resp.aiter_bytes()
+    try:
+        while True:
+            waiting = time.perf_counter()
+            try:
+                chunk = await asyncio.wait_for(anext(chunks), max(0.0, min(idle, expires - waiting)))
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                if time.perf_counter() >= expires:
+                    raise httpx.ReadTimeout("超过总超时", request=resp.request) from None
+                raise httpx.ReadTimeout(f"响应数据中断超过 {idle:.0f}s", request=resp.request) from None
+            f = time.perf_counter()
+            decoder.feed(chunk)
+            feeding += time.perf_counter() - f
+        received = time.perf_counter() - t
+        parse = feeding - decoder.decode_time - decoder.write_time
+        result = decoder.finish(claim)
+        if phases is not None:
+            phases.update(download=received - feeding, parse=parse,
+                          decode=decoder.decode_time, write=decoder.write_time)
+        return result
+    finally:
+        decoder.abort()
+
+
+def _fetch_image(
+    payload: dict,
+    timeout: float,
+    api_key: str,
+    output_path: str,
+    tag: str,
+    t0: float,
+    claim: Callable[[], bool] | None = None,
+    decided: threading.Event | None = None,
+    phases: dict | None = None,
+) -> tuple:
+    """发送一次请求，200 时把图片写入 output_path。
+
+    返回 (resp, result)，非 200 时 result 为 None；超时 / 连接失败等异常原样抛出。
+    claim、decided 供请求对冲使用（见 _stream_image_to_file）；phases 不为空时填入本次请求的分阶段耗时和收发字节数。
+    响应总是在本线程中关闭（httpx 的响应不是线程安全的）。
+    """
+    with _request_once(payload, timeout, api_key, phases) as resp:
+        if resp.status_code != 200:
+            resp.read()
+            return resp, None
+        _safe_print(f"{tag} API 响应成功，耗时 {time.time() - t0:.1f}s，接收图片中...")
+        return resp, _stream_image_to_file(resp, output_path, claim, phases, decided)
+
+
+async def _afetch_image(
+    payload: dict,
+    timeout: float,
+    api_key: str,
+    output_path: str,
+    tag: str,
+    t0: float,
+    claim: Callable[[], bool] | None = None,
+    phases: dict | None = None,
+) -> tuple:
+    """_fetch_image 的异步版本（取消协程即可中止请求）。"""
+    async with _arequest_once(payload, timeout, api_key, phases) as resp:
+        if resp.status_code != 200:
+            await resp.aread()
+            return resp, None
+        _safe_print(f"{tag} API 响应成功，耗时 {time.time() - t0:.1f}s，接收图片中...")
+        return resp, await _astream_image_to_file(resp, output_path, claim, phases)
+
+
+# ---------------------------------------------------------------------------
+# 结果缓存（按请求内容寻址，同内容请求不再重复计费）
+# ---------------------------------------------------------------------------
+
+def cache_key(payload: dict) -> str:
+    """MODEL_PATH + 规范化 payload 的 sha256，作为结果缓存的键。"""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(f"{MODEL_PATH}\n{canonical}".encode("utf-8")).hexdigest()
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    """优先硬链接，跨文件系统等情况下退回复制；先写临时名再原子替换 dst。"""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f".{dst.name}.{uuid.uuid4().hex[:8]}.part")
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ResultCache:
+    """已生成图片的磁盘缓存，按最近使用时间（文件 mtime）做 LRU 淘汰。
+
+    条目路径为 <root>/<key 前两位>/<key><扩展名>，命中时刷新 mtime。
+    read=False（--refresh）时只写不读，用新结果覆盖旧条目。
+    缓存读写失败只会退化为正常请求，不影响任务本身。
+    """
+
+    def __init__(
+        self,
+        root: Path = CACHE_DIR,
+        max_mb: float = DEFAULT_CACHE_MAX_MB,
+        max_age_days: float = DEFAULT_CACHE_MAX_AGE_DAYS,
+        read: bool = True,
+    ):
+        self.root = Path(root)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age = max_age_days * 86400
+        self.read = read
+
+    def _entries(self, key: str) -> list:
+        return list((self.root / key[:2]).glob(f"{key}.*"))
+
+    def get(self, key: str, output_path: str) -> dict | None:
+        """命中时把缓存图片写到 output_path，返回结果字典；未命中返回 None。"""
+        if not self.read:
+            return None
+        entries = self._entries(key)
+        if not entries:
+            return None
+        entry = entries[0]
+        out = Path(output_path)
+        if not _has_image_suffix(out):
+            out = out.with_name(out.name + entry.suffix)
+        try:
+            os.utime(entry)
+            _link_or_copy(entry, out)
+        except OSError:
+            return None
+        return {
+            "success": True,
+            "path": str(out),
+            "size_kb": round(out.stat().st_size / 1024, 1),
+            "elapsed": 0.0,
+            "cached": True,
+        }
+
+    def put(self, key: str, path: str) -> None:
+        """把刚生成的图片存入缓存。"""
+        src = Path(path)
+        dst = self.root / key[:2] / f"{key}{src.suffix or '.png'}"
+        try:
+            for old in self._entries(key):
+                if old != dst:
+                    old.unlink(missing_ok=True)
+            _link_or_copy(src, dst)
+        except OSError:
+            pass
+
+    def evict(self) -> int:
+        """删除超龄条目，再按最近使用时间淘汰到容量上限以内，返回删除数。"""
+        if not self.root.is_dir():
+            return 0
+        entries = []
+        for shard in self.root.iterdir():
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+        entries.sort()
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+def open_cache(enabled: bool | None = None, refresh: bool = False) -> ResultCache | None:
+    """按 CLI 开关和 config.json 创建结果缓存，未启用返回 None。
+
+    enabled 为 None 时取 config.json 的 "cache"（默认关闭）；refresh 隐含启用。
+    """
+    config = _load_config()
+    if enabled is None:
+        enabled = bool(config.get("cache", False))
+    if not (enabled or refresh):
+        return None
+    return ResultCache(
+        root=Path(config.get("cache_dir", CACHE_DIR)).expanduser(),
+        max_mb=config.get("cache_max_mb", DEFAULT_CACHE_MAX_MB),
+        max_age_days=config.get("cache_max_age_days", DEFAULT_CACHE_MAX_AGE_DAYS),
+        read=not refresh,
+    )
+
+
+# ---------------------------------------------------------------------------
+# 重试策略（退避抖动、Retry-After、批量重试预算、熔断）
+# ---------------------------------------------------------------------------
+
+def _retry_after_seconds(resp: httpx.Response) -> float | None:
+    """解析 Retry-After 响应头（秒数或 HTTP 日期），缺失或无法解析时返回 None。"""
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class RetryPolicy:
+    """请求失败后的重试策略，批量任务共用一个实例。
+
+    - 退避：decorrelated jitter（在 [base, 上次等待×3] 间随机取值），
+      避免故障恢复后所有任务同时重试；服务端给出 Retry-After 时至少等待该时长
+    - 重试预算：budget 为整个批次允许的重试总次数（可用 extend_budget 追加），
+      用完后失败的任务不再重试
+    - 熔断（breaker=True）：最近请求的失败率过高时暂停所有请求 cooldown 秒，
+      之后只放行一个探测请求，成功才恢复，失败则加倍暂停时间；
+      连续熔断 BREAKER_MAX_TRIPS 次后认为上游已不可用，剩余请求直接失败
+
+    线程用 wait_admission，协程用 await_admission；record 在每次请求结束时调用。
+    """
+
+    def __init__(self, max_retries: int = 3, budget: int | None = None, breaker: bool = False):
+        self.max_retries = max_retries
+        self.budget = budget
+        self.breaker = breaker
+        self.retries = 0
+        self._budget_noted = False
+        self._lock = threading.Lock()
+        self._window = deque(maxlen=BREAKER_WINDOW)
+        self._cooldown = BREAKER_COOLDOWN
+        self._open_until = None
+        self._probing = False
+        self._trips = 0
+        self.gave_up = False
+
+    def next_delay(self, prev_delay: float, retry_after: float | None = None) -> float | None:
+        """返回下一次重试前的等待秒数；批次重试预算已用完时返回 None。"""
+        with self._lock:
+            if self.budget is not None and self.retries >= self.budget:
+                if not self._budget_noted:
+                    self._budget_noted = True
+                    _safe_print(f"[ikunimage 重试] 本批次重试预算（{self.retries} 次）已用完，后续失败不再重试",
+                                file=sys.stderr)
+                return None
+            self.retries += 1
+        delay = min(RETRY_MAX_DELAY, random.uniform(RETRY_BASE_DELAY, max(RETRY_BASE_DELAY, prev_delay) * 3))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, RETRY_AFTER_MAX))
+        return delay
+
+    def extend_budget(self, amount: float) -> None:
+        """追加重试预算（批量按已提交任务数逐步放宽）。"""
+        with self._lock:
+            self.budget += amount
+
+    def _admit(self) -> tuple[float, bool | None]:
+        with self._lock:
+            if self.gave_up:
+                return 0.0, None
+            if self._open_until is None:
+                return 0.0, False
+            now = time.monotonic()
+            if now < self._open_until:
+                return self._open_until - now, False
+            if self._probing:
+                return BREAKER_POLL_SECONDS, False
+            self._probing = True
+            return 0.0, True
+
+    def wait_admission(self) -> bool | None:
+        """熔断期间阻塞等待；返回本次请求是否为熔断后的探测请求（传给 record），
+        已放弃时返回 None，调用方应直接按失败处理。"""
+        while True:
+            wait, probe = self._admit()
+            if wait <= 0:
+                return probe
+            time.sleep(wait)
+
+    async def await_admission(self) -> bool | None:
+        """wait_admission 的协程版本。"""
+        while True:
+            wait, probe = self._admit()
+            if wait <= 0:
+                return probe
+            await asyncio.sleep(wait)
+
+    def record(self, outcome: str, probe: bool = False) -> None:
+        """记录一次请求结果（_request_outcome 的取值），驱动熔断状态。"""
+        if not self.breaker:
+            return
+        failed = outcome in ("throttled", "error")
+        with self._lock:
+            if probe:
+                self._probing = False
+                if failed:
+                    self._cooldown = min(self._cooldown * 2, BREAKER_MAX_COOLDOWN)
+                    self._trip("探测请求仍然失败")
+                else:
+                    self._open_until = None
+                    self._cooldown = BREAKER_COOLDOWN
+                    self._trips = 0
+                    _safe_print("[ikunimage 熔断] 探测请求成功，恢复发送")
+                return
+            if self._open_until is not None:
+                return  # 熔断前已发出的请求，结果不再计入
+            self._window.append(failed)
+            failures = sum(self._window)
+            if (len(self._window) >= BREAKER_MIN_SAMPLES
+                    and failures >= BREAKER_FAILURE_RATIO * len(self._window)):
+                self._trip(f"最近 {len(self._window)} 次请求失败 {failures} 次")
+
+    def _trip(self, reason: str) -> None:
+        self._trips += 1
+        self._window.clear()
+        if self._trips > BREAKER_MAX_TRIPS:
+            self.gave_up = True
+            _safe_print(f"[ikunimage 熔断] {reason}，上游持续不可用，放弃剩余请求", file=sys.stderr)
+            return
+        self._open_until = time.monotonic() + self._cooldown
+        _safe_print(f"[ikunimage 熔断] {reason}，暂停所有请求 {self._cooldown:.0f}s", file=sys.stderr)
+
+
+# ---------------------------------------------------------------------------
+# 自适应并发控制（AIMD）
+# ---------------------------------------------------------------------------
+
+class AdaptiveConcurrency:
+    """AIMD 并发控制器：根据请求结果动态调整同时在途的请求数上限。
+
+    - 成功且延迟平稳：大约每完成 limit 个请求把上限 +1（加性增）
+    - 429/503 或超时：上限减半（乘性减）。减半前已发出的请求随后再失败不会重复减半，
+      避免一阵 429 直接把并发压到 1
+    延迟按 latency_class（如分辨率）分别统计基线，混跑 1K/4K 时互不干扰。
+
+    线程用 acquire/release，协程用 aacquire/release（须在事件循环线程内调用 release）。
+    """
+
+    def __init__(self, max_limit: int, initial: int = 2, min_limit: int = 1):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self._limit = float(max(self.min_limit, min(initial, self.max_limit)))
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._async_waiters = deque()
+        self._last_decrease = 0.0
+        self._latency = {}  # latency_class -> [近期 EWMA, 基线, 样本数]
+        self._t0 = time.monotonic()
+        self.history = [(0.0, self.limit)]  # (相对秒数, 上限)，用于汇总报告
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def acquire(self) -> float:
+        """阻塞直到有空闲名额，返回请求开始时间（传给 release）。"""
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+            return time.monotonic()
+
+    async def aacquire(self) -> float:
+        """acquire 的协程版本。"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._in_flight < self.limit:
+                    self._in_flight += 1
+                    return time.monotonic()
+                waiter = loop.create_future()
+                self._async_waiters.append(waiter)
+            await waiter
+
+    def release(self, started: float, outcome: str, latency_class: str = "") -> None:
+        """请求结束时调用，outcome 取 _request_outcome 的返回值或 "throttled"（超时）。"""
+        now = time.monotonic()
+        with self._lock:
+            was_saturated = self._in_flight >= self.limit
+            self._in_flight -= 1
+            old = self.limit
+            if outcome == "throttled":
+                if started >= self._last_decrease:
+                    self._limit = max(self.min_limit, self._limit / 2)
+                    self._last_decrease = now
+            elif outcome == "ok":
+                latency = now - started
+                stats = self._latency.setdefault(latency_class, [latency, math.inf, 0])
+                stats[0] = 0.7 * stats[0] + 0.3 * latency
+                stats[2] += 1
+                # 前几个样本波动大，攒够后再确定基线，以免单个偏快的请求把基线压得过低
+                if stats[2] >= ADAPTIVE_BASELINE_SAMPLES:
+                    stats[1] = min(stats[1], stats[0])
+                # 只有名额确实用满、且延迟没有明显上升时才加并发
+                if was_saturated and stats[0] <= ADAPTIVE_LATENCY_TOLERANCE * stats[1]:
+                    self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            new = self.limit
+            if new != old:
+                self.history.append((round(now - self._t0, 1), new))
+            self._cond.notify_all()
+            waiters = list(self._async_waiters)
+            self._async_waiters.clear()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        if new != old:
+            reason = "收到限流/超时" if new < old else "延迟平稳"
+            _safe_print(f"[ikunimage 并发] {reason}，并发上限 {old} -> {new}")
+
+    def describe(self) -> str:
+        """并发上限随时间的变化，如 "0s:2 → 41.3s:3 → 97.0s:1"。"""
+        return " → ".join(f"{t:g}s:{n}" for t, n in self.history)
+
+
+def _request_outcome(status_code: int) -> str:
+    """把响应状态归类：ok / throttled（限流）/ error（可重试的服务端错误）/ rejected（请求本身有误）。"""
+    if status_code == 200:
+        return "ok"
+    if status_code in THROTTLE_STATUS_CODES:
+        return "throttled"
+    if status_code in RETRYABLE_STATUS_CODES:
+        return "error"
+    return "rejected"
+
+
+# ---------------------------------------------------------------------------
+# 请求对冲（--hedge，缩短长尾延迟）
+# ---------------------------------------------------------------------------
+
+class HedgePolicy:
+    """请求对冲：请求在途时间超过同类请求延迟的 percentile 分位数仍未完成时，再发一个相同请求，
+    取先成功的一个，另一个立即中止且结果丢弃。
+
+    延迟按 latency_class 分别统计；本进程样本不足 HEDGE_MIN_SAMPLES 时改用 history 中
+    同一 latency key（模式 / 分辨率 / 宽高比）的持久化耗时，仍不足再按 HEDGE_FALLBACK_DELAY 等待。
+    对冲请求同样计费，总数受 budget 限制（批量按已提交任务数用 extend_budget 追加）。线程安全。
+    """
+
+    def __init__(
+            self, percentile: float = HEDGE_DEFAULT_PERCENTILE, budget: float = 1,
+            history: "LatencyHistory | None" = None,
+    ):
+        self.percentile = min(max(percentile, 1.0), 99.9)
+        self.budget = budget
+        self.history = history
+        self.hedged = 0
+        self.wins = 0
+        self._samples = {}  # latency_class -> 最近的成功耗时
+        self._lock = threading.Lock()
+
+    def observe(self, latency_class: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(latency_class, deque(maxlen=HEDGE_MAX_SAMPLES)).append(seconds)
+
+    def delay(self, latency_class: str, history_key: str | None = None) -> float:
+        """发出对冲请求前应等待的秒数，history_key 为请求的 latency key。"""
+        with self._lock:
+            samples = sorted(self._samples.get(latency_class, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES and self.history is not None and history_key is not None:
+            samples = self.history.samples(history_key)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_FALLBACK_DELAY.get(latency_class, HEDGE_DEFAULT_DELAY)
+        rank = math.ceil(self.percentile / 100 * len(samples)) - 1
+        return samples[max(0, rank)]
+
+    def extend_budget(self, amount: float) -> None:
+        with self._lock:
+            self.budget += amount
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.hedged + 1 > self.budget:
+                return False
+            self.hedged += 1
+            return True
+
+    def record_win(self) -> None:
+        with self._lock:
+            self.wins += 1
+
+    def describe(self) -> str:
+        return f"发出 {self.hedged} 个对冲请求，其中 {self.wins} 个先于原请求完成"
+
+
+def _first_success(outcomes: list, phases: dict | None = None) -> tuple:
+    """所有请求都没有成功时的返回值：优先返回收到的 HTTP 响应，否则抛出首个异常。
+
+    phases 不为空时填入所返回请求的分阶段耗时。
+    """
+    for resp, result, exc, own in outcomes:
+        if exc is None:
+            if phases is not None:
+                phases.update(own)
+            return resp, result
+    raise outcomes[0][2]
+
+
+def _fetch_image_hedged(
+    payload: dict,
+    timeout: float,
+    api_key: str,
+    output_path: str,
+    tag: str,
+    t0: float,
+    hedge: HedgePolicy,
+    latency_class: str,
+    phases: dict | None = None,
+    history_key: str | None = None,
+) -> tuple:
+    """带对冲的 _fetch_image，返回值与异常语义相同，phases 取最终采用的那个请求。
+
+    两个请求各在一个线程中执行；先成功写出文件的一方获胜（claim），并置位 decided，
+    另一方在收到下一块数据时发现后停止接收、在自己的线程中关闭响应，不会覆盖输出文件。
+    同步请求在收到响应头之前无法中断：落败的一方在那之前仍占着一个连接和一个限速名额。
+    """
+    claimed = threading.Lock()
+    decided = threading.Event()
+    finished = queue.SimpleQueue()
+
+    def _claim() -> bool:
+        return claimed.acquire(blocking=False)
+
+    def _run(hedged: bool) -> None:
+        own = {} if phases is not None else None
+        try:
+            resp, result = _fetch_image(payload, timeout, api_key, output_path, tag, t0,
+                                        claim=_claim, decided=decided, phases=own)
+            finished.put((hedged, resp, result, None, own))
+        except Exception as e:
+            finished.put((hedged, None, None, e, own))
+
+    threading.Thread(target=contextvars.copy_context().run, args=(_run, False), daemon=True).start()
+    running = 1
+    delay = hedge.delay(latency_class, history_key)
+    try:
+        item = finished.get(timeout=delay)
+    except queue.Empty:
+        item = None
+        if hedge.try_spend():
+            _safe_print(f"{tag} 请求已在途 {delay:.0f}s，发出对冲请求")
+            threading.Thread(target=contextvars.copy_context().run, args=(_run, True), daemon=True).start()
+            running += 1
+
+    outcomes = []
+    while True:
+        if item is None:
+            item = finished.get()
+        running -= 1
+        hedged, resp, result, exc, own = item
+        if exc is None and result is not None and result["success"]:
+            decided.set()
+            if hedged:
+                hedge.record_win()
+            if phases is not None:
+                phases.update(own)
+            return resp, result
+        outcomes.append((resp, result, exc, own))
+        if not running:
+            return _first_success(outcomes, phases)
+        item = None
+
+
+async def _afetch_image_hedged(
+    payload: dict,
+    timeout: float,
+    api_key: str,
+    output_path: str,
+    tag: str,
+    t0: float,
+    hedge: HedgePolicy,
+    latency_class: str,
+    phases: dict | None = None,
+    history_key: str | None = None,
+) -> tuple:
+    """_fetch_image_hedged 的异步版本，落败的请求直接取消。"""
+    claimed = False
+    owned = {}  # task -> 该请求的分阶段耗时
+
+    def _claim() -> bool:
+        nonlocal claimed
+        if claimed:
+            return False
+        claimed = True
+        return True
+
+    def _start() -> asyncio.Task:
+        own = {} if phases is not None else None
+        task = asyncio.ensure_future(
+            _afetch_image(payload, timeout, api_key, output_path, tag, t0, claim=_claim, phases=own))
+        owned[task] = own
+        return task
+
+    primary = _start()
+    running = {primary}
+    delay = hedge.delay(latency_class, history_key)
+    done, _ = await asyncio.wait(running, timeout=delay)
+    if not done and hedge.try_spend():
+        _safe_print(f"{tag} 请求已在途 {delay:.0f}s，发出对冲请求")
+        running.add(_start())
+
+    outcomes = []
+    try:
+        while running:
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                exc = task.exception()
+                resp, result = (None, None) if exc is not None else task.result()
+                if exc is None and result is not None and result["success"]:
+                    if task is not primary:
+                        hedge.record_win()
+                    if phases is not None:
+                        phases.update(owned[task])
+                    return resp, result
+                outcomes.append((resp, result, exc, owned[task]))
+    finally:
+        for task in running:
+            task.cancel()
+    return _first_success(outcomes, phases)
+
+
+# ---------------------------------------------------------------------------
+# 延迟历史与自适应超时（按模式 / 分辨率 / 宽高比学习，跨进程持久化）
+# ---------------------------------------------------------------------------
+
+class LatencyHistory:
+    """成功请求耗时的持久化历史，按 latency key（模式 / 分辨率 / 宽高比）分类，用于计算自适应超时。
+
+    首次使用时从 path 读入；本进程新增的样本在 save() 时于 flock 下与磁盘上的历史合并写回，
+    其他进程同时写入的样本不会丢失，每类只保留最近 LATENCY_HISTORY_SIZE 个。
+    读写失败只会退化为固定超时。线程安全。
+    """
+
+    def __init__(self, path: Path = LATENCY_HISTORY_PATH):
+        self.path = Path(path)
+        self._samples = None  # latency key -> 最近的成功耗时（秒）
+        self._new = {}  # 本进程新增、尚未写回的样本
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse(text: str) -> dict:
+        try:
+            data = json.loads(text or "{}")
+            return {k: [float(x) for x in v][-LATENCY_HISTORY_SIZE:] for k, v in data.items()}
+        except (ValueError, TypeError, AttributeError):
+            return {}
+
+    def _load(self) -> dict:
+        if self._samples is None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_SH)
+                    self._samples = self._parse(f.read())
+            except OSError:
+                self._samples = {}
+        return self._samples
+
+    def observe(self, key: str, seconds: float) -> None:
+        sample = round(seconds, 2)
+        with self._lock:
+            samples = self._load().setdefault(key, [])
+            samples.append(sample)
+            del samples[:-LATENCY_HISTORY_SIZE]
+            self._new.setdefault(key, []).append(sample)
+
+    def samples(self, key: str) -> list:
+        """该 latency key 最近的成功耗时（秒），从小到大排列。"""
+        with self._lock:
+            return sorted(self._load().get(key, ()))
+
+    def timeout(self, key: str, ceiling: float) -> float:
+        """总超时（秒）：样本足够时为 p99 x 系数，限制在 [ADAPTIVE_TIMEOUT_FLOOR, ceiling]；否则为 ceiling。"""
+        samples = self.samples(key)
+        if len(samples) < ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+            return ceiling
+        rank = math.ceil(ADAPTIVE_TIMEOUT_PERCENTILE / 100 * len(samples)) - 1
+        return min(ceiling, max(ADAPTIVE_TIMEOUT_FLOOR, math.ceil(samples[rank] * ADAPTIVE_TIMEOUT_FACTOR)))
+
+    def save(self) -> None:
+        """把本进程新增的样本合并写回磁盘。"""
+        with self._lock:
+            new, self._new = self._new, {}
+        if not new:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a+", encoding="utf-8") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                state = self._parse(f.read())
+                for key, samples in new.items():
+                    state[key] = (state.get(key, []) + samples)[-LATENCY_HISTORY_SIZE:]
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+        except OSError:
+            pass
+
+
+def open_latency_history(enabled: bool = True) -> LatencyHistory | None:
+    """按命令行参数打开延迟历史；enabled=False（--fixed-timeout）时返回 None，使用固定超时。"""
+    return LatencyHistory() if enabled else None
+
+
+# ---------------------------------------------------------------------------
+# 分阶段耗时与批量指标（--metrics）
+# ---------------------------------------------------------------------------
+
+def _result_timings(phases: dict, started: float, **totals: float) -> dict:
+    """成功结果的 timings 字段（秒）。
+
+    queue / backoff / prepare 是整个任务的累计值，其余为最终成功的那次请求的阶段耗时，total 为任务总耗时。
+    """
+    timings = {name: round(totals.get(name, phases.get(name, 0.0)), 3) for name in TIMING_PHASES}
+    timings["total"] = round(time.perf_counter() - started, 3)
+    return timings
+
+
+class BatchMetrics:
+    """批量运行指标：请求数（按状态）、重试数（按触发重试的状态）、收发字节数、任务数，
+    以及成功任务各阶段耗时与总耗时的直方图。
+
+    path 以 .prom 结尾时导出 Prometheus 文本格式（可交给 node_exporter 的 textfile collector 采集），
+    否则导出 JSON；先写临时文件再原子替换，采集方不会读到半份文件。
+    interval > 0 时由后台线程定期导出，close() 时导出最终结果。线程安全。
+    """
+
+    def __init__(self, path: Path, interval: float = 0):
+        self.path = Path(path)
+        self.interval = interval
+        self.started = time.time()
+        self.hedge = None  # 启用对冲时由批量函数挂上 HedgePolicy，一并导出对冲请求数
+        self._requests = {}
+        self._retries = {}
+        self._tasks = {}
+        self._bytes_in = self._bytes_out = 0
+        self._hist = {}  # 名称 -> [各桶计数..., +Inf 桶计数, 总和]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def request(self, status: str, phases: dict) -> None:
+        """记录一次 API 请求，status 为 HTTP 状态码或 timeout / connect_error / transport_error。"""
+        with self._lock:
+            self._requests[status] = self._requests.get(status, 0) + 1
+            self._bytes_in += phases.get("bytes_in", 0)
+            self._bytes_out += phases.get("bytes_out", 0)
+
+    def retry(self, status: str) -> None:
+        with self._lock:
+            self._retries[status] = self._retries.get(status, 0) + 1
+
+    def task(self, result: dict) -> None:
+        """记录一个任务的最终结果，本次真正请求成功的任务计入耗时直方图。"""
+        if result.get("resumed"):
+            kind = "resumed"
+        elif result.get("cached"):
+            kind = "cached"
+        elif result.get("coalesced"):
+            kind = "coalesced"
+        elif result.get("skipped"):
+            kind = "skipped"
+        else:
+            kind = "ok" if result["success"] else "failed"
+        timings = result.get("timings") if kind == "ok" else None
+        with self._lock:
+            self._tasks[kind] = self._tasks.get(kind, 0) + 1
+            for name, seconds in (timings or {}).items():
+                hist = self._hist.setdefault(name, [0] * (len(METRICS_BUCKETS) + 1) + [0.0])
+                hist[bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+                hist[-1] += seconds
+
+    def snapshot(self) -> dict:
+        """当前指标的 JSON 形式，直方图的桶计数为累计值（与 Prometheus 一致）。"""
+        now = time.time()
+        with self._lock:
+            data = {
+                "script": METRICS_SCRIPT,
+                "updated": round(now, 3),
+                "elapsed": round(now - self.started, 3),
+                "requests": dict(self._requests),
+                "retries": dict(self._retries),
+                "tasks": dict(self._tasks),
+                "bytes_in": self._bytes_in,
+                "bytes_out": self._bytes_out,
+            }
+            hists = {name: list(hist) for name, hist in self._hist.items()}
+        if self.hedge is not None:
+            data["hedged"] = self.hedge.hedged
+        data["histograms"] = {}
+        for name, hist in hists.items():
+            cumulative = list(itertools.accumulate(hist[:-1]))
+            buckets = {f"{b:g}": n for b, n in zip(METRICS_BUCKETS, cumulative)}
+            buckets["+Inf"] = cumulative[-1]
+            data["histograms"][name] = {"buckets": buckets, "sum": round(hist[-1], 3), "count": cumulative[-1]}
+        return data
+
+    def render_prometheus(self) -> str:
+        data = self.snapshot()
+        lines = []
+
+        def _metric(name: str, kind: str, help_text: str, samples) -> None:
+            lines.append(f"# HELP ikunimage_{name} {help_text}")
+            lines.append(f"# TYPE ikunimage_{name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f'ikunimage_{name}{suffix}{{script="{METRICS_SCRIPT}"{labels}}} {value}')
+
+        def _histogram(labels: str, hist: dict):
+            for le, n in hist["buckets"].items():
+                yield "_bucket", f'{labels},le="{le}"', n
+            yield "_sum", labels, hist["sum"]
+            yield "_count", labels, hist["count"]
+
+        _metric("requests_total", "counter",
+                "API 请求数，status 为 HTTP 状态码或 timeout / connect_error / transport_error",
+                [("", f',status="{k}"', v) for k, v in sorted(data["requests"].items())])
+        _metric("retries_total", "counter", "重试次数，status 为触发重试的状态",
+                [("", f',status="{k}"', v) for k, v in sorted(data["retries"].items())])
+        _metric("tasks_total", "counter", "已结束的任务数",
+                [("", f',result="{k}"', v) for k, v in sorted(data["tasks"].items())])
+        _metric("received_bytes_total", "counter", "接收的响应字节数", [("", "", data["bytes_in"])])
+        _metric("sent_bytes_total", "counter", "发送的请求字节数", [("", "", data["bytes_out"])])
+        if "hedged" in data:
+            _metric("hedged_requests_total", "counter", "发出的对冲请求数", [("", "", data["hedged"])])
+        _metric("batch_elapsed_seconds", "gauge", "批量已运行时间", [("", "", data["elapsed"])])
+        _metric("last_update_timestamp_seconds", "gauge", "指标导出时间", [("", "", data["updated"])])
+        hists = data["histograms"]
+        _metric("phase_seconds", "histogram", "成功任务各阶段耗时",
+                [sample for name in (*TIMING_PHASES, "postprocess") if name in hists
+                 for sample in _histogram(f',phase="{name}"', hists[name])])
+        if "total" in hists:
+            _metric("task_seconds", "histogram", "成功任务总耗时", _histogram("", hists["total"]))
+        return "\n".join(lines) + "\n"
+
+    def describe(self) -> str:
+        """成功任务各阶段的平均耗时，如 "queue 0.10s | ttfb 20.31s | ..."，还没有成功任务时为空。"""
+        with self._lock:
+            means = {name: hist[-1] / max(1, sum(hist[:-1])) for name, hist in self._hist.items()}
+        phases = (*TIMING_PHASES, "postprocess", "total")
+        return " | ".join(f"{name} {means[name]:.2f}s" for name in phases if name in means)
+
+    def write(self) -> None:
+        """导出一次指标，写入失败只打印警告。"""
+        if self.path.suffix == ".prom":
+            text = self.render_prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=2, ensure_ascii=False) + "\n"
+        tmp = self.path.with_name(f".{self.path.name}.{uuid.uuid4().hex[:8]}.part")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_text(text, encoding="utf-8")
+            os.replace(tmp, self.path)
+        except OSError as e:
+            tmp.unlink(missing_ok=True)
+            _safe_print(f"[ikunimage] 警告: 写入指标文件失败: {e}", file=sys.stderr)
+
+    def start(self) -> None:
+        """interval > 0 时启动定期导出线程。"""
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(
+                target=contextvars.copy_context().run, args=(self._loop,), daemon=True,
+            )
+            self._thread.start()
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def close(self) -> None:
+        """停止定期导出并写出最终指标。"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+
+# ---------------------------------------------------------------------------
+# 多张输出（--count：一次请求多个候选，上游不支持时并发拆分）
+# ---------------------------------------------------------------------------
+
+def _indexed_path(output_path, index: int) -> Path:
+    """第 index 张图（从 0 起）的输出路径：第 1 张为 output_path，其余为 <文件名>_<序号><图片后缀>。"""
+    path = Path(output_path)
+    if index == 0:
+        return path
+    if not _has_image_suffix(path):
+        return path.with_name(f"{path.name}_{index + 1}")
+    return path.with_name(f"{path.stem}_{index + 1}{path.suffix}")
+
+
+def _has_image_suffix(path: Path) -> bool:
+    """路径是否带图片扩展名；没有时（包括 photo.v2 这类带点但不是图片后缀的文件名）按 mimeType 在末尾补上扩展名。"""
+    return (mimetypes.guess_type(path.name)[0] or "").startswith("image/")
+
+
+_multi_candidate = {}  # 本进程已知的探测结果，"supported" 键存在即已读取 / 探测过
+_multi_candidate_lock = threading.Lock()
+
+
+def _load_state() -> dict:
+    """读取 STATE_FILE，文件不存在或解析失败返回空 dict。"""
+    try:
+        state = json.loads(STATE_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def _update_state(key: str, value) -> None:
+    """在 flock 下把一项探测结果写入 STATE_FILE（写临时文件再重命名），已有的值不覆盖。
+
+    STATE_FILE 存在但无法解析时不写，不会覆盖掉原有内容；写入失败只会让以后重新探测。
+    """
+    tmp = STATE_FILE.with_name(f".{STATE_FILE.name}.{uuid.uuid4().hex[:8]}.part")
+    try:
+        STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(STATE_FILE.with_name(f".{STATE_FILE.name}.lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = json.loads(STATE_FILE.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                state = {}
+            if not isinstance(state, dict) or key in state:
+                return
+            state[key] = value
+            tmp.write_text(json.dumps(state, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+            os.replace(tmp, STATE_FILE)
+    except (OSError, ValueError):
+        tmp.unlink(missing_ok=True)
+
+
+def _multi_candidate_support() -> bool | None:
+    """上游是否支持一次返回多个候选，未知时返回 None。
+
+    config.json 中手动设置的 multi_candidate 优先，其次是 STATE_FILE 中记录的探测结果；
+    只在本进程第一次调用时读文件（异步引擎经 asyncio.to_thread 调用）。
+    """
+    with _multi_candidate_lock:
+        if "supported" not in _multi_candidate:
+            manual = _load_config().get("multi_candidate")
+            if not isinstance(manual, bool):
+                manual = _load_state().get("multi_candidate")
+            _multi_candidate["supported"] = manual if isinstance(manual, bool) else None
+        return _multi_candidate["supported"]
+
+
+def _remember_multi_candidate(supported: bool) -> None:
+    """记录首次探测的结果：本进程内立即生效，并写入 STATE_FILE；已有的值（包括手动设置的）不覆盖。"""
+    if _multi_candidate_support() is not None:
+        return
+    with _multi_candidate_lock:
+        if _multi_candidate.get("supported") is not None:
+            return
+        _multi_candidate["supported"] = supported
+    _update_state("multi_candidate", supported)
+
+
+def _merge_images(count: int, results: list) -> dict:
+    """合并同一任务各请求的结果。有请求失败时整体记为失败，但仍列出已生成的图片（已计费，不丢弃）。"""
+    ok = [r for r in results if r["success"]]
+    failed = [r for r in results if not r["success"]]
+    paths = [p for r in ok for p in r.get("paths", [r["path"]])]
+    merged = {"success": not failed}
+    if paths:
+        merged.update(
+            path=paths[0],
+            paths=paths,
+            size_kb=round(sum(r["size_kb"] for r in ok), 1),
+            elapsed=max(r.get("elapsed", 0.0) for r in ok),
+        )
+        timings = next((r["timings"] for r in ok if "timings" in r), None)
+        if timings is not None:
+            merged["timings"] = timings
+        digests = {p: d for r in ok for p, d in r.get("sha256", {}).items()}
+        if digests:
+            merged["sha256"] = digests
+    if failed:
+        merged["error"] = f"{count} 张中只生成了 {len(paths)} 张。错误: {failed[0]['error']}"
+    return merged
+
+
+def _fan_out(steps: Callable, kwargs: dict, output_path: str, task_label: str, start: int, count: int) -> list:
+    """并发执行 count 次单张的核心逻辑 steps（见 _run_steps），返回各自的结果。
+
+    输出依次为第 start + 1 张起的编号路径。
+    """
+    with ThreadPoolExecutor(max_workers=count, thread_name_prefix="ikunimage-fanout") as pool:
+        futures = [
+            # 每个线程继承当前调用的上下文（守护进程中所属的客户端调用）
+            pool.submit(contextvars.copy_context().run, _run_steps, steps(
+                **kwargs,
+                output_path=str(_indexed_path(output_path, start + i)),
+                task_label=f"{task_label} 第{start + i + 1}张".strip(),
+            ))
+            for i in range(count)
+        ]
+        return [f.result() for f in futures]
+
+
+async def _afan_out(steps: Callable, kwargs: dict, output_path: str, task_label: str, start: int, count: int) -> list:
+    """_fan_out 的异步版本。"""
+    return list(await asyncio.gather(*(
+        _arun_steps(steps(
+            **kwargs,
+            output_path=str(_indexed_path(output_path, start + i)),
+            task_label=f"{task_label} 第{start + i + 1}张".strip(),
+        ))
+        for i in range(count)
+    )))
+
+
+# ---------------------------------------------------------------------------
+# 输出后处理（格式转换、缩放、缩略图、去除元数据；批量时在进程池中执行）
+# ---------------------------------------------------------------------------
+
+class OutputPostprocess(NamedTuple):
+    """生成后的输出图片处理参数，全部为默认值时不做处理。"""
+
+    format: str | None = None    # 转换格式 webp / jpeg / png，None = 保持接口返回的格式
+    quality: int = 85            # webp / jpeg 质量
+    max_edge: int = 0            # 长边上限（像素），0 = 不缩放
+    thumbnail: int = 0           # 另存缩略图的长边像素，0 = 不生成
+    strip: bool = False          # 去除元数据（EXIF、ICC 配置）
+    keep_original: bool = False  # 转换格式后保留接口返回的原文件
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.format or self.max_edge or self.thumbnail or self.strip)
+
+
+def _thumbnail_path(path: Path) -> Path:
+    """缩略图路径：<文件名>.thumb<后缀>。"""
+    return path.with_name(f"{path.stem}.thumb{path.suffix}")
+
+
+def _save_image(im, path: Path, fmt: str, post: OutputPostprocess, info: dict) -> None:
+    """写到同目录的临时文件再重命名，中途失败不会留下半个文件。"""
+    if fmt == "jpeg" and im.mode not in ("RGB", "L"):
+        im = im.convert("RGB")
+    elif im.mode not in ("RGB", "RGBA", "L", "LA"):
+        im = im.convert("RGBA")
+    save_kwargs = {} if fmt == "png" else {"quality": post.quality}
+    if not post.strip:
+        save_kwargs.update({k: info[k] for k in ("icc_profile", "exif") if info.get(k)})
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.part")
+    try:
+        im.save(tmp, format=fmt.upper(), **save_kwargs)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def _postprocess_image(path: str, post: OutputPostprocess) -> dict:
+    """按 post 处理一张输出图片，返回 {"path": 处理后的路径, "bytes": int[, "thumbnail": 缩略图路径]}。
+
+    格式不变、无需缩放且不去元数据时不重编码原图（只生成缩略图）。
+    """
+    src = Path(path)
+    with Image.open(src) as im:
+        im.load()
+        info = dict(im.info)
+        fmt = post.format or {"JPEG": "jpeg", "WEBP": "webp"}.get(im.format, "png")
+        dst = src.with_suffix("." + fmt.replace("jpeg", "jpg")) if post.format else src
+        if post.strip:
+            # 方向标记随元数据一起去掉，先按 EXIF 方向摆正
+            im = ImageOps.exif_transpose(im)
+        needs_resize = post.max_edge and max(im.size) > post.max_edge
+        if needs_resize:
+            im.thumbnail((post.max_edge, post.max_edge), Image.Resampling.LANCZOS)
+        if dst != src or needs_resize or post.strip:
+            _save_image(im, dst, fmt, post, info)
+        out = {"path": str(dst)}
+        if post.thumbnail:
+            thumb = im.copy()
+            thumb.thumbnail((post.thumbnail, post.thumbnail), Image.Resampling.LANCZOS)
+            thumb_path = _thumbnail_path(dst)
+            # 缩略图只用于展示，总是去掉元数据
+            _save_image(thumb, thumb_path, fmt, post._replace(strip=True), info)
+            out["thumbnail"] = str(thumb_path)
+    if dst != src and not post.keep_original:
+        src.unlink()
+    out["bytes"] = dst.stat().st_size
+    return out
+
+
+def _postprocess_outputs(paths: list, post: OutputPostprocess) -> tuple[list, float]:
+    """处理一个任务的全部输出图片，返回 (各图片的处理结果, 耗时秒数)。
+
+    模块级函数，便于提交到进程池执行。
+    """
+    t = time.perf_counter()
+    outs = [_postprocess_image(p, post) for p in paths]
+    return outs, time.perf_counter() - t
+
+
+def _apply_postprocess(result: dict, outs: list, seconds: float) -> dict:
+    """把后处理结果合并进任务结果：更新路径和大小，附加 thumbnails 与 timings.postprocess。
+
+    输出文件已被改写，写出时算的 sha256 不再适用，一并去掉。
+    """
+    paths = [o["path"] for o in outs]
+    result.pop("sha256", None)
+    result["path"] = paths[0]
+    if "paths" in result:
+        result["paths"] = paths
+    result["size_kb"] = round(sum(o["bytes"] for o in outs) / 1024, 1)
+    thumbnails = [o["thumbnail"] for o in outs if "thumbnail" in o]
+    if thumbnails:
+        result["thumbnails"] = thumbnails
+    if "timings" in result:
+        result["timings"]["postprocess"] = round(seconds, 3)
+    return result
+
+
+def postprocess_result(result: dict, post: OutputPostprocess, tag: str) -> dict:
+    """在当前线程中对成功结果做后处理（单图模式）。失败时保留原图，只打印警告。"""
+    try:
+        _apply_postprocess(result, *_postprocess_outputs(result.get("paths", [result["path"]]), post))
+    except (OSError, ValueError) as e:
+        result["postprocess_error"] = str(e)
+        _safe_print(f"{tag} 后处理失败，保留原图: {e}", file=sys.stderr)
+        return result
+    saved = ", ".join(result.get("paths", [result["path"]]) + result.get("thumbnails", []))
+    _safe_print(f"{tag} 后处理完成 -> {saved}")
+    return result
+
+
+class OutputPipeline:
+    """批量输出的后处理流水线：网络 worker 把成功结果交给进程池后立即返回，继续下一个请求。
+
+    转换、缩放等 CPU 密集操作在子进程中执行，与在途请求重叠，不占用网络线程和 GIL。
+    最多 processes × POSTPROCESS_QUEUE_FACTOR 个任务在排队或处理，后处理跟不上时 submit 阻塞（背压）。
+    处理完成后在进程池的结果线程中以提交时的上下文调用 done(result)；失败时保留原图，只打印警告。
+    线程安全。
+    """
+
+    def __init__(self, post: OutputPostprocess, processes: int, label: str):
+        self.post = post
+        self.label = label
+        self._executor = ProcessPoolExecutor(max_workers=processes)
+        self._slots = threading.BoundedSemaphore(processes * POSTPROCESS_QUEUE_FACTOR)
+
+    def submit(self, result: dict, done: Callable[[dict], None]) -> None:
+        self._slots.acquire()
+        ctx = contextvars.copy_context()
+        handed = time.perf_counter()
+
+        def _finished(future) -> None:
+            try:
+                _apply_postprocess(result, *future.result())
+            except Exception as e:
+                result["postprocess_error"] = str(e)
+                _safe_print(f"[ikunimage {self.label}] 任务 #{result['index'] + 1} 后处理失败，保留原图: {e}",
+                            file=sys.stderr)
+            if "timings" in result:
+                result["timings"]["total"] = round(result["timings"]["total"] + time.perf_counter() - handed, 3)
+            try:
+                done(result)
+            finally:
+                self._slots.release()
+
+        future = self._executor.submit(_postprocess_outputs, result.get("paths", [result["path"]]), self.post)
+        future.add_done_callback(lambda f: ctx.run(_finished, f))
+
+    def close(self) -> None:
+        """等待已提交的任务全部处理完毕（含 done 回调）后关闭进程池。"""
+        self._executor.shutdown()
+
+
+def open_output_pipeline(post: OutputPostprocess | None, workers: int, label: str) -> OutputPipeline | None:
+    """批量后处理流水线，未启用后处理时返回 None。进程数不超过网络并发数和 CPU 核数。"""
+    if post is None or not post.enabled:
+        return None
+    return OutputPipeline(post, max(1, min(workers, os.cpu_count() or 1)), label)
+
+
+# ---------------------------------------------------------------------------
+# 核心编辑逻辑（线程安全）
+# ---------------------------------------------------------------------------
+#
+# 重试、响应处理和统计只在 _edit_steps 中写一遍。它是一个生成器，遇到等待（退避、准入、
+# 并发名额、读取输入、发请求、读写缓存等）时 yield 一个 _Step，由引擎执行后把结果 send 回来：
+# 线程引擎用 _run_steps 直接调用同步版本，async 引擎用 _arun_steps await 异步版本。
+
+class _Step:
+    """核心逻辑中的一步等待操作：线程引擎调用 sync(*args, **kwargs)，async 引擎 await aio(*args, **kwargs)。"""
+
+    __slots__ = ("sync", "aio", "args", "kwargs")
+
+    def __init__(self, sync: Callable, aio: Callable, *args, **kwargs):
+        self.sync = sync
+        self.aio = aio
+        self.args = args
+        self.kwargs = kwargs
+
+
+def _thread_step(fn: Callable, *args, **kwargs) -> _Step:
+    """阻塞的文件 / CPU 操作：线程引擎直接调用，async 引擎放到线程池执行，不卡住事件循环。"""
+    return _Step(fn, lambda *a, **kw: asyncio.to_thread(fn, *a, **kw), *args, **kwargs)
+
+
+def _run_steps(steps):
+    """在当前线程中驱动核心逻辑生成器，返回其返回值。
+
+    某一步抛出的异常（包括 KeyboardInterrupt）先抛回生成器，释放并发名额、记录统计等 finally 照常执行。
+    """
+    value = error = None
+    while True:
+        try:
+            step = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, error = step.sync(*step.args, **step.kwargs), None
+        except BaseException as e:
+            value, error = None, e
+
+
+async def _arun_steps(steps):
+    """_run_steps 的异步版本（任务被取消时 CancelledError 同样抛回生成器）。"""
+    value = error = None
+    while True:
+        try:
+            step = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, error = await step.aio(*step.args, **step.kwargs), None
+        except BaseException as e:
+            value, error = None, e
+
+
+def _edit_steps(
+    input_image: str,
+    prompt: str,
+    api_key: str,
+    aspect_ratio: str = "1:1",
+    output_path: str = "output.png",
+    max_retries: int = 3,
+    task_label: str = "",
+    cache: ResultCache | None = None,
+    concurrency: AdaptiveConcurrency | None = None,
+    retry_policy: RetryPolicy | None = None,
+    hedge: HedgePolicy | None = None,
+    input_cache: InputImageCache | None = None,
+    preprocess: InputPreprocess | None = None,
+    metrics: BatchMetrics | None = None,
+    submitted: float | None = None,
+    deadline: float | None = None,
+    latency: LatencyHistory | None = None,
+    count: int = 1,
+):
+    """编辑单张图片的核心逻辑（生成器，见 _run_steps / _arun_steps），返回结果字典。
+
+    返回:
+        成功: {"success": True, "path": str, "size_kb": float, "elapsed": float}
+              输出多张图时额外带 "paths": [str]（第 1 张即 path）
+              命中结果缓存时额外带 "cached": True
+              实际发出请求时额外带 "timings": {阶段: 秒}，阶段见 TIMING_PHASES，另有 total
+              （批量启用输出后处理时另有 postprocess，total 含后处理）
+        失败: {"success": False, "error": str}
+
+    deadline（time.time() 时间戳）不为空时，单次请求最多等到截止时间，赶不上截止时间时不再重试。
+    latency 不为空时按同类请求的历史耗时计算超时（上限仍为 TIMEOUT_SECONDS），成功耗时计入历史；
+    超时后的重试把超时放宽一倍。
+    count > 1 时一次请求 count 个候选（不走结果缓存），上游返回不足时并发补齐；
+    上游不支持多候选时直接拆成 count 个并发请求（见 _multi_candidate_support）。
+    """
+    input_image = str(_job_path(input_image))
+    output_path = str(_job_path(output_path))
+    tag = f"[ikunimage 编辑{' ' + task_label if task_label else ''}]"
+    t_task = submitted if submitted is not None else time.perf_counter()
+    # 批量线程引擎从提交到开始执行的等待计入 queue
+    queued = time.perf_counter() - t_task
+
+    # 多张输出时拆分请求用的参数（输出路径与标签由 _fan_out 逐个生成）
+    piece = dict(
+        input_image=input_image, prompt=prompt, api_key=api_key, aspect_ratio=aspect_ratio,
+        max_retries=max_retries, concurrency=concurrency, retry_policy=retry_policy, hedge=hedge,
+        input_cache=input_cache, preprocess=preprocess, metrics=metrics, deadline=deadline, latency=latency,
+    )
+
+    def _split(start: int, n: int) -> _Step:
+        # 并发拆成 n 个单张请求，输出为第 start + 1 张起（见 _fan_out）
+        return _Step(_fan_out, _afan_out, _edit_steps, piece, output_path, task_label, start, n)
+
+    if count > 1:
+        # 缓存条目只存一张图，拆分出的同内容请求也不能互相命中，因此多张输出不走结果缓存
+        cache = None
+        if (yield _thread_step(_multi_candidate_support)) is False:
+            return _merge_images(count, (yield _split(0, count)))
+
+    # 读取输入图片（批量时经 input_cache 复用编码结果）
+    try:
+        if input_cache is not None:
+            image_b64, mime_type = yield _thread_step(input_cache.read, input_image)
+        else:
+            image_b64, mime_type = yield _thread_step(read_image_as_base64, input_image, preprocess)
+        _safe_print(f"{tag} 输入图片: {input_image} ({mime_type})")
+    except (OSError, ValueError) as e:
+        return {"success": False, "error": str(e)}
+
+    payload = build_edit_payload(prompt, image_b64, mime_type, aspect_ratio, count)
+    prepare = time.perf_counter() - t_task - queued
+    latency_key = f"{METRICS_SCRIPT}/{aspect_ratio}" + (f"/x{count}" if count > 1 else "")
+    timeout = latency.timeout(latency_key, TIMEOUT_SECONDS) if latency is not None else TIMEOUT_SECONDS
+
+    key = (yield _thread_step(cache_key, payload)) if cache is not None else None
+    if key is not None:
+        hit = yield _thread_step(cache.get, key, output_path)
+        if hit:
+            _safe_print(f"{tag} 命中结果缓存 -> {hit['path']}")
+            return hit
+
+    _safe_print(f"{tag} 正在编辑图片...")
+    _safe_print(f"{tag}   编辑描述: {prompt[:80]}{'...' if len(prompt) > 80 else ''}")
+    _safe_print(f"{tag}   宽高比: {aspect_ratio} | 超时: {timeout}s")
+
+    policy = retry_policy or RetryPolicy(max_retries)
+    resp = None
+    result = None
+    last_error = None
+    delay = 0.0
+    retry_after = None
+    status = None
+    backoff = 0.0
+    rerouted = False
+
+    for attempt in range(policy.max_retries + 1):
+        if attempt > 0 and not rerouted:
+            delay = policy.next_delay(delay, retry_after)
+            if delay is None:
+                return {"success": False, "error": f"批量重试预算已用完。最后错误: {last_error}"}
+            if deadline is not None and time.time() + delay >= deadline:
+                return {"success": False, "error": f"截止时间前无法完成，放弃重试。最后错误: {last_error}"}
+            _safe_print(f"{tag} 第 {attempt}/{policy.max_retries} 次重试，等待 {delay:.1f}s ...")
+            yield _Step(time.sleep, asyncio.sleep, delay)
+            backoff += delay
+            if metrics is not None:
+                metrics.retry(status)
+        retry_after = None
+        rerouted = False
+
+        t_wait = time.perf_counter()
+        probe = yield _Step(policy.wait_admission, policy.await_admission)
+        if probe is None:
+            return {"success": False, "error": f"上游持续失败，已熔断放弃。最后错误: {last_error}"}
+        started = (yield _Step(concurrency.acquire, concurrency.aacquire)) if concurrency is not None else None
+        queued += time.perf_counter() - t_wait
+        outcome = "error"
+        status = None
+        phases = {}
+        _safe_print(f"{tag} 发送请求 (attempt {attempt + 1})")
+
+        attempt_timeout = timeout if deadline is None else max(1.0, min(timeout, deadline - time.time()))
+        t0 = time.time()
+        try:
+            if hedge is None:
+                fetch = _Step(_fetch_image, _afetch_image, payload, attempt_timeout, api_key, output_path, tag, t0,
+                              phases=phases)
+            else:
+                fetch = _Step(_fetch_image_hedged, _afetch_image_hedged, payload, attempt_timeout, api_key,
+                              output_path, tag, t0, hedge, "edit", phases, latency_key)
+            resp, result = yield fetch
+            outcome = _request_outcome(resp.status_code)
+            status = str(resp.status_code)
+        except httpx.TimeoutException:
+            outcome = "throttled"
+            status = "timeout"
+            last_error = "请求超时"
+            _safe_print(f"{tag} 请求超时", file=sys.stderr)
+            # 按历史算出的超时可能偏紧（上游整体变慢），重试时放宽
+            timeout = min(TIMEOUT_SECONDS, timeout * 2)
+            continue
+        except httpx.ConnectError as e:
+            outcome = "error"
+            status = "connect_error"
+            last_error = f"连接失败: {e}"
+            _safe_print(f"{tag} 连接失败: {e}", file=sys.stderr)
+            continue
+        except httpx.TransportError as e:
+            # 响应体收到一半连接被断开等（RemoteProtocolError / ReadError），复用的长连接上尤其常见；
+            # 未写完的临时文件已由解码器清理，按可重试的上游错误处理
+            outcome = "error"
+            status = "transport_error"
+            last_error = f"传输中断: {e}"
+            _safe_print(f"{tag} 传输中断: {e}", file=sys.stderr)
+            continue
+        finally:
+            if concurrency is not None:
+                concurrency.release(started, outcome, "edit")
+            policy.record(outcome, probe)
+            queued += phases.pop("queue", 0.0)
+            if metrics is not None and status is not None:
+                metrics.request(status, phases)
+
+        elapsed = time.time() - t0
+
+        if resp.status_code == 200:
+            if hedge is not None and result["success"]:
+                hedge.observe("edit", elapsed)
+            if latency is not None and result["success"]:
+                latency.observe(latency_key, elapsed)
+            break
+
+        if resp.extensions.get("ikunimage_reroute") and attempt < policy.max_retries:
+            # 这个 Key 刚被 Key 池标记为不可用（认证失败 / 额度用尽 / 连续失败），立即换用其他 Key
+            last_error = _retry_error_message(resp)
+            rerouted = True
+            _safe_print(f"{tag} 收到 {resp.status_code}，换用其他 Key 重试", file=sys.stderr)
+            continue
+
+        if resp.status_code in RETRYABLE_STATUS_CODES and attempt < policy.max_retries:
+            last_error = _retry_error_message(resp)
+            retry_after = _retry_after_seconds(resp)
+            _safe_print(f"{tag} 收到 {resp.status_code}，将重试", file=sys.stderr)
+            continue
+
+        # 不可重试
+        if count > 1 and resp.status_code == 400 and "candidate" in resp.text.lower():
+            # 上游不支持一次返回多个候选：记下来，本次及以后都改为并发拆分
+            yield _thread_step(_remember_multi_candidate, False)
+            return _merge_images(count, (yield _split(0, count)))
+        return _fatal_error_result(resp)
+    else:
+        return {"success": False, "error": f"重试 {policy.max_retries} 次仍然失败。最后错误: {last_error}"}
+
+    if result["success"]:
+        saved = ", ".join(result.get("paths", [result["path"]]))
+        _safe_print(f"{tag} 编辑完成，大小 {result['size_kb']:.0f}KB -> {saved}")
+        result["elapsed"] = round(elapsed, 1)
+        result["timings"] = _result_timings(phases, t_task, queue=queued, backoff=backoff, prepare=prepare)
+        if key is not None:
+            yield _thread_step(_after_write, [result["path"]], cache.put, key, result["path"])
+        if count > 1:
+            got = len(result.get("paths", [result["path"]]))
+            yield _thread_step(_remember_multi_candidate, got > 1)
+            if got < count:
+                _safe_print(f"{tag} 上游返回了 {got}/{count} 张，其余并发补齐")
+                extra = yield _split(got, count - got)
+                result = _merge_images(count, [result, *extra])
+    return result
+
+
+def _edit_core(**kwargs) -> dict:
+    """编辑单张图片（线程引擎），参数与返回值见 _edit_steps。线程安全，不会调用 sys.exit。"""
+    return _run_steps(_edit_steps(**kwargs))
+
+
+async def _aedit_core(**kwargs) -> dict:
+    """_edit_core 的异步版本，供 async 引擎在单线程内并发调用（读图编码等阻塞操作放到线程池执行）。"""
+    return await _arun_steps(_edit_steps(**kwargs))
+
+
+# ---------------------------------------------------------------------------
+# 单张编辑（CLI 单图模式）
+# ---------------------------------------------------------------------------
+
+def edit(
+    input_image: str,
+    prompt: str,
+    api_key: str,
+    aspect_ratio: str = "1:1",
+    output_path: str = "output.png",
+    max_retries: int = 3,
+    cache: ResultCache | None = None,
+    preprocess: InputPreprocess | None = None,
+    hedge_percentile: float | None = None,
+    latency: LatencyHistory | None = None,
+    count: int = 1,
+    postprocess: OutputPostprocess | None = None,
+) -> str:
+    """单张编辑入口，失败时 sys.exit(1)。"""
+    result = _edit_core(
+        input_image=input_image,
+        prompt=prompt,
+        api_key=api_key,
+        aspect_ratio=aspect_ratio,
+        output_path=output_path,
+        max_retries=max_retries,
+        cache=cache,
+        preprocess=preprocess,
+        hedge=HedgePolicy(hedge_percentile, history=latency) if hedge_percentile else None,
+        latency=latency,
+        count=count,
+    )
+    if cache is not None:
+        cache.evict()
+    if latency is not None:
+        latency.save()
+    if not result["success"]:
+        _safe_print(f"错误: {result['error']}", file=sys.stderr, level="error")
+        sys.exit(1)
+    if postprocess is not None and postprocess.enabled:
+        postprocess_result(result, postprocess, "[ikunimage 编辑]")
+    return result["path"]
+
+
+# ---------------------------------------------------------------------------
+# 批量进度日志（中断后 --resume 续跑）
+# ---------------------------------------------------------------------------
+
+def _task_key(task: dict) -> str:
+    """任务指纹：任务内容与输入图片（大小、修改时间）都不变才视为同一任务。"""
+    try:
+        st = os.stat(_job_path(task["input"]))
+        input_stat = [st.st_size, st.st_mtime_ns]
+    except (OSError, KeyError, TypeError):
+        input_stat = None
+    canonical = json.dumps({"task": task, "input_stat": input_stat},
+                           sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _journal_output(path: str, digests: dict) -> dict:
+    """进度日志中一个输出文件的记录：路径、大小，以及 digests 中有的 sha256。"""
+    item = {"path": path, "bytes": Path(path).stat().st_size}
+    if path in digests:
+        item["sha256"] = digests[path]
+    return item
+
+
+class BatchJournal:
+    """批量任务进度日志：每个任务结束（成功或最终失败）时向 JSONL 文件追加一行。
+
+    每行写入后立即 fsync，进程被杀最多丢失正在写的那一行；读取时跳过无法解析的残行，
+    同一任务以最后一条记录为准。成功记录带输出文件的大小，以及写出时顺带算好的 sha256
+    （结果中的 "sha256"，不为此重读文件），续跑时据此校验；没有 sha256 的输出只校验大小。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def completed(self) -> dict:
+        """返回 {任务指纹: 最后一条记录}，仅包含最后一次成功的任务。"""
+        entries = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if isinstance(entry, dict) and "key" in entry:
+                        entries[entry["key"]] = entry
+        except FileNotFoundError:
+            return {}
+        return {k: e for k, e in entries.items() if e.get("success")}
+
+    def record(self, task: dict, result: dict) -> None:
+        entry = {
+            "key": _task_key(task),
+            "index": result.get("index"),
+            "success": result["success"],
+            "time": round(time.time(), 3),
+        }
+        if result["success"]:
+            digests = result.get("sha256", {})
+            entry.update(
+                _journal_output(result["path"], digests),
+                size_kb=result["size_kb"],
+                elapsed=result.get("elapsed", 0.0),
+            )
+            if "paths" in result:
+                entry["extra"] = [_journal_output(p, digests) for p in result["paths"][1:]]
+        else:
+            entry["error"] = result.get("error")
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = self._open()
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(self.path, "a+", encoding="utf-8")
+        # 上次写到一半被杀时补一个换行，免得新记录和残行粘在一起
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        return f
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _output_verifies(entry: dict) -> bool:
+    """日志中记录的输出文件（含多张输出的其余图片）仍然存在且内容未变（没有 sha256 的只比较大小）。"""
+    for item in (entry, *entry.get("extra", ())):
+        path = _job_path(item.get("path", ""))
+        try:
+            if path.stat().st_size != item.get("bytes"):
+                return False
+            if "sha256" in item and _file_digest(path) != item["sha256"]:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def _journal_hit(done: dict, task: dict, index: int) -> dict | None:
+    """任务在进度日志中已完成且输出文件校验通过时返回续跑结果，否则返回 None。"""
+    entry = done.get(_task_key(task))
+    if entry is None or not _output_verifies(entry):
+        return None
+    result = {
+        "success": True,
+        "path": entry["path"],
+        "size_kb": entry["size_kb"],
+        "elapsed": entry.get("elapsed", 0.0),
+        "resumed": True,
+        "index": index,
+    }
+    if "extra" in entry:
+        result["paths"] = [entry["path"], *(item["path"] for item in entry["extra"])]
+    return result
+
+
+# ---------------------------------------------------------------------------
+# 批量任务输入与结果汇总
+# ---------------------------------------------------------------------------
+
+def iter_jsonl_tasks(path: Path):
+    """逐行按需读取 JSONL 任务文件（跳过空行）。
+
+    不做整体预检查：解析失败的行以 ValueError 占位，由批量流程记为失败任务，不影响其他行。
+    """
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                yield ValueError(f"第 {line_no} 行 JSON 解析失败: {e}")
+
+
+def _sweep_path_value(value) -> str:
+    """填入输出路径模板的变量值：宽高比的 ":" 换成 "x"，路径分隔符换成 "_"。"""
+    return str(value).replace(":", "x").replace("/", "_").replace("\\", "_")
+
+
+def _sweep_task(spec: dict, values: dict) -> dict:
+    """按一组变量取值生成任务：与任务字段同名的变量直接作为字段，其余字段的字符串按模板替换。"""
+    task = {k: v for k, v in values.items() if k in SWEEP_TASK_FIELDS}
+    path_values = {k: _sweep_path_value(v) for k, v in values.items()}
+    for key, template in spec.items():
+        if key == "sweep":
+            continue
+        if isinstance(template, str):
+            task[key] = template.format_map(path_values if key == "output" else values)
+        else:
+            task[key] = template
+    return task
+
+
+def iter_sweep_tasks(spec: dict):
+    """展开参数扫描定义，返回按需生成任务的迭代器（不在内存中生成完整任务列表）。
+
+    spec 形如:
+        {"sweep": {"style": ["油画", "水墨"], "aspect_ratio": "*", "input": ["a.png", "b.png"]},
+         "prompt": "一只猫，{style}风格", "output": "sweep/{style}_{aspect_ratio}_{input}.png"}
+    sweep 中每个变量一组取值，按定义顺序做笛卡尔积；aspect_ratio 取 "*" 表示全部可选值。
+    其余字段是任务字段的模板，字符串中的 {变量} 按当前组合替换（{index} 为从 1 开始的序号，
+    字面量花括号写成 {{ }}）；与任务字段同名的变量没有对应模板时直接作为任务字段。
+    输出路径中的变量值把 ":" 换成 "x"、路径分隔符换成 "_"。
+
+    Raises:
+        ValueError: 定义有误（变量没有取值、模板引用了未定义的变量、输出路径无法区分不同组合等）
+    """
+    sweep = spec.get("sweep")
+    if not isinstance(sweep, dict) or not sweep:
+        raise ValueError("sweep 必须是非空对象（变量名 -> 取值列表）")
+    unknown = [k for k in spec if k != "sweep" and k not in SWEEP_TASK_FIELDS]
+    if unknown:
+        raise ValueError(f"未知字段 {', '.join(unknown)}（可用: {', '.join(SWEEP_TASK_FIELDS)}）")
+    choices = {"aspect_ratio": VALID_ASPECT_RATIOS}
+    axes = {}
+    for name, values in sweep.items():
+        if values == "*" and name in choices:
+            values = choices[name]
+        elif not isinstance(values, list):
+            values = [values]
+        if not values:
+            raise ValueError(f"变量 {name} 没有取值")
+        axes[name] = values
+    missing = [field for field in REQUIRED_TASK_FIELDS if field not in spec and field not in axes]
+    if missing:
+        raise ValueError(f"缺少字段 {', '.join(missing)}")
+    if not isinstance(spec.get("output"), str):
+        raise ValueError("output 必须是路径模板字符串")
+    try:
+        placeholders = {name for _, name, _, _ in string.Formatter().parse(spec["output"]) if name}
+        # 所有组合共用同一组模板，第一个组合能展开即可全部展开
+        _sweep_task(spec, dict(zip(axes, (values[0] for values in axes.values())), index=1))
+    except KeyError as e:
+        raise ValueError(f"模板引用了未定义的变量 {e}") from None
+    except (IndexError, ValueError) as e:
+        raise ValueError(f"模板格式有误: {e}") from None
+    ambiguous = [name for name, values in axes.items() if len(values) > 1 and name not in placeholders]
+    if ambiguous and "index" not in placeholders:
+        raise ValueError(f"output 模板缺少变量 {', '.join('{' + n + '}' for n in ambiguous)}，不同组合会写到同一路径")
+
+    total = math.prod(len(values) for values in axes.values())
+    shape = " × ".join(f"{name}({len(values)})" for name, values in axes.items())
+    _safe_print(f"[ikunimage 批量编辑] 参数扫描: {shape} = {total} 个任务")
+
+    def _expand():
+        for index, combo in enumerate(itertools.product(*axes.values()), 1):
+            yield _sweep_task(spec, dict(zip(axes, combo), index=index))
+
+    return _expand()
+
+
+def _task_error(task) -> str | None:
+    """检查单个批量任务，有问题时返回错误描述。"""
+    if isinstance(task, Exception):
+        return str(task)
+    if not isinstance(task, dict):
+        return "任务必须是 JSON 对象"
+    missing = [field for field in REQUIRED_TASK_FIELDS if field not in task]
+    if missing:
+        return f"缺少必填字段 {', '.join(missing)}"
+    if not _is_number(task.get("priority", 0)):
+        return "priority 必须是数字"
+    count = task.get("count", 1)
+    if not isinstance(count, int) or isinstance(count, bool) or not 1 <= count <= MAX_IMAGE_COUNT:
+        return f"count 必须是 1-{MAX_IMAGE_COUNT} 的整数"
+    try:
+        _task_deadline(task, 0)
+    except (TypeError, ValueError):
+        return "deadline 必须是秒数或 ISO 8601 时间"
+    return None
+
+
+class BatchResults:
+    """批量结果汇总：统计成功 / 命中缓存 / 续跑数，按需逐条写出或在内存中保留结果。
+
+    ndjson_path 不为空时每个任务结束即向该文件写一行 JSON，下游可以边跑边消费；
+    collect=False 时不在内存中保留结果，配合 JSONL 任务输入，内存占用与任务数无关。
+    metrics 不为空时每个结果同时计入批量指标（批量函数也从这里取用 metrics 统计请求）。
+    progress > 0 时每隔 progress 秒输出一行进度汇总（notice 级别，--quiet 下仍输出）。
+    线程安全。
+    """
+
+    def __init__(
+        self,
+        label: str,
+        collect: bool = True,
+        ndjson_path: Path | None = None,
+        metrics: BatchMetrics | None = None,
+        progress: float = 0,
+    ):
+        self.label = label
+        self.metrics = metrics
+        self.total = self.ok = self.cached = self.coalesced = self.resumed = self.skipped = 0
+        self._results = {} if collect else None
+        self._lock = threading.Lock()
+        self._file = None
+        if ndjson_path is not None:
+            ndjson_path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(ndjson_path, "w", encoding="utf-8")
+        self._started = time.time()
+        self._stop = threading.Event()
+        self._progress = None
+        if progress > 0:
+            self._progress = threading.Thread(
+                target=contextvars.copy_context().run, args=(self._report, progress), daemon=True,
+            )
+            self._progress.start()
+
+    def _report(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            with self._lock:
+                total, ok = self.total, self.ok
+            rate = ok / max(time.time() - self._started, 1e-9)
+            _safe_print(
+                f"[ikunimage {self.label}] 进度: 已完成 {total} 个（成功 {ok}，失败 {total - ok}），{rate:.2f} 张/秒",
+                level="notice", event="progress", done=total, ok=ok, failed=total - ok, rate=round(rate, 2),
+            )
+
+    @property
+    def failed(self) -> int:
+        return self.total - self.ok
+
+    def add(self, result: dict, announce: bool = True) -> None:
+        line = json.dumps(result, ensure_ascii=False) + "\n" if self._file is not None else None
+        with self._lock:
+            self.total += 1
+            self.ok += bool(result["success"])
+            self.cached += bool(result.get("cached"))
+            self.coalesced += bool(result.get("coalesced"))
+            self.resumed += bool(result.get("resumed"))
+            self.skipped += bool(result.get("skipped"))
+            if self._results is not None:
+                self._results[result["index"]] = result
+            if line is not None:
+                self._file.write(line)
+                self._file.flush()
+        if self.metrics is not None:
+            self.metrics.task(result)
+        if announce:
+            status = "OK" if result["success"] else "FAIL"
+            detail = {"path": result.get("path")} if result["success"] else {"error": result.get("error")}
+            _safe_print(f"[ikunimage {self.label}] 任务 #{result['index'] + 1} {status}",
+                        event="task", index=result["index"], success=result["success"], **detail)
+
+    def note(self) -> str:
+        """汇总行的补充说明，如 "（其中 3 个命中缓存），2 个因截止时间跳过"。"""
+        notes = []
+        if self.cached:
+            notes.append(f"{self.cached} 个命中缓存")
+        if self.coalesced:
+            notes.append(f"{self.coalesced} 个与相同任务合并请求")
+        if self.resumed:
+            notes.append(f"{self.resumed} 个沿用上次结果")
+        note = f"（其中 {'，'.join(notes)}）" if notes else ""
+        if self.skipped:
+            note += f"，{self.skipped} 个因截止时间跳过"
+        return note
+
+    def ordered(self) -> list:
+        """按任务序号排列的结果列表（collect=False 时为空）。"""
+        if self._results is None:
+            return []
+        return [self._results[i] for i in sorted(self._results)]
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._progress is not None:
+            self._progress.join()
+            self._progress = None
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# ---------------------------------------------------------------------------
+# 批量调度（优先级、截止时间、长任务优先）
+# ---------------------------------------------------------------------------
+
+def _expected_seconds(task) -> float:
+    """预估任务耗时（秒）。图生图只有一个延迟类别，各任务相同。"""
+    return EXPECTED_SECONDS["edit"]
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _task_deadline(task: dict, started: float) -> float | None:
+    """任务的截止时间（time.time() 时间戳），未设置时返回 None。
+
+    deadline 为数字时表示批量开始后的秒数，为字符串时按 ISO 8601 解析（不带时区按本地时间）；
+    格式不对时抛出 ValueError。
+    """
+    value = task.get("deadline")
+    if value is None:
+        return None
+    if _is_number(value):
+        return started + value
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).timestamp()
+    raise ValueError(f"无效的 deadline: {value!r}")
+
+
+def _deadline_skip(task: dict, index: int, started: float) -> dict | None:
+    """预计赶不上截止时间的任务返回跳过结果，否则返回 None（任务已通过 _task_error 检查）。"""
+    deadline = _task_deadline(task, started)
+    if deadline is None or time.time() + _expected_seconds(task) <= deadline:
+        return None
+    return {"success": False, "error": "预计无法在截止时间前完成，已跳过", "skipped": True, "index": index}
+
+
+class TaskScheduler:
+    """批量任务的取出顺序，迭代产出 (原始序号, 任务)。
+
+    priority 大的先取；同优先级中带 deadline 的任务按最晚开始时间（截止时间 - 预估耗时）先取，
+    其余按预估耗时从长到短（长任务先开跑，整批更早结束），最后按文件顺序。
+    只在最多 window 个已读入的任务中排序：JSON 数组不超过 window 时整体排序，
+    JSONL 流式读取时内存占用仍与任务数无关。无效任务排在最前，尽早报错。
+    """
+
+    def __init__(self, tasks: Iterable, started: float, window: int = SCHEDULE_WINDOW):
+        self.started = started
+        self.window = max(1, window)
+        self._source = enumerate(tasks)
+        self._heap = []
+
+    def _key(self, index: int, task) -> tuple:
+        if _task_error(task) is not None:
+            return (-math.inf, 0.0, 0.0, index)
+        expected = _expected_seconds(task)
+        deadline = _task_deadline(task, self.started)
+        latest_start = deadline - expected if deadline is not None else math.inf
+        return (-task.get("priority", 0), latest_start, -expected, index)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple:
+        # 先把窗口补满（首次读入 window 个，之后每取出一个再读入一个）
+        for index, task in self._source:
+            heapq.heappush(self._heap, (self._key(index, task), index, task))
+            if len(self._heap) >= self.window:
+                break
+        if not self._heap:
+            raise StopIteration
+        _, index, task = heapq.heappop(self._heap)
+        return index, task
+
+
+# ---------------------------------------------------------------------------
+# 相同任务合并（single-flight：同时在途的相同请求只发一次）
+# ---------------------------------------------------------------------------
+
+class SingleFlight:
+    """批量内相同请求的合并：同一时刻只有第一个任务（leader）真正发请求。
+
+    其余相同任务登记回调后立即让出 worker，leader 的输出落盘后把结果交给它们（见 _coalesced_result）；
+    leader 完成后再出现的相同任务重新发请求（需要跨批次复用请开启结果缓存）。线程安全。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}  # 合并键 -> 等待 leader 结果的回调
+
+    def join(self, key: str, callback: Callable[[dict], None]) -> bool:
+        """key 已有请求在途时登记 callback(leader 的结果) 并返回 True；否则本任务成为 leader，返回 False。"""
+        with self._lock:
+            waiters = self._flights.get(key)
+            if waiters is None:
+                self._flights[key] = []
+                return False
+            waiters.append(callback)
+            return True
+
+    def land(self, key: str, result: dict) -> None:
+        """leader 结束（输出已落盘、尚未后处理）后调用，在当前线程中依次执行登记的回调。"""
+        with self._lock:
+            waiters = self._flights.pop(key, [])
+        for callback in waiters:
+            callback(result)
+
+
+def _coalesced_result(task: dict, index: int, leader: dict) -> dict:
+    """把 leader 的结果分发给合并进来的任务：输出文件硬链接（跨文件系统时复制）到本任务的输出路径。"""
+    if not leader["success"]:
+        return {
+            "success": False,
+            "error": f"与任务 #{leader['index'] + 1} 合并的请求失败: {leader['error']}",
+            "index": index,
+        }
+    src = Path(leader["path"])
+    out = _job_path(task["output"])
+    if not _has_image_suffix(out):
+        out = out.with_name(out.name + src.suffix)
+    try:
+        _link_or_copy(src, out)
+    except OSError as e:
+        return {"success": False, "error": f"复制合并结果失败: {e}", "index": index}
+    result = {
+        "success": True,
+        "path": str(out),
+        "size_kb": leader["size_kb"],
+        "elapsed": leader.get("elapsed", 0.0),
+        "coalesced": True,
+        "index": index,
+    }
+    digest = leader.get("sha256", {}).get(leader["path"])
+    if digest is not None:
+        result["sha256"] = {str(out): digest}
+    return result
+
+
+def _flight_key(task: dict, count: int, input_cache: InputImageCache) -> str | None:
+    """相同任务的合并键：输入图片内容 + 编辑描述 + 宽高比（预处理参数整批相同）；多张输出的任务不合并。
+
+    输入图片读取失败时返回 None，由任务自己报错。
+    """
+    if task.get("count", count) != 1:
+        return None
+    try:
+        digest = input_cache.digest(Path(_job_path(task["input"])))
+    except OSError:
+        return None
+    canonical = json.dumps([digest, task["prompt"], task.get("aspect_ratio", "1:1")], ensure_ascii=False)
+    return hashlib.sha256(f"{MODEL_PATH}\n{canonical}".encode("utf-8")).hexdigest()
+
+
+# ---------------------------------------------------------------------------
+# 并发批量编辑
+# ---------------------------------------------------------------------------
+
+class _BatchRun:
+    """一次批量编辑中两种引擎共用的部分，参数见 edit_batch。
+
+    并发 / 重试 / 对冲策略、任务的前置检查（task_steps）、结果落盘后的记录（deliver）和结束汇总（summary）
+    只在这里写一遍；edit_batch（线程池）和 aedit_batch（协程）只负责取任务、调度和等待。
+    """
+
+    def __init__(
+        self,
+        tasks: Iterable,
+        api_key: str,
+        workers: int = 0,
+        max_retries: int = 3,
+        cache: ResultCache | None = None,
+        adaptive: bool = False,
+        retry_budget: int | None = None,
+        journal: BatchJournal | None = None,
+        resume: bool = False,
+        sink: BatchResults | None = None,
+        hedge_percentile: float | None = None,
+        hedge_budget: float = HEDGE_BUDGET_RATIO,
+        schedule: bool = True,
+        latency: LatencyHistory | None = None,
+        count: int = 1,
+        preprocess: InputPreprocess | None = None,
+        postprocess: OutputPostprocess | None = None,
+        fsync: str = "off",
+        coalesce: bool = True,
+        engine: str = "",
+    ):
+        num_tasks = len(tasks) if isinstance(tasks, Sized) else None
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.cache = cache
+        self.retry_budget = retry_budget
+        self.journal = journal
+        self.sink = sink or BatchResults("批量编辑")
+        self.metrics = self.sink.metrics
+        self.hedge_budget = hedge_budget
+        self.latency = latency
+        self.count = count
+        self.done = journal.completed() if journal is not None and resume else {}
+
+        if workers <= 0:
+            workers = ADAPTIVE_MAX_WORKERS if adaptive else 2
+        self.workers = max(1, min(workers, num_tasks or workers))
+        self.concurrency = AdaptiveConcurrency(max_limit=self.workers) if adaptive else None
+        workers_desc = f"自适应 1~{self.workers}" if adaptive else str(self.workers)
+        self.retry_policy = RetryPolicy(
+            max_retries, budget=RETRY_BUDGET_MIN if retry_budget is None else retry_budget, breaker=True,
+        )
+        self.hedge = HedgePolicy(hedge_percentile, budget=1, history=latency) if hedge_percentile else None
+        if self.metrics is not None:
+            self.metrics.hedge = self.hedge
+
+        tasks_desc = f"共 {num_tasks} 个任务" if num_tasks is not None else "流式读取任务"
+        _safe_print(f"[ikunimage 批量编辑] {tasks_desc}，并发数: {workers_desc}{engine}", level="notice")
+        if self.done:
+            _safe_print(f"[ikunimage 批量编辑] 断点续跑：进度日志中有 {len(self.done)} 个已完成任务，校验输出后跳过",
+                        level="notice")
+
+        self.t_start = time.time()
+        self.pending = TaskScheduler(tasks, self.t_start) if schedule else enumerate(tasks)
+        # 同一张输入图被多个任务引用时只读取、编码（预处理）一次
+        self.executor = _preprocess_executor(preprocess, self.workers)
+        self.input_cache = InputImageCache(preprocess=preprocess, executor=self.executor)
+        self.pipeline = open_output_pipeline(postprocess, self.workers, "批量编辑")
+        self.claims = OutputClaims(postprocess)
+        self.flights = SingleFlight() if coalesce else None
+        self.writer = OutputWriter(fsync)
+        # 在调用方的上下文中设置，worker 线程 / 协程与其中的对冲、拆分请求都继承它（解码器据此找到写入器）
+        self.writer_token = _output_writer.set(self.writer)
+
+    def extend_budgets(self) -> None:
+        """每取出一个任务，按比例增加批次的重试和对冲预算。"""
+        if self.retry_budget is None:
+            self.retry_policy.extend_budget(RETRY_BUDGET_RATIO)
+        if self.hedge is not None:
+            self.hedge.extend_budget(self.hedge_budget)
+
+    def _finish(self, task: dict, result: dict) -> None:
+        if self.journal is not None:
+            self.journal.record(task, result)
+        self.sink.add(result)
+
+    def deliver(self, task: dict, result: dict, key: str | None = None) -> None:
+        """输出落盘（及后处理）后才记录结果；落盘前立即返回，worker 继续下一个请求。
+
+        已落盘时会直接记录进度日志（fsync）、提交后处理（队列满时阻塞），async 引擎需放到线程里调用。
+        """
+        if not result["success"]:
+            if key is not None:
+                self.flights.land(key, result)
+            self._finish(task, result)
+            return
+
+        def _written(error: str | None) -> None:
+            if error is not None:
+                failed = {"success": False, "error": f"写出失败: {error}", "index": result["index"]}
+                if key is not None:
+                    self.flights.land(key, failed)
+                self._finish(task, failed)
+                return
+            if key is not None:
+                # 先让合并进来的任务链接原图，再交给后处理（转换格式时会删除原图）
+                self.flights.land(key, result)
+            if self.pipeline is not None:
+                self.pipeline.submit(result, lambda r: self._finish(task, r))
+            else:
+                self._finish(task, result)
+
+        self.writer.when_written(result.get("paths", [result["path"]]), _written)
+
+    def task_steps(self, index: int, task: dict, submitted: float | None = None):
+        """一个任务从前置检查到交付结果的全部步骤（生成器，见 _run_steps / _arun_steps）。"""
+        count = self.count
+        error = _task_error(task) or self.claims.claim(task, index, task.get("count", count))
+        if error is not None:
+            self.sink.add({"success": False, "error": error, "index": index})
+            return
+        resumed = (yield _thread_step(_journal_hit, self.done, task, index)) if self.done else None
+        if resumed is not None:
+            self.sink.add(resumed, announce=False)
+            return
+        skipped = _deadline_skip(task, index, self.t_start)
+        if skipped is not None:
+            self.sink.add(skipped)
+            return
+        # 合并键要读取输入图片算摘要，async 引擎放到线程里执行
+        key = (yield _thread_step(_flight_key, task, count, self.input_cache)) if self.flights is not None else None
+        if key is not None and self.flights.join(
+            key, lambda leader: self.deliver(task, _coalesced_result(task, index, leader)),
+        ):
+            # 相同请求已在途：不占用 worker，等 leader 完成后直接分发结果
+            return
+        result = yield from _edit_steps(
+            input_image=task["input"],
+            prompt=task["prompt"],
+            api_key=self.api_key,
+            aspect_ratio=task.get("aspect_ratio", "1:1"),
+            output_path=task["output"],
+            max_retries=self.max_retries,
+            task_label=f"#{index + 1}",
+            cache=self.cache,
+            concurrency=self.concurrency,
+            retry_policy=self.retry_policy,
+            hedge=self.hedge,
+            metrics=self.metrics,
+            submitted=submitted,
+            deadline=_task_deadline(task, self.t_start),
+            latency=self.latency,
+            count=task.get("count", count),
+            input_cache=self.input_cache,
+        )
+        result["index"] = index
+        yield _thread_step(self.deliver, task, result, key)
+
+    def _drain(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.writer.close()
+        if self.pipeline is not None:
+            self.pipeline.close()
+
+    def close_outputs(self) -> None:
+        """等待后台写盘和后处理全部完成（含记录结果的回调），撤下本批次的写入器。"""
+        try:
+            self._drain()
+        finally:
+            _output_writer.reset(self.writer_token)
+
+    async def aclose_outputs(self) -> None:
+        """close_outputs 的异步版本，等待放到线程里执行。"""
+        try:
+            await asyncio.to_thread(self._drain)
+        finally:
+            _output_writer.reset(self.writer_token)
+
+    def summary(self) -> list:
+        """写回缓存、延迟历史和进度日志，打印汇总，返回按任务序号排列的结果。"""
+        if self.cache is not None:
+            self.cache.evict()
+        if self.latency is not None:
+            self.latency.save()
+        if self.journal is not None:
+            self.journal.close()
+        sink = self.sink
+        sink.close()
+
+        t_total = time.time() - self.t_start
+        _safe_print(
+            f"\n[ikunimage 批量编辑] 全部完成: {sink.ok}/{sink.total} 成功{sink.note()}，总耗时 {t_total:.1f}s",
+            level="notice", event="summary", ok=sink.ok, total=sink.total, elapsed=round(t_total, 1),
+        )
+        if self.concurrency is not None:
+            _safe_print(f"[ikunimage 批量编辑] 并发上限变化: {self.concurrency.describe()}", level="notice")
+        if self.hedge is not None:
+            _safe_print(f"[ikunimage 批量编辑] 请求对冲: {self.hedge.describe()}", level="notice")
+        if _key_pool is not None and _key_pool.routes(self.api_key):
+            _safe_print(f"[ikunimage 批量编辑] Key 池: {_key_pool.describe()}", level="notice")
+        if self.metrics is not None and self.metrics.describe():
+            _safe_print(f"[ikunimage 批量编辑] 成功任务平均耗时: {self.metrics.describe()}", level="notice")
+
+        return sink.ordered()
+
+
+def edit_batch(tasks: Iterable, api_key: str, **options) -> list:
+    """并发批量编辑多张图片。
+
+    参数:
+        tasks: 任务列表或任意可迭代对象（如 iter_jsonl_tasks 的生成器，按需读取），每个元素为 dict:
+            {
+                "input": str,            # 必填，输入图片路径
+                "prompt": str,           # 必填，编辑描述
+                "aspect_ratio": str,     # 可选，默认 "1:1"
+                "output": str,           # 必填，输出路径
+                "count": int,            # 可选，默认取 count 参数，输出图片数（第 2 张起为 <文件名>_2 ...）
+                "priority": int,         # 可选，默认 0，越大越先执行
+                "deadline": float | str, # 可选，批量开始后的秒数或 ISO 8601 时间，预计赶不上时跳过
+            }
+        api_key: ikun API Key
+        以下为关键字参数:
+        workers: 并发数。0 = 自动（默认 2）
+        max_retries: 每个任务的最大重试次数（默认 3）
+        cache: 结果缓存，None 表示不使用
+        adaptive: 启用 AIMD 自适应并发，workers 作为并发上限（0 = 自动，默认 32）
+        retry_budget: 整个批次允许的重试总次数，None = 10 + 任务数的一半
+        journal: 进度日志，每个任务结束时追加记录
+        resume: 跳过 journal 中已完成且输出文件校验通过的任务
+        sink: 结果汇总（可逐条写 NDJSON、可不在内存中保留结果），None = 保留全部结果；
+              sink.metrics 不为空时同时统计请求数、流量和分阶段耗时
+        hedge_percentile: 启用请求对冲，在途时间超过该延迟分位数时再发一个相同请求
+        hedge_budget: 对冲请求数上限占任务数的比例（至少 1 个）
+        schedule: 按 priority / deadline / 预估耗时安排执行顺序（见 TaskScheduler），False = 按文件顺序
+        latency: 延迟历史，不为空时按历史耗时自适应超时（见 LatencyHistory），结束时写回
+        count: 任务未指定 count 时的输出图片数（默认 1）
+        preprocess: 输入图片预处理参数，在进程池中与网络请求并行执行
+        postprocess: 输出图片后处理参数，成功的任务交给进程池处理（见 OutputPipeline），
+                     处理完成后才记录进度日志和结果
+        fsync: 输出文件的 fsync 方式 off / batch / always（见 OutputWriter）；
+               输出由后台写线程写盘，落盘后才记录进度日志和结果，输出路径重复的任务记为失败
+        coalesce: 合并同时在途的相同任务（见 SingleFlight），只发一次请求，结果复制到各自的输出路径（默认开启）
+
+    返回:
+        按任务序号排列的结果列表，每个元素为 _edit_core 的返回值，
+        额外附加 "index" 字段表示原始任务序号；sink 不保留结果时为空列表。
+    """
+    run = _BatchRun(tasks, api_key, **options)
+    # 预热共享连接池，避免首批任务各自握手
+    warmup_http_pool(run.workers)
+
+    # 提交队列有界：最多 workers × BATCH_QUEUE_FACTOR 个任务在排队或执行，
+    # 任务文件按需读取，十万级任务也只占常量内存
+    slots = threading.BoundedSemaphore(run.workers * BATCH_QUEUE_FACTOR)
+    errors = []
+
+    def _on_done(future) -> None:
+        slots.release()
+        if future.exception() is not None:
+            errors.append(future.exception())
+
+    # worker 线程继承当前调用的上下文（守护进程中据此转发日志、解析相对路径，解码器据此找到写入器）
+    try:
+        with ThreadPoolExecutor(
+                max_workers=run.workers, initializer=_inherit_context, initargs=(contextvars.copy_context(),),
+        ) as pool:
+            for index, task in run.pending:
+                slots.acquire()
+                if errors:
+                    break
+                run.extend_budgets()
+                steps = run.task_steps(index, task, time.perf_counter())
+                pool.submit(_run_steps, steps).add_done_callback(_on_done)
+    finally:
+        run.close_outputs()
+    if errors:
+        raise errors[0]
+    return run.summary()
+
+
+async def aedit_batch(tasks: Iterable, api_key: str, **options) -> list:
+    """edit_batch 的 asyncio 版本：单线程内保持最多 workers 个请求同时在途。
+
+    参数与返回值同 edit_batch。HTTP/1.1 下在途连接数仍受 --max-connections
+    限制，高并发建议配合 --http2。
+    """
+    run = _BatchRun(tasks, api_key, engine="（async 引擎）", **options)
+
+    async def _worker():
+        # 所有 worker 共享同一个迭代器，按需取任务，取任务时不会让出事件循环，天然互斥
+        for index, task in run.pending:
+            run.extend_budgets()
+            await _arun_steps(run.task_steps(index, task))
+
+    try:
+        await awarmup_http_pool(run.workers)
+        await asyncio.gather(*(_worker() for _ in range(run.workers)))
+    finally:
+        if _daemon_loop is None:
+            await aclose_http_pool()
+        await run.aclose_outputs()
+    return run.summary()
+
+
+# ---------------------------------------------------------------------------
+# 守护进程（--serve：常驻保持连接池与配置，脚本调用作为瘦客户端提交）
+# ---------------------------------------------------------------------------
+
+class _Job:
+    """守护进程中的一次客户端调用：客户端的工作目录、环境变量中的 API Key、转发输出的日志写出器。"""
+
+    def __init__(self, cwd: str, api_key: str | None, logger: _LogWriter):
+        self.cwd = cwd
+        self.api_key = api_key
+        self.logger = logger
+
+
+# 当前线程 / 协程所属的客户端调用，进程内执行时为 None；批量 worker、对冲请求等线程都继承它
+_current_job: contextvars.ContextVar = contextvars.ContextVar("ikunimage_job", default=None)
+# 守护进程的常驻事件循环：async 引擎的调用都提交到这里，async 连接池跨调用复用
+_daemon_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _inherit_context(ctx: contextvars.Context) -> None:
+    """线程池的 initializer：worker 线程继承提交方的上下文变量（所属客户端调用、批量写入器等）。"""
+    for var, value in ctx.items():
+        var.set(value)
+
+
+def _job_path(path) -> Path:
+    """相对路径按发起调用的客户端的工作目录解析（进程内执行时原样返回）。"""
+    path = Path(path)
+    job = _current_job.get()
+    if job is None or path.is_absolute():
+        return path
+    return Path(job.cwd) / path
+
+
+def _run_async(coro):
+    """执行 async 批量：进程内新建事件循环；守护进程中提交到常驻事件循环并等待完成。"""
+    if _daemon_loop is None:
+        return asyncio.run(coro)
+    return asyncio.run_coroutine_threadsafe(coro, _daemon_loop).result()
+
+
+def _script_stamp() -> str:
+    """脚本路径 + 修改时间，用于发现守护进程运行的是更新前的旧脚本。"""
+    path = Path(__file__).resolve()
+    return f"{path}:{path.stat().st_mtime_ns}"
+
+
+def _send_frame(conn: socket.socket, lock: threading.Lock, frame: dict) -> None:
+    data = (json.dumps(frame, ensure_ascii=False) + "\n").encode("utf-8")
+    with lock:
+        conn.sendall(data)
+
+
+class _ChannelStream:
+    """类文件对象：把一次调用的 stdout / stderr 逐行打包成 JSON 帧发回客户端。"""
+
+    def __init__(self, conn: socket.socket, lock: threading.Lock, name: str):
+        self._conn = conn
+        self._lock = lock
+        self.name = name
+
+    def write(self, text: str) -> None:
+        _send_frame(self._conn, self._lock, {"stream": self.name, "data": text})
+
+    def flush(self) -> None:
+        pass
+
+
+def _run_job(job: _Job, argv: list) -> int:
+    """在当前线程内按命令行参数执行一次客户端调用，返回退出码。"""
+    _current_job.set(job)
+    try:
+        main(argv)
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:  # 单个调用的意外错误不能拖垮守护进程
+        _safe_print(f"错误: {e}", file=sys.stderr, level="error")
+        return 1
+    finally:
+        job.logger.close()
+
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+    """处理一个客户端连接：读取一行 JSON 请求，执行后发送 {"exit": 退出码}。
+
+    请求: {"argv": [...], "cwd": str, "api_key": str | null, "stamp": str}
+    执行期间的输出以 {"stream": "stdout" | "stderr", "data": str} 帧转发。
+    """
+
+    def handle(self) -> None:
+        try:
+            request = json.loads(self.rfile.readline())
+            argv, cwd = list(request["argv"]), str(request["cwd"])
+        except (ValueError, KeyError, TypeError):
+            return  # 探测连接或无效请求
+        lock = threading.Lock()
+        if request.get("stamp") != self.server.stamp:
+            error = "守护进程运行的脚本版本与当前脚本不一致，请重启守护进程"
+            _send_frame(self.connection, lock, {"exit": None, "error": error})
+            return
+        logger = _LogWriter(
+            stdout=_ChannelStream(self.connection, lock, "stdout"),
+            stderr=_ChannelStream(self.connection, lock, "stderr"),
+        )
+        number = next(self.server.calls)
+        t0 = time.time()
+        code = contextvars.copy_context().run(_run_job, _Job(cwd, request.get("api_key"), logger), argv)
+        _safe_print(f"[ikunimage 守护进程] 调用 #{number} 结束（退出码 {code}，耗时 {time.time() - t0:.1f}s）")
+        try:
+            _send_frame(self.connection, lock, {"exit": code})
+        except OSError:
+            pass  # 客户端已提前退出
+
+
+def _daemon_connect(socket_path: Path) -> socket.socket | None:
+    """连接守护进程；socket 不存在、无人监听或平台不支持 Unix socket 时返回 None。"""
+    if not hasattr(socket, "AF_UNIX") or not socket_path.exists():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(socket_path))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def submit_to_daemon(socket_path: Path, argv: list) -> int | None:
+    """把本次调用交给守护进程执行并原样转发其输出，返回退出码。
+
+    没有守护进程在运行、或它运行的是旧版本脚本时返回 None，由调用方在本进程内执行。
+    """
+    sock = _daemon_connect(socket_path)
+    if sock is None:
+        return None
+    request = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "api_key": os.environ.get("IKUN_API_KEY", "").strip() or None,
+        "stamp": _script_stamp(),
+    }
+    streams = {"stdout": sys.stdout, "stderr": sys.stderr}
+    with sock, sock.makefile("rb") as f:
+        try:
+            sock.sendall((json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8"))
+            for line in f:
+                frame = json.loads(line)
+                if "exit" in frame:
+                    if frame["exit"] is None:
+                        _safe_print(f"[ikunimage] 警告: {frame.get('error')}，改为在本进程内执行", file=sys.stderr)
+                    return frame["exit"]
+                stream = streams[frame["stream"]]
+                stream.write(frame["data"])
+                stream.flush()
+        except KeyboardInterrupt:
+            _safe_print("[ikunimage] 已中断；已提交的任务仍在守护进程中执行完毕，可用 --resume 续跑其余任务",
+                        file=sys.stderr)
+            return 130
+        except (OSError, ValueError, KeyError):
+            pass
+    _safe_print(f"错误: 与守护进程的连接意外中断（{socket_path}）", file=sys.stderr, level="error")
+    return 1
+
+
+def serve(socket_path: Path, max_connections: int, http2: bool) -> None:
+    """--serve：在 Unix socket 上常驻执行本脚本的客户端调用，直到 Ctrl+C 或 SIGTERM。
+
+    所有调用共用一个连接池（总在途请求数不超过 max_connections）、跨进程限流器、Key 池和结果缓存，
+    API Key 与 config.json 只在守护进程内解析；async 引擎的调用共用一个常驻事件循环。
+    """
+    global _daemon_loop
+    if not hasattr(socket, "AF_UNIX"):
+        _safe_print("错误: 当前平台不支持 Unix socket，无法启动守护进程", file=sys.stderr, level="error")
+        sys.exit(1)
+    probe = _daemon_connect(socket_path)
+    if probe is not None:
+        probe.close()
+        _safe_print(f"错误: 已有守护进程在 {socket_path} 上运行", file=sys.stderr, level="error")
+        sys.exit(1)
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    socket_path.unlink(missing_ok=True)  # 上次异常退出残留的 socket 文件
+
+    configure_http_pool(max_connections=max_connections, http2=http2)
+    configure_rate_limit_from_config()
+    configure_key_pool_from_config()
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="ikunimage-daemon-loop", daemon=True).start()
+    _daemon_loop = loop
+
+    old_umask = os.umask(0o177)  # socket 文件只允许当前用户连接
+    try:
+        server = socketserver.ThreadingUnixStreamServer(str(socket_path), _DaemonHandler)
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    server.stamp = _script_stamp()
+    server.calls = itertools.count(1)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    warmup_http_pool()
+    _safe_print(f"[ikunimage 守护进程] 已启动: {socket_path}（连接池上限 {_client_options['max_connections']}）",
+                level="notice")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        socket_path.unlink(missing_ok=True)
+        _safe_print("[ikunimage 守护进程] 已退出", level="notice")
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def main(argv: list | None = None):
+    parser = argparse.ArgumentParser(
+        description="ikunimage - NanoBananaPro 图生图 / 图片编辑器（ikun 渠道）",
+        epilog="上传本地图片 + 文字描述，AI 生成编辑后的新图片。",
+    )
+
+    # 配置子命令
+    parser.add_argument(
+        "--setup", action="store_true",
+        help="交互式引导创建配置文件",
+    )
+
+    # API Key
+    parser.add_argument(
+        "--api-key", default=None,
+        help="API Key（优先级高于环境变量和配置文件）",
+    )
+
+    # 单图模式参数
+    parser.add_argument(
+        "--input", "-i", default=None,
         help="输入图片路径（单图模式，必填）",
     )
     parser.add_argument(
@@ -479,73 +4531,314 @@ def main():
         "--output", "-o", default="output.png",
         help="输出文件路径",
     )
+    parser.add_argument(
+        "--count", "-n", type=int, default=1,
+        choices=range(1, MAX_IMAGE_COUNT + 1), metavar=f"1-{MAX_IMAGE_COUNT}",
+        help="输出图片数：一次请求多个候选，上游不支持时并发拆分；第 2 张起为 <文件名>_2 ...，"
+             "批量时作为任务 count 字段的默认值（默认: 1）",
+    )
+
+    # 输入预处理（需要 Pillow）
+    parser.add_argument(
+        "--max-input-edge", type=int, default=0, metavar="PX",
+        help="上传前把输入图片长边缩到不超过 PX 像素（默认: 不缩放）",
+    )
+    parser.add_argument(
+        "--input-format", choices=INPUT_FORMATS, default=None,
+        help="上传前把输入图片重编码为该格式（默认: 保持原格式）",
+    )
+    parser.add_argument(
+        "--input-quality", type=int, default=85,
+        choices=range(1, 101), metavar="1-100",
+        help="webp / jpeg 重编码质量（默认: 85）",
+    )
+
+    # 输出后处理（需要 Pillow；批量时在进程池中与网络请求并行执行）
+    parser.add_argument(
+        "--output-format", choices=OUTPUT_FORMATS, default=None,
+        help="把输出图片转换为该格式，扩展名随之改变（默认: 保持接口返回的格式）",
+    )
+    parser.add_argument(
+        "--output-quality", type=int, default=85,
+        choices=range(1, 101), metavar="1-100",
+        help="输出转换为 webp / jpeg 时的质量（默认: 85）",
+    )
+    parser.add_argument(
+        "--max-output-edge", type=int, default=0, metavar="PX",
+        help="把输出图片长边缩到不超过 PX 像素（默认: 不缩放）",
+    )
+    parser.add_argument(
+        "--thumbnail", type=int, default=0, metavar="PX",
+        help="另存长边为 PX 像素的缩略图 <文件名>.thumb.<扩展名>（默认: 不生成）",
+    )
+    parser.add_argument(
+        "--strip-metadata", action="store_true",
+        help="去除输出图片的 EXIF / ICC 等元数据",
+    )
+    parser.add_argument(
+        "--keep-original", action="store_true",
+        help="--output-format 转换后保留接口返回的原文件",
+    )
+    parser.add_argument(
+        "--coalesce", action=argparse.BooleanOptionalAction, default=True,
+        help="批量中同时在途的相同任务只请求一次，结果复制到各自的输出路径"
+             "（默认开启，想让相同任务各出一张不同的图时用 --no-coalesce）",
+    )
+    parser.add_argument(
+        "--fsync", choices=FSYNC_MODES, default="off",
+        help="批量输出文件的 fsync 方式：off 不 fsync，batch 攒一批一起 fsync，always 每个文件都 fsync（默认: off）",
+    )
 
     # 批量模式参数
     parser.add_argument(
         "--batch", "-b", default=None, metavar="JSON_FILE",
-        help="批量任务 JSON 文件路径（与 --input/--prompt 互斥）",
+        help="批量任务文件：JSON 数组、.jsonl（每行一个任务，按需读取），"
+             "或带 sweep 的参数扫描定义（按需展开）（与 --input/--prompt 互斥）",
     )
     parser.add_argument(
         "--workers", "-w", type=int, default=0,
         help="并发 worker 数（默认: 自动）",
     )
+    parser.add_argument(
+        "--results", default=None, metavar="JSONL_FILE",
+        help="每个任务完成即向该文件写一行结果（NDJSON），结束时不再打印汇总 JSON",
+    )
+    parser.add_argument(
+        "--metrics", default=None, metavar="FILE",
+        help="导出批量指标（请求 / 重试 / 流量计数与分阶段耗时直方图）：.prom 为 Prometheus textfile，其他为 JSON",
+    )
+    parser.add_argument(
+        "--metrics-interval", type=float, default=0, metavar="SECONDS",
+        help="批量运行期间每隔多少秒导出一次指标（默认: 只在结束时导出）",
+    )
+    parser.add_argument(
+        "--journal", default=None, metavar="JSONL_FILE",
+        help="批量进度日志路径（默认: 批量文件同目录的 <文件名>.journal.jsonl）",
+    )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="按进度日志跳过已完成且输出文件未变的任务",
+    )
+    parser.add_argument(
+        "--retry-budget", type=int, default=None, metavar="N",
+        help="整个批次允许的重试总次数（默认: 任务数的一半，至少 10）",
+    )
+    parser.add_argument(
+        "--hedge", type=float, nargs="?", const=HEDGE_DEFAULT_PERCENTILE, default=None, metavar="PERCENTILE",
+        help=f"请求对冲：在途时间超过该延迟分位数时再发一个相同请求，取先完成者（默认分位数: {HEDGE_DEFAULT_PERCENTILE:g}）",
+    )
+    parser.add_argument(
+        "--hedge-budget", type=float, default=HEDGE_BUDGET_RATIO, metavar="RATIO",
+        help=f"批量时对冲请求数上限占任务数的比例（默认: {HEDGE_BUDGET_RATIO:g}）",
+    )
+    parser.add_argument(
+        "--fixed-timeout", action="store_true",
+        help="不按历史耗时自适应超时，始终使用固定超时（600 秒）",
+    )
+    parser.add_argument(
+        "--adaptive", action="store_true",
+        help=f"按 429/延迟自动调整并发（AIMD），--workers 作为上限（默认上限: {ADAPTIVE_MAX_WORKERS}）",
+    )
+    parser.add_argument(
+        "--engine", choices=["thread", "async"], default="thread",
+        help="批量并发引擎：thread 线程池 / async 单线程协程（默认: thread）",
+    )
+    parser.add_argument(
+        "--schedule", action=argparse.BooleanOptionalAction, default=True,
+        help="按任务的 priority / deadline 和预估耗时（长任务优先）安排执行顺序（默认开启，--no-schedule 按文件顺序）",
+    )
 
     # 通用参数
+    parser.add_argument(
+        "--quiet", "-q", action="store_true",
+        help="只输出批量汇总、警告和错误，不输出逐个任务的进度",
+    )
+    parser.add_argument(
+        "--log-json", action="store_true",
+        help="日志以 JSON Lines 输出（每行含 ts / level / msg，任务与进度事件带结构化字段）",
+    )
+    parser.add_argument(
+        "--progress", type=float, default=0, metavar="SECONDS",
+        help="批量时每隔多少秒输出一行进度汇总（常与 --quiet 配合）",
+    )
+    parser.add_argument(
+        "--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS,
+        help=f"共享连接池最大连接数（默认: {DEFAULT_MAX_CONNECTIONS}）",
+    )
+    parser.add_argument(
+        "--http2", action="store_true",
+        help="启用 HTTP/2 多路复用（需要 pip install 'httpx[http2]'）",
+    )
+    parser.add_argument(
+        "--cache", action=argparse.BooleanOptionalAction, default=None,
+        help="复用相同请求的历史结果（默认取 config.json 的 cache，未配置则关闭）",
+    )
+    parser.add_argument(
+        "--refresh", action="store_true",
+        help="忽略已有缓存重新请求，并用新结果更新缓存",
+    )
     parser.add_argument(
         "--retry", "-r", type=int, default=3,
         choices=range(0, 11), metavar="0-10",
         help="每个任务的最大重试次数（默认: 3）",
     )
 
-    args = parser.parse_args()
+    # 守护进程
+    parser.add_argument(
+        "--serve", action="store_true",
+        help="以守护进程运行：常驻保持连接池与配置，之后的调用自动提交给它执行",
+    )
+    parser.add_argument(
+        "--socket", default=str(DAEMON_SOCKET), metavar="PATH",
+        help=f"守护进程的 Unix socket 路径（默认: {DAEMON_SOCKET}）",
+    )
+    parser.add_argument(
+        "--no-daemon", action="store_true",
+        help="即使有守护进程在运行也在本进程内执行",
+    )
+
+    args = parser.parse_args(argv)
+    configure_logging(quiet=args.quiet, json_lines=args.log_json)
 
     # --setup 模式
     if args.setup:
         run_setup()
         return
 
+    # --serve 模式
+    if args.serve:
+        serve(Path(args.socket), args.max_connections, args.http2)
+        return
+
     # 互斥检查
     if args.batch and (args.input or args.prompt):
         parser.error("--batch 和 --input/--prompt 不能同时使用")
     if not args.batch and (not args.input or not args.prompt):
         parser.error("单图模式必须同时指定 --input 和 --prompt，或使用 --batch 批量模式")
 
+    # 有守护进程在运行时交给它执行，本进程只转发输出
+    job = _current_job.get()
+    if job is None and not args.no_daemon:
+        code = submit_to_daemon(Path(args.socket), sys.argv[1:] if argv is None else argv)
+        if code is not None:
+            sys.exit(code)
+
+    preprocess = InputPreprocess(
+        max_edge=max(0, args.max_input_edge),
+        format=args.input_format,
+        quality=args.input_quality,
+    )
+    postprocess = OutputPostprocess(
+        format=args.output_format,
+        quality=args.output_quality,
+        max_edge=max(0, args.max_output_edge),
+        thumbnail=max(0, args.thumbnail),
+        strip=args.strip_metadata,
+        keep_original=args.keep_original,
+    )
+    if (preprocess.enabled or postprocess.enabled) and Image is None:
+        _safe_print("错误: 输入预处理 / 输出后处理需要 Pillow 库，请执行: pip install pillow",
+                    file=sys.stderr, level="error")
+        sys.exit(1)
+
     # 解析 API Key
-    api_key = resolve_api_key(args.api_key)
+    api_key = resolve_api_key(args.api_key or (job.api_key if job is not None else None))
+    if job is None:
+        # 守护进程中连接池与限流在启动时配置，所有调用共用
+        configure_http_pool(max_connections=args.max_connections, http2=args.http2)
+        configure_rate_limit_from_config()
+        configure_key_pool_from_config()
+    cache = open_cache(args.cache, args.refresh)
+    latency = open_latency_history(not args.fixed_timeout)
 
     if args.batch:
         # 批量模式
-        batch_path = Path(args.batch)
+        batch_path = _job_path(args.batch)
         if not batch_path.exists():
-            print(f"错误: 批量任务文件不存在: {batch_path}", file=sys.stderr)
-            sys.exit(1)
-
-        try:
-            tasks = json.loads(batch_path.read_text(encoding="utf-8"))
-        except (json.JSONDecodeError, UnicodeDecodeError) as e:
-            print(f"错误: 解析批量任务文件失败: {e}", file=sys.stderr)
+            _safe_print(f"错误: 批量任务文件不存在: {batch_path}", file=sys.stderr, level="error")
             sys.exit(1)
 
-        if not isinstance(tasks, list) or not tasks:
-            print("错误: 批量任务文件必须是非空 JSON 数组", file=sys.stderr)
-            sys.exit(1)
+        if batch_path.suffix.lower() in JSONL_SUFFIXES:
+            # JSONL 逐行按需读取；有问题的行在执行时记为失败任务，不做整体预检查
+            tasks = iter_jsonl_tasks(batch_path)
+        else:
+            try:
+                tasks = json.loads(batch_path.read_text(encoding="utf-8"))
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                _safe_print(f"错误: 解析批量任务文件失败: {e}", file=sys.stderr, level="error")
+                sys.exit(1)
 
-        for i, t in enumerate(tasks):
-            for field in ("input", "prompt", "output"):
-                if field not in t:
-                    print(f"错误: 任务 #{i + 1} 缺少必填字段 '{field}'", file=sys.stderr)
+            if isinstance(tasks, dict) and "sweep" in tasks:
+                # 参数扫描：任务按需展开，有问题的组合在执行时记为失败任务
+                try:
+                    tasks = iter_sweep_tasks(tasks)
+                except ValueError as e:
+                    _safe_print(f"错误: 参数扫描定义有误: {e}", file=sys.stderr, level="error")
                     sys.exit(1)
+            elif not isinstance(tasks, list) or not tasks:
+                _safe_print("错误: 批量任务文件必须是非空 JSON 数组（或带 sweep 的参数扫描定义）",
+                            file=sys.stderr, level="error")
+                sys.exit(1)
+            else:
+                for i, t in enumerate(tasks):
+                    for field in ("input", "prompt", "output"):
+                        if field not in t:
+                            _safe_print(f"错误: 任务 #{i + 1} 缺少必填字段 '{field}'", file=sys.stderr, level="error")
+                            sys.exit(1)
 
-        results = edit_batch(
+        journal_path = _job_path(args.journal) if args.journal else batch_path.with_name(
+            f"{batch_path.stem}.journal.jsonl")
+        if args.resume and not journal_path.exists():
+            _safe_print(f"[ikunimage 批量编辑] 未找到进度日志 {journal_path}，从头开始", file=sys.stderr)
+        _safe_print(f"[ikunimage 批量编辑] 进度日志: {journal_path}", level="notice")
+
+        results_path = _job_path(args.results) if args.results else None
+        # 结果逐条写入文件时不再在内存中保留，也不在结束时打印汇总 JSON
+        metrics = BatchMetrics(_job_path(args.metrics), args.metrics_interval) if args.metrics else None
+        sink = BatchResults(
+            "批量编辑", collect=results_path is None, ndjson_path=results_path,
+            metrics=metrics, progress=args.progress,
+        )
+
+        batch_kwargs = dict(
             tasks=tasks,
             api_key=api_key,
             workers=args.workers,
             max_retries=args.retry,
+            adaptive=args.adaptive,
+            retry_budget=args.retry_budget,
+            journal=BatchJournal(journal_path),
+            resume=args.resume,
+            sink=sink,
+            hedge_percentile=args.hedge,
+            hedge_budget=args.hedge_budget,
+            schedule=args.schedule,
+            latency=latency,
+            count=args.count,
+            postprocess=postprocess,
+            fsync=args.fsync,
+            coalesce=args.coalesce,
+            cache=cache,
+            preprocess=preprocess,
         )
+        if metrics is not None:
+            metrics.start()
+        try:
+            if args.engine == "async":
+                results = _run_async(aedit_batch(**batch_kwargs))
+            else:
+                results = edit_batch(**batch_kwargs)
+        finally:
+            if metrics is not None:
+                metrics.close()
+                _safe_print(f"[ikunimage 批量编辑] 指标已写入: {metrics.path}", level="notice")
 
-        print("\n" + json.dumps(results, indent=2, ensure_ascii=False))
+        if results_path is None:
+            _print_result("\n" + json.dumps(results, indent=2, ensure_ascii=False))
+        else:
+            _safe_print(f"[ikunimage 批量编辑] 结果已逐条写入: {results_path}", level="notice")
 
-        if any(not r["success"] for r in results if r):
+        if sink.failed:
             sys.exit(1)
     else:
         # 单图模式
@@ -556,6 +4849,12 @@ def main():
             aspect_ratio=args.aspect_ratio,
             output_path=args.output,
             max_retries=args.retry,
+            cache=cache,
+            preprocess=preprocess,
+            hedge_percentile=args.hedge,
+            latency=latency,
+            count=args.count,
+            postprocess=postprocess,
         )
 
 